@@ -1,6 +1,13 @@
 from .constants import *
+from .tracing import *
+from .cache import *
+from .archive import *
+from .installer import *
+from .wheelhouse import *
 from .config import *
+from .lock import *
 from .executer import *
+from .importtime import *
 from .cli import *
 
 from importlib.metadata import version
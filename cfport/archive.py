@@ -0,0 +1,636 @@
+import os
+import stat
+import time
+import zlib
+import struct
+import tarfile
+
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Tuple
+from typing import Union
+from typing import BinaryIO
+from typing import Iterator
+from typing import Optional
+from typing import NamedTuple
+from pathlib import Path
+from collections import deque
+from cftool.console import log
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+
+from .cache import format_size
+from .tracing import trace
+from .constants import ARCHIVE_MTIME
+from .constants import ARCHIVE_WORKERS
+from .constants import ARCHIVE_CHUNK_SIZE
+from .constants import ARCHIVE_ZSTD_LEVEL
+from .constants import ARCHIVE_DEFLATE_LEVEL
+from .constants import WORKSPACE_META_DIR
+
+
+archive_formats = {"zip": ".zip", "tar.gz": ".tar.gz", "tar.zst": ".tar.zst"}
+# these files are already compressed (or are hardly compressible), so they are stored
+# as is instead of being compressed again
+stored_suffixes = {
+    ".whl",
+    ".zip",
+    ".gz",
+    ".tgz",
+    ".bz2",
+    ".xz",
+    ".zst",
+    ".7z",
+    ".jar",
+    ".egg",
+    ".safetensors",
+    ".pt",
+    ".pth",
+    ".ckpt",
+    ".bin",
+    ".onnx",
+    ".gguf",
+    ".npz",
+    ".png",
+    ".jpg",
+    ".jpeg",
+    ".gif",
+    ".webp",
+    ".mp3",
+    ".mp4",
+    ".webm",
+    ".woff2",
+}
+
+ZIP64_LIMIT = (1 << 32) - 1
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+
+class _Entry(NamedTuple):
+    arcname: str
+    path: Path
+    kind: str
+    size: int
+    mode: int
+    target: Optional[str]
+
+    @property
+    def is_stored(self) -> bool:
+        return self.path.suffix.lower() in stored_suffixes
+
+
+# a segment of an archive stream, which is either bytes, or a range of a file
+TSegment = Union[bytes, Tuple[Path, int, int]]
+
+
+def _scan(root: Path, prefix: str, ignores: List[str]) -> List[_Entry]:
+    """Returns the entries under `root`, sorted by their names so the order is stable."""
+
+    entries = [_Entry(prefix, root, "dir", 0, 0o755, None)]
+    for dirpath, dirnames, filenames in os.walk(root):
+        if ignores and dirpath == str(root):
+            dirnames[:] = [name for name in dirnames if name not in ignores]
+            filenames = [name for name in filenames if name not in ignores]
+        rel_dir = Path(dirpath).relative_to(root).as_posix()
+        arc_dir = prefix if rel_dir == "." else f"{prefix}/{rel_dir}"
+        for name in dirnames + filenames:
+            path = Path(dirpath) / name
+            arcname = f"{arc_dir}/{name}"
+            st = os.lstat(path)
+            if stat.S_ISLNK(st.st_mode):
+                target = os.readlink(path)
+                entries.append(_Entry(arcname, path, "link", 0, 0o777, target))
+            elif stat.S_ISDIR(st.st_mode):
+                entries.append(_Entry(arcname, path, "dir", 0, 0o755, None))
+            elif stat.S_ISREG(st.st_mode):
+                mode = 0o755 if st.st_mode & 0o111 else 0o644
+                entries.append(_Entry(arcname, path, "file", st.st_size, mode, None))
+    entries.sort(key=lambda e: e.arcname)
+    # files which are hardlinked to a previous file are marked by `target`, so they can
+    # be stored as hardlinks in tar archives
+    inodes: Dict[Tuple[int, int], str] = {}
+    for i, entry in enumerate(entries):
+        if entry.kind != "file":
+            continue
+        st = os.lstat(entry.path)
+        if st.st_nlink < 2:
+            continue
+        target = inodes.setdefault((st.st_dev, st.st_ino), entry.arcname)
+        if target != entry.arcname:
+            entries[i] = entry._replace(target=target)
+    return entries
+
+
+def _read_segments(segments: List[TSegment]) -> bytes:
+    parts = []
+    for segment in segments:
+        if isinstance(segment, bytes):
+            parts.append(segment)
+            continue
+        path, offset, length = segment
+        with path.open("rb") as f:
+            f.seek(offset)
+            data = f.read(length)
+        if len(data) != length:
+            raise RuntimeError(f"'{path}' is modified while archiving")
+        parts.append(data)
+    return b"".join(parts)
+
+
+def _process_chunk(
+    segments: List[TSegment],
+    level: Optional[int],
+    final: bool,
+) -> Tuple[bytes, Optional[bytes]]:
+    """
+    Reads the chunk and compresses it into a raw deflate stream (if `level` is not
+    `None`). Non-final chunks end with a full flush, so the compressed chunks can be
+    concatenated into a valid deflate stream (just like `pigz`).
+    """
+
+    data = _read_segments(segments)
+    if level is None:
+        return data, None
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    compressed = compressor.compress(data)
+    compressed += compressor.flush(zlib.Z_FINISH if final else zlib.Z_FULL_FLUSH)
+    return data, compressed
+
+
+def _final_deflate_block() -> bytes:
+    compressor = zlib.compressobj(0, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.flush(zlib.Z_FINISH)
+
+
+class _OrderedPool:
+    """Runs jobs concurrently, but yields their results in the submission order."""
+
+    def __init__(self, executor: ThreadPoolExecutor, max_pending: int):
+        self.executor = executor
+        self.max_pending = max_pending
+        self.pending: deque = deque()
+
+    def push(self, tag: Any, *args: Any) -> Iterator[Tuple[Any, Any]]:
+        """
+        Submits a chunk (`args` of `_process_chunk`, no job will be submitted if `args` is
+        empty), and yields the results that should be consumed to keep the pool bounded.
+        """
+
+        future: Optional[Future] = None
+        if args:
+            future = self.executor.submit(_process_chunk, *args)
+        self.pending.append((tag, future))
+        while len(self.pending) > self.max_pending:
+            yield self._pop()
+
+    def drain(self) -> Iterator[Tuple[Any, Any]]:
+        while self.pending:
+            yield self._pop()
+
+    def _pop(self) -> Tuple[Any, Any]:
+        tag, future = self.pending.popleft()
+        return tag, None if future is None else future.result()
+
+
+# the DOS date format used by zip starts from 1980-01-01
+ARCHIVE_MTIME_MIN = 315532800
+
+
+def _dos_time(mtime: int) -> Tuple[int, int]:
+    t = time.gmtime(max(mtime, ARCHIVE_MTIME_MIN))
+    dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    dos_date = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    return dos_time, dos_date
+
+
+class _ZipWriter:
+    """
+    Writes zip archives (with zip64 extensions when needed) from compressed chunks, which
+    `zipfile` cannot do.
+    """
+
+    def __init__(self, f: BinaryIO, mtime: int):
+        self.f = f
+        self.dos_time, self.dos_date = _dos_time(mtime)
+        self.central: List[bytes] = []
+        # the entry which is being written
+        self.entry: Optional[_Entry] = None
+        self.header_offset = 0
+        self.method = ZIP_STORED
+        self.zip64 = False
+        self.crc = 0
+        self.size = 0
+        self.compressed_size = 0
+
+    def _flags(self, name: bytes) -> int:
+        # marks the names as utf-8 if they are not ascii
+        return 0 if name.isascii() else 0x800
+
+    def _get_name(self, entry: _Entry) -> bytes:
+        # directories are marked by the trailing slash in zip
+        if entry.kind == "dir":
+            return f"{entry.arcname}/".encode()
+        return entry.arcname.encode()
+
+    def _local_header(self, entry: _Entry, crc: int, sizes: Tuple[int, int]) -> bytes:
+        name = self._get_name(entry)
+        version = 45 if self.zip64 else 20
+        compressed_size, size = sizes
+        extra = b""
+        if self.zip64:
+            extra = struct.pack("<HHQQ", 1, 16, size, compressed_size)
+            compressed_size = size = ZIP64_LIMIT
+        header = struct.pack(
+            "<IHHHHHIIIHH",
+            0x04034B50,
+            version,
+            self._flags(name),
+            self.method,
+            self.dos_time,
+            self.dos_date,
+            crc,
+            compressed_size,
+            size,
+            len(name),
+            len(extra),
+        )
+        return header + name + extra
+
+    def begin(self, entry: _Entry, method: int) -> None:
+        self.entry = entry
+        self.header_offset = self.f.tell()
+        self.method = method
+        # same as `zipfile`, leaves some room for the expansion of the compression
+        self.zip64 = entry.size * 1.05 > ZIP64_LIMIT
+        self.crc = 0
+        self.size = 0
+        self.compressed_size = 0
+        self.f.write(self._local_header(entry, 0, (0, 0)))
+
+    def write(self, data: bytes, compressed: Optional[bytes]) -> None:
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        output = data if compressed is None else compressed
+        self.f.write(output)
+        self.compressed_size += len(output)
+
+    def end(self) -> None:
+        entry = self.entry
+        if entry is None:
+            raise RuntimeError("no entry is being written")
+        if entry.kind == "file" and self.size != entry.size:
+            raise RuntimeError(f"'{entry.path}' is modified while archiving")
+        sizes = self.compressed_size, self.size
+        end = self.f.tell()
+        self.f.seek(self.header_offset)
+        self.f.write(self._local_header(entry, self.crc, sizes))
+        self.f.seek(end)
+        self._add_central(entry, self.crc, sizes)
+        self.entry = None
+
+    def write_entry(
+        self,
+        entry: _Entry,
+        data: bytes,
+        compressed: Optional[bytes],
+    ) -> None:
+        # small files are stored if they cannot be compressed at all
+        if compressed is None or len(compressed) >= len(data):
+            self.begin(entry, ZIP_STORED)
+            self.write(data, None)
+        else:
+            self.begin(entry, ZIP_DEFLATED)
+            self.write(data, compressed)
+        self.end()
+
+    def _add_central(self, entry: _Entry, crc: int, sizes: Tuple[int, int]) -> None:
+        name = self._get_name(entry)
+        compressed_size, size = sizes
+        offset = self.header_offset
+        zip64_fields = []
+        if size >= ZIP64_LIMIT:
+            zip64_fields.append(size)
+            size = ZIP64_LIMIT
+        if compressed_size >= ZIP64_LIMIT:
+            zip64_fields.append(compressed_size)
+            compressed_size = ZIP64_LIMIT
+        if offset >= ZIP64_LIMIT:
+            zip64_fields.append(offset)
+            offset = ZIP64_LIMIT
+        extra = b""
+        if zip64_fields:
+            n = len(zip64_fields)
+            extra = struct.pack(f"<HH{n}Q", 1, 8 * n, *zip64_fields)
+        if entry.kind == "dir":
+            mode = stat.S_IFDIR | entry.mode
+        elif entry.kind == "link":
+            mode = stat.S_IFLNK | entry.mode
+        else:
+            mode = stat.S_IFREG | entry.mode
+        external_attr = mode << 16
+        if entry.kind == "dir":
+            # the MS-DOS directory attribute
+            external_attr |= 0x10
+        version = 45 if self.zip64 or zip64_fields else 20
+        header = struct.pack(
+            "<IHHHHHHIIIHHHHHII",
+            0x02014B50,
+            (3 << 8) | version,
+            version,
+            self._flags(name),
+            self.method,
+            self.dos_time,
+            self.dos_date,
+            crc,
+            compressed_size,
+            size,
+            len(name),
+            len(extra),
+            0,
+            0,
+            0,
+            external_attr,
+            offset,
+        )
+        self.central.append(header + name + extra)
+
+    def close(self) -> None:
+        offset = self.f.tell()
+        for header in self.central:
+            self.f.write(header)
+        size = self.f.tell() - offset
+        n = len(self.central)
+        if n >= 0xFFFF or size >= ZIP64_LIMIT or offset >= ZIP64_LIMIT:
+            zip64_offset = self.f.tell()
+            self.f.write(
+                struct.pack(
+                    "<IQHHIIQQQQ",
+                    0x06064B50,
+                    44,
+                    45,
+                    45,
+                    0,
+                    0,
+                    n,
+                    n,
+                    size,
+                    offset,
+                )
+            )
+            self.f.write(struct.pack("<IIQI", 0x07064B50, 0, zip64_offset, 1))
+            n = min(n, 0xFFFF)
+            size = min(size, ZIP64_LIMIT)
+            offset = min(offset, ZIP64_LIMIT)
+        self.f.write(struct.pack("<IHHHHIIH", 0x06054B50, 0, 0, n, n, size, offset, 0))
+
+
+def _write_zip(
+    f: BinaryIO,
+    entries: List[_Entry],
+    pool: _OrderedPool,
+    chunk_size: int,
+    mtime: int,
+) -> None:
+    writer = _ZipWriter(f, mtime)
+    level = ARCHIVE_DEFLATE_LEVEL
+
+    def _consume(tag: Any, result: Any) -> None:
+        entry, index, num_chunks = tag
+        if entry.kind != "file":
+            writer.begin(entry, ZIP_STORED)
+            if entry.kind == "link":
+                writer.write((entry.target or "").encode(), None)
+            writer.end()
+        elif num_chunks == 1:
+            writer.write_entry(entry, *result)
+        else:
+            if index == 0:
+                method = ZIP_STORED if entry.is_stored else ZIP_DEFLATED
+                writer.begin(entry, method)
+            if index < num_chunks - 1:
+                writer.write(*result)
+            else:
+                data, compressed = result
+                writer.write(data, compressed)
+                if compressed is not None:
+                    writer.write(b"", _final_deflate_block())
+                writer.end()
+
+    def _jobs() -> Iterator[Tuple[Any, Any]]:
+        for entry in entries:
+            if entry.kind != "file":
+                yield from pool.push((entry, 0, 1))
+                continue
+            entry_level = None if entry.is_stored else level
+            num_chunks = max(1, -(-entry.size // chunk_size))
+            for i in range(num_chunks):
+                offset = i * chunk_size
+                length = min(chunk_size, entry.size - offset)
+                segments: List[TSegment] = [(entry.path, offset, length)]
+                final = num_chunks == 1
+                tag = entry, i, num_chunks
+                yield from pool.push(tag, segments, entry_level, final)
+        yield from pool.drain()
+
+    for tag, result in _jobs():
+        _consume(tag, result)
+    writer.close()
+
+
+def _tar_header(entry: _Entry, mtime: int) -> bytes:
+    info = tarfile.TarInfo(entry.arcname)
+    info.mtime = mtime
+    info.mode = entry.mode
+    info.uid = info.gid = 0
+    info.uname = info.gname = ""
+    if entry.kind == "dir":
+        info.type = tarfile.DIRTYPE
+    elif entry.kind == "link":
+        info.type = tarfile.SYMTYPE
+        info.linkname = entry.target or ""
+    elif entry.target is not None:
+        info.type = tarfile.LNKTYPE
+        info.linkname = entry.target
+    else:
+        info.size = entry.size
+    return info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+
+
+def _tar_chunks(
+    entries: List[_Entry],
+    chunk_size: int,
+    mtime: int,
+) -> Iterator[Tuple[List[TSegment], bool]]:
+    """
+    Splits the tar stream of `entries` into chunks of `chunk_size` bytes, yields the
+    segments of each chunk, and whether the chunk only contains stored files.
+    """
+
+    segments: List[TSegment] = []
+    filled = 0
+    stored = 0
+    total = 0
+
+    def _add(segment: TSegment, length: int, is_stored: bool) -> Iterator[Any]:
+        nonlocal segments, filled, stored
+        segments.append(segment)
+        filled += length
+        stored += length if is_stored else 0
+        if filled >= chunk_size:
+            yield segments, stored == filled
+            segments, filled, stored = [], 0, 0
+
+    def _add_bytes(data: bytes) -> Iterator[Any]:
+        for i in range(0, len(data), chunk_size):
+            piece = data[i : i + chunk_size]
+            yield from _add(piece, len(piece), False)
+
+    for entry in entries:
+        header = _tar_header(entry, mtime)
+        total += len(header)
+        yield from _add_bytes(header)
+        if entry.kind != "file" or entry.target is not None or entry.size == 0:
+            continue
+        offset = 0
+        while offset < entry.size:
+            length = min(chunk_size - filled, entry.size - offset)
+            yield from _add((entry.path, offset, length), length, entry.is_stored)
+            offset += length
+        total += entry.size
+        padding = -entry.size % tarfile.BLOCKSIZE
+        total += padding
+        yield from _add_bytes(b"\0" * padding)
+    # the end of the archive, padded to a whole record like `tarfile`
+    end = 2 * tarfile.BLOCKSIZE
+    end += -(total + end) % tarfile.RECORDSIZE
+    yield from _add_bytes(b"\0" * end)
+    if segments:
+        yield segments, stored == filled
+
+
+def _write_tar_gz(
+    f: BinaryIO,
+    entries: List[_Entry],
+    pool: _OrderedPool,
+    chunk_size: int,
+    mtime: int,
+) -> None:
+    # the gzip header with no name & a zero timestamp, so it is reproducible
+    f.write(b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff")
+    crc = size = 0
+
+    def _jobs() -> Iterator[Tuple[Any, Any]]:
+        for segments, is_stored in _tar_chunks(entries, chunk_size, mtime):
+            level = 0 if is_stored else ARCHIVE_DEFLATE_LEVEL
+            yield from pool.push(None, segments, level, False)
+        yield from pool.drain()
+
+    for _, (data, compressed) in _jobs():
+        crc = zlib.crc32(data, crc)
+        size += len(data)
+        f.write(compressed)
+    f.write(_final_deflate_block())
+    f.write(struct.pack("<II", crc, size & 0xFFFFFFFF))
+
+
+def _write_tar_zst(
+    f: BinaryIO,
+    entries: List[_Entry],
+    pool: _OrderedPool,
+    chunk_size: int,
+    mtime: int,
+    workers: int,
+) -> None:
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError(
+            "`zstandard` is required for `tar.zst` archives, "
+            "install it by `pip install carefree-portable[zstd]`"
+        )
+    # `zstd` compresses with its own threads, and its output does not depend on the
+    # number of threads (as long as it is positive)
+    compressor = zstandard.ZstdCompressor(level=ARCHIVE_ZSTD_LEVEL, threads=workers)
+
+    def _jobs() -> Iterator[Tuple[Any, Any]]:
+        for segments, _ in _tar_chunks(entries, chunk_size, mtime):
+            yield from pool.push(None, segments, None, False)
+        yield from pool.drain()
+
+    with compressor.stream_writer(f, closefd=False) as writer:
+        for _, (data, _) in _jobs():
+            writer.write(data)
+
+
+def get_archive_path(root: Path, archive_format: str) -> Path:
+    """Returns the default path of the `archive_format` archive of `root`."""
+
+    if archive_format not in archive_formats:
+        raise ValueError(f"unknown archive format '{archive_format}'")
+    return root.parent / f"{root.name}{archive_formats[archive_format]}"
+
+
+def export_archive(
+    root: Path,
+    archive_format: str = "zip",
+    path: Optional[Path] = None,
+    *,
+    workers: int = ARCHIVE_WORKERS,
+    chunk_size: int = ARCHIVE_CHUNK_SIZE,
+    ignores: Optional[List[str]] = None,
+) -> Path:
+    """
+    Export the directory `root` to an archive (`zip` / `tar.gz` / `tar.zst`) at `path`
+    (defaults to `get_archive_path`), which contains `root` as its top-level folder.
+
+    Files are streamed into the archive chunk by chunk, and the chunks are read and
+    compressed by `workers` threads (`zlib` and `zstd` release the GIL), so the memory
+    footprint is bounded by a few chunks per worker. Files with `stored_suffixes` (e.g.
+    wheels, safetensors) are stored without being compressed again.
+
+    Hardlinked files are stored as hardlinks in tar archives (zip does not support them).
+
+    The output is byte-identical for identical inputs: entries are sorted, timestamps are
+    set to `ARCHIVE_MTIME` (`SOURCE_DATE_EPOCH`, if provided), owners are dropped and
+    permissions are normalized to `755` / `644`.
+
+    `ignores` are the top-level names which are excluded (defaults to the workspace
+    meta directory).
+    """
+
+    if path is None:
+        path = get_archive_path(root, archive_format)
+    elif archive_format not in archive_formats:
+        raise ValueError(f"unknown archive format '{archive_format}'")
+    if ignores is None:
+        ignores = [WORKSPACE_META_DIR]
+    workers = max(1, workers)
+    t = time.time()
+    with trace(f"archive {path.name}", "archive", format=archive_format):
+        entries = _scan(root, root.name, ignores)
+        total = sum(entry.size for entry in entries)
+        log(f"archiving {len(entries)} entries ({format_size(total)}) to '{path}'")
+        tmp_path = path.with_name(f"{path.name}.tmp")
+        with ThreadPoolExecutor(workers) as executor, tmp_path.open("wb") as f:
+            pool = _OrderedPool(executor, 2 * workers)
+            args: Dict[str, Any] = dict(chunk_size=chunk_size, mtime=ARCHIVE_MTIME)
+            if archive_format == "zip":
+                _write_zip(f, entries, pool, **args)
+            elif archive_format == "tar.gz":
+                _write_tar_gz(f, entries, pool, **args)
+            else:
+                _write_tar_zst(f, entries, pool, workers=workers, **args)
+        tmp_path.replace(path)
+    size = format_size(path.stat().st_size)
+    log(f"archived '{path}' ({size}) in {time.time() - t:.2f}s")
+    return path
+
+
+__all__ = [
+    "archive_formats",
+    "stored_suffixes",
+    "get_archive_path",
+    "export_archive",
+]
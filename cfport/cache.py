@@ -0,0 +1,291 @@
+import os
+import json
+import shutil
+import hashlib
+import threading
+
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Union
+from typing import Optional
+from pathlib import Path
+from cftool.console import log
+
+from .constants import DOWNLOAD_CACHE_DIR
+from .constants import DOWNLOAD_CACHE_MAX_SIZE
+
+
+size_units = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
+def parse_size(size: Union[int, str]) -> int:
+    if isinstance(size, int):
+        return size
+    size = size.strip().upper().rstrip("B")
+    unit = size[-1:] if size[-1:] in size_units else ""
+    number = size[: len(size) - len(unit)]
+    return int(float(number) * size_units[unit])
+
+
+def format_size(size: float) -> str:
+    for unit in ["B", "KB", "MB", "GB"]:
+        if size < 1024:
+            return f"{size:.2f}{unit}"
+        size /= 1024
+    return f"{size:.2f}TB"
+
+
+def hash_file(path: Path) -> str:
+    sha256 = hashlib.sha256()
+    with path.open("rb") as f:
+        while True:
+            chunk = f.read(1 << 20)
+            if not chunk:
+                break
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _tmp_path(path: Path) -> Path:
+    return path.with_name(f"{path.name}.tmp{os.getpid()}-{threading.get_ident()}")
+
+
+def _place(src: Path, dst: Path, *, link: bool) -> None:
+    tmp_dst = _tmp_path(dst)
+    if tmp_dst.exists():
+        tmp_dst.unlink()
+    try:
+        if not link:
+            raise OSError
+        os.link(src, tmp_dst)
+    except OSError:
+        shutil.copyfile(src, tmp_dst)
+    tmp_dst.replace(dst)
+
+
+# blobs which are being put into the cache by this process, they will not be evicted
+_pinned_blobs: Dict[Path, int] = {}
+_pinned_lock = threading.Lock()
+
+
+def _pin(blob: Path, delta: int) -> None:
+    with _pinned_lock:
+        count = _pinned_blobs.get(blob, 0) + delta
+        if count > 0:
+            _pinned_blobs[blob] = count
+        else:
+            _pinned_blobs.pop(blob, None)
+
+
+class DownloadCache:
+    """
+    A user-level, content-addressed cache of downloaded files, shared across workspaces.
+
+    Files are stored once under `blobs/<sha256>`, and each url is mapped to its blob by
+    a small `urls/<sha256 of url>.json` entry. The modification time of a blob records
+    its last access, which is used to evict the least recently used blobs when the total
+    size exceeds `max_size`.
+
+    Since every write is an atomic rename, multiple `cfport` processes can share the
+    same cache without locking.
+    """
+
+    def __init__(
+        self,
+        root: Path = DOWNLOAD_CACHE_DIR,
+        max_size: Union[int, str] = DOWNLOAD_CACHE_MAX_SIZE,
+    ):
+        self.root = root
+        self.max_size = parse_size(max_size)
+        self.blobs_dir = root / "blobs"
+        self.urls_dir = root / "urls"
+
+    def _url_path(self, url: str) -> Path:
+        return self.urls_dir / f"{hashlib.sha256(url.encode()).hexdigest()}.json"
+
+    def _load_entry(self, url: str) -> Optional[Dict[str, Any]]:
+        url_path = self._url_path(url)
+        if not url_path.is_file():
+            return None
+        try:
+            with url_path.open("r") as f:
+                entry = json.load(f)
+        except ValueError:
+            return None
+        if entry.get("url") != url:
+            return None
+        return entry
+
+    def _blobs(self) -> Dict[Path, os.stat_result]:
+        if not self.blobs_dir.is_dir():
+            return {}
+        blobs = {}
+        for blob in self.blobs_dir.iterdir():
+            if ".tmp" in blob.name:
+                continue
+            # blobs might be evicted by other threads / processes at any time
+            try:
+                blobs[blob] = blob.stat()
+            except FileNotFoundError:
+                continue
+        return blobs
+
+    def get(self, url: str, *, sha256: Optional[str] = None) -> Optional[Path]:
+        """
+        Return the cached blob of `url`, or `None` if it is not cached.
+
+        If `sha256` is provided, the blob is looked up by its content directly, so files
+        downloaded from other urls (e.g. mirrors) can be reused as well. Blobs are named by
+        their verified hashes, so they do not need to be hashed again here.
+        """
+
+        # blobs might be evicted by other threads / processes at any time
+        try:
+            if sha256 is not None:
+                blob = self.blobs_dir / sha256.lower()
+                if not blob.is_file():
+                    return None
+            else:
+                entry = self._load_entry(url)
+                if entry is None:
+                    return None
+                blob = self.blobs_dir / entry["sha256"]
+                if not blob.is_file() or blob.stat().st_size != entry["size"]:
+                    return None
+            os.utime(blob)
+        except FileNotFoundError:
+            return None
+        return blob
+
+    def restore(
+        self,
+        url: str,
+        path: Path,
+        *,
+        sha256: Optional[str] = None,
+        link: bool = False,
+    ) -> bool:
+        """
+        Restore the cached `url` to `path`, returns whether the cache is hit.
+
+        `link` should only be `True` if `path` will not be modified afterwards (e.g. it is
+        an archive which will be removed after extraction), because the hardlink shares its
+        content with the cached blob.
+        """
+
+        blob = self.get(url, sha256=sha256)
+        if blob is None:
+            return False
+        log(f"restoring '{url}' from cache")
+        try:
+            _place(blob, path, link=link)
+        except FileNotFoundError:
+            log(f"'{blob.name}' is evicted from cache meanwhile, it will be downloaded")
+            return False
+        return True
+
+    def put(
+        self,
+        url: str,
+        path: Path,
+        *,
+        sha256: Optional[str] = None,
+        link: bool = False,
+    ) -> Path:
+        """Put the downloaded `path` of `url` into the cache, returns the cached blob."""
+
+        if sha256 is None:
+            sha256 = hash_file(path)
+        self.blobs_dir.mkdir(parents=True, exist_ok=True)
+        self.urls_dir.mkdir(parents=True, exist_ok=True)
+        blob = self.blobs_dir / sha256
+        _pin(blob, 1)
+        try:
+            try:
+                os.utime(blob)
+            except FileNotFoundError:
+                _place(path, blob, link=link)
+            entry = dict(url=url, sha256=sha256, size=path.stat().st_size)
+            url_path = self._url_path(url)
+            tmp_url_path = _tmp_path(url_path)
+            with tmp_url_path.open("w") as f:
+                json.dump(entry, f)
+            tmp_url_path.replace(url_path)
+            self.prune(keep=[blob])
+        finally:
+            _pin(blob, -1)
+        return blob
+
+    def stats(self) -> Dict[str, Any]:
+        blobs = self._blobs()
+        num_urls = 0
+        if self.urls_dir.is_dir():
+            num_urls = len(list(self.urls_dir.glob("*.json")))
+        return dict(
+            root=str(self.root),
+            num_urls=num_urls,
+            num_blobs=len(blobs),
+            size=sum(stat.st_size for stat in blobs.values()),
+            max_size=self.max_size,
+        )
+
+    def prune(
+        self,
+        max_size: Optional[Union[int, str]] = None,
+        *,
+        keep: Optional[List[Path]] = None,
+    ) -> int:
+        """
+        Evict the least recently used blobs until the cache fits in `max_size`, and
+        remove dangling url entries. Returns the number of bytes freed.
+        """
+
+        limit = self.max_size if max_size is None else parse_size(max_size)
+        blobs = self._blobs()
+        total = sum(stat.st_size for stat in blobs.values())
+        freed = 0
+        for blob, stat in sorted(blobs.items(), key=lambda item: item[1].st_mtime):
+            if total <= limit:
+                break
+            if keep is not None and blob in keep:
+                continue
+            with _pinned_lock:
+                if blob in _pinned_blobs:
+                    continue
+            log(f"evicting '{blob.name}' ({format_size(stat.st_size)}) from cache")
+            blob.unlink(missing_ok=True)
+            total -= stat.st_size
+            freed += stat.st_size
+        if self.urls_dir.is_dir():
+            for url_path in self.urls_dir.glob("*.json"):
+                try:
+                    with url_path.open("r") as f:
+                        sha256 = json.load(f)["sha256"]
+                except (OSError, ValueError, KeyError):
+                    sha256 = None
+                if sha256 is None or not (self.blobs_dir / sha256).is_file():
+                    url_path.unlink(missing_ok=True)
+        return freed
+
+    def clear(self) -> int:
+        """Remove everything in the cache, returns the number of bytes freed."""
+
+        size = self.stats()["size"]
+        if self.root.is_dir():
+            shutil.rmtree(self.root)
+        return size
+
+
+def get_download_cache() -> Optional[DownloadCache]:
+    """Returns the global download cache, or `None` if it is disabled by `CFPORT_NO_CACHE`."""
+
+    if os.environ.get("CFPORT_NO_CACHE", "0") not in ("", "0"):
+        return None
+    return DownloadCache()
+
+
+__all__ = [
+    "DownloadCache",
+    "get_download_cache",
+]
@@ -3,7 +3,15 @@ import click
 import cfport
 
 from cftool import console
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
 from pathlib import Path
+from cfport.cache import format_size
+from cfport.tracing import COPIED_BYTES
+from cfport.tracing import DOWNLOADED_BYTES
+from cfport.cache import DownloadCache
 from cfport.config import load_config
 from cfport.toolkit import Platform
 from cfport.constants import AUTO_KEY
@@ -25,19 +33,78 @@ def run_config(
     console.log("Done!")
 
 
-def run_package(*, file: str) -> None:
-    console.rule("Packaging Project")
+def _load_config(file: str, *, write_lock: bool = False) -> cfport.IConfig:
     console.log(f"Loading config from {file}")
     config = load_config(file)
+    # lock file is relative to the config file, and the default lock file will be used
+    # if it exists (or if it should be written)
+    lock_path = Path(file).parent / cfport.DEFAULT_LOCK_FILE
+    if config.lock_file is not None:
+        config.lock_file = str(Path(file).parent / config.lock_file)
+    elif write_lock or lock_path.is_file():
+        console.log(f"Using lock file: {lock_path}")
+        config.lock_file = str(lock_path)
+    return config
+
+
+def _format_metrics(metrics: Dict[str, Any]) -> str:
+    msg = f"{metrics['wall']:.2f}s wall, {metrics['cpu']:.2f}s cpu"
+    if metrics.get("children_cpu") is not None:
+        msg += f", {metrics['children_cpu']:.2f}s subprocess cpu"
+    for key, label in [(DOWNLOADED_BYTES, "downloaded"), (COPIED_BYTES, "copied")]:
+        if metrics.get(key):
+            msg += f", {format_size(metrics[key])} {label}"
+    if metrics.get("peak_rss") is not None:
+        msg += f", {format_size(metrics['peak_rss'])} peak rss"
+    return msg
+
+
+def _print_profile(summary: Dict[str, Any]) -> None:
+    console.rule("Profile")
+    console.log(f"Total: {_format_metrics(summary['total'])}")
+    blocks = sorted(summary["blocks"].items(), key=lambda kv: -kv[1]["wall"])
+    for name, metrics in blocks:
+        console.log(f"block '{name}': {_format_metrics(metrics)}")
+    for i, hotspot in enumerate(summary["hotspots"]):
+        prefix = f"#{i + 1} {hotspot['category']} '{hotspot['name']}'"
+        if hotspot["block"] is not None:
+            prefix += f" (in '{hotspot['block']}')"
+        console.log(f"{prefix}: {_format_metrics(hotspot)}")
+
+
+def run_package(
+    *,
+    file: str,
+    offline: bool = False,
+    force: Optional[List[str]] = None,
+    profile: bool = False,
+    resume: bool = False,
+    archive: Optional[str] = None,
+    lock: bool = False,
+) -> None:
+    console.rule("Packaging Project")
+    config = _load_config(file, write_lock=lock)
+    if offline:
+        console.log("Packaging in offline mode")
+        config.offline = True
     workspace = config.workspace
     console.log(f"Workspace: {workspace}")
     console.log("Initializing executer")
     executer = cfport.Executer.init(config)
     console.log("Launching executer")
-    executer.launch()
+    try:
+        executer.launch(force=force, resume=resume)
+    except Exception:
+        console.log("Packaging failed, run `cfport package --resume` to continue")
+        raise
     console.log(f"Dumping executer to {workspace}/executer.json")
     with (Path(workspace) / "executer.json").open("w") as f:
         json.dump(executer.to_pack().asdict(), f, indent=2)
+    if archive is not None:
+        console.rule("Archiving Workspace")
+        cfport.export_archive(Path(workspace), archive)
+    if profile and executer.trace_summary is not None:
+        _print_profile(executer.trace_summary)
     console.rule("Congratulations")
     console.log("Your portable project is ready!")
 
@@ -51,6 +118,76 @@ def run_execute(*, file: str) -> None:
     console.log("Your portable project is ready!")
 
 
+def run_lock(*, file: str, upgrade: bool = False) -> None:
+    console.rule("Locking Python Requirements")
+    config = _load_config(file)
+    if config.lock_file is None:
+        config.lock_file = str(Path(file).parent / cfport.DEFAULT_LOCK_FILE)
+    config.upgrade_lock = upgrade
+    console.log(f"Lock file: {config.lock_file}")
+    executer = cfport.Executer.init(config)
+    # only the blocks which are needed for locking are built, and the checkpoint of a
+    # failed `cfport package` is kept
+    lock_block = cfport.LockPythonRequirementsBlock()
+    executer.launch(
+        [
+            cfport.PrepareBlock(),
+            cfport.DownloadBlock(),
+            cfport.PreparePythonBlock(),
+            lock_block,
+        ],
+        use_external_blocks=False,
+        use_checkpoint=False,
+    )
+    if lock_block.lock is None:
+        raise RuntimeError("failed to lock the python requirements (see above)")
+    console.log("Done!")
+
+
+def run_cache(*, action: str, max_size: Optional[str] = None) -> None:
+    cache = DownloadCache()
+    if action == "stats":
+        stats = cache.stats()
+        console.log(f"Cache root: {stats['root']}")
+        console.log(f"Cached urls: {stats['num_urls']}")
+        console.log(f"Cached files: {stats['num_blobs']}")
+        console.log(
+            f"Cache size: {format_size(stats['size'])} / "
+            f"{format_size(stats['max_size'])}"
+        )
+    elif action == "prune":
+        freed = cache.prune(max_size)
+        console.log(f"Pruned {format_size(freed)} from cache")
+    elif action == "clear":
+        freed = cache.clear()
+        console.log(f"Cleared {format_size(freed)} from cache")
+    else:
+        raise ValueError(f"unknown cache action: {action}")
+
+
+def run_profile_launch(
+    *,
+    file: str,
+    runs: int = 5,
+    warmup: int = 1,
+    timeout: float = 60.0,
+    top: int = 20,
+    output: Optional[str] = None,
+) -> None:
+    console.rule("Profiling Launch")
+    config = _load_config(file)
+    path = None if output is None else Path(output)
+    cfport.profile_launch(
+        config,
+        runs=runs,
+        warmup=warmup,
+        timeout=timeout,
+        top=top,
+        path=path,
+    )
+    console.log("Done!")
+
+
 @click.group()
 def main() -> None:
     pass
@@ -97,8 +234,61 @@ def config(
     type=str,
     help="The config file for packaging.",
 )
-def package(*, file: str) -> None:
-    run_package(file=file)
+@click.option(
+    "--offline",
+    is_flag=True,
+    help="Package without network access, everything should be in the local caches.",
+)
+@click.option(
+    "--force",
+    multiple=True,
+    type=str,
+    help="Build the block (e.g. `download`) even if it is up to date, can be repeated. "
+    "Use `all` to build every block.",
+)
+@click.option(
+    "--profile",
+    is_flag=True,
+    help="Print the hotspots of this run, the full trace is always dumped to "
+    "`.cfport/trace` in the workspace.",
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    help="Resume the last failed run from its first incomplete block / requirement / "
+    "asset / download.",
+)
+@click.option(
+    "--archive",
+    default=None,
+    type=click.Choice(list(cfport.archive_formats)),
+    help="Export the workspace to an archive next to it after packaging.",
+)
+@click.option(
+    "--lock",
+    is_flag=True,
+    help="Lock the requirements into `cfport.lock` next to the config file (if it is not "
+    "up to date), and install from it. An existing lock file is always used.",
+)
+def package(
+    *,
+    file: str,
+    offline: bool,
+    force: List[str],
+    profile: bool,
+    resume: bool,
+    archive: Optional[str],
+    lock: bool,
+) -> None:
+    run_package(
+        file=file,
+        offline=offline,
+        force=list(force),
+        profile=profile,
+        resume=resume,
+        archive=archive,
+        lock=lock,
+    )
 
 
 @main.command()
@@ -112,10 +302,107 @@ def execute(*, file: str) -> None:
     run_execute(file=file)
 
 
+@main.command()
+@click.option(
+    "-f",
+    "--file",
+    default=cfport.DEFAULT_CONFIG_FILE,
+    show_default=True,
+    type=str,
+    help="The config file whose python requirements should be locked.",
+)
+@click.option(
+    "--upgrade",
+    is_flag=True,
+    help="Resolve the requirements again even if the lock file is up to date.",
+)
+def lock(*, file: str, upgrade: bool) -> None:
+    run_lock(file=file, upgrade=upgrade)
+
+
+@main.command()
+@click.argument("action", type=click.Choice(["stats", "prune", "clear"]))
+@click.option(
+    "--max-size",
+    default=None,
+    type=str,
+    help="The size limit (e.g. `10G`) used by `prune`, defaults to `CFPORT_CACHE_MAX_SIZE`.",
+)
+def cache(*, action: str, max_size: Optional[str]) -> None:
+    run_cache(action=action, max_size=max_size)
+
+
+@main.command(name="profile-launch")
+@click.option(
+    "-f",
+    "--file",
+    default=cfport.DEFAULT_CONFIG_FILE,
+    show_default=True,
+    type=str,
+    help="The config file of the packaged project.",
+)
+@click.option(
+    "--runs",
+    default=5,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="The number of runs to aggregate.",
+)
+@click.option(
+    "--warmup",
+    default=1,
+    show_default=True,
+    type=click.IntRange(min=0),
+    help="The number of runs to discard before profiling (e.g. to write bytecode).",
+)
+@click.option(
+    "--timeout",
+    default=60.0,
+    show_default=True,
+    type=float,
+    help="Kill the project after this many seconds (e.g. servers) in each run.",
+)
+@click.option(
+    "--top",
+    default=20,
+    show_default=True,
+    type=int,
+    help="The number of packages to print.",
+)
+@click.option(
+    "-o",
+    "--output",
+    default=None,
+    type=str,
+    help="Path of the JSON report, defaults to `.cfport/importtime.json` in the "
+    "workspace.",
+)
+def profile_launch(
+    *,
+    file: str,
+    runs: int,
+    warmup: int,
+    timeout: float,
+    top: int,
+    output: Optional[str],
+) -> None:
+    run_profile_launch(
+        file=file,
+        runs=runs,
+        warmup=warmup,
+        timeout=timeout,
+        top=top,
+        output=output,
+    )
+
+
 __all__ = [
     "run_config",
     "run_package",
     "run_execute",
+    "run_lock",
+    "run_cache",
+    "run_profile_launch",
 ]
 
 
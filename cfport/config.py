@@ -1,6 +1,6 @@
 import json
+import hashlib
 import tempfile
-import subprocess
 
 from typing import Any
 from typing import Dict
@@ -17,15 +17,24 @@ from cftool.console import log
 from cftool.console import rule
 
 from .toolkit import cp
+from .toolkit import sync
 from .toolkit import download
+from .toolkit import parse_download_name
 from .toolkit import git_clone
 from .toolkit import hijack_cmds
 from .toolkit import get_platform
 from .toolkit import Platform
+from .toolkit import CopyStrategy
+from .toolkit import archive_suffixes
+from .cache import format_size
+from .wheelhouse import Wheelhouse
 from .constants import AUTO_KEY
 from .constants import DEFAULT_WORKSPACE
+from .constants import DOWNLOAD_SEGMENTS
+from .constants import WORKSPACE_META_DIR
 from .constants import PRESETS_SETTINGS_DIR
 from .constants import DEFAULT_SETTINGS_PATH
+from .tracing import traced_run
 
 
 configs: Dict[str, Type["IConfig"]] = {}
@@ -51,8 +60,12 @@ class PyRequirement:
     -------
     __str__()
         Returns a string representation of the requirement.
-    install_with(pip_cmd: List[str], executable: str)
+    pip_args() -> Optional[List[str]]
+        Returns the arguments of `pip install` for the requirement, or `None` if it uses a custom
+        installation command, in which case it cannot be merged with other requirements.
+    install_with(pip_cmd: List[str], executable: str, wheelhouse: Optional[Wheelhouse] = None, offline: bool = False)
         Installs the requirement using the specified pip command and executable.
+        If `wheelhouse` is provided, the requirement will be installed from it.
 
     Examples
     --------
@@ -94,23 +107,37 @@ class PyRequirement:
 
     __repr__ = __str__
 
+    @property
+    def pip_args(self) -> Optional[List[str]]:
+        if self.install_command is not None:
+            return None
+        if self.git_url is not None:
+            return [self.git_url]
+        if self.package_name is not None:
+            return [self.package_name]
+        if self.requirement_file is not None:
+            return ["-r", self.requirement_file]
+        raise ValueError(f"invalid requirement occurred: {self}")
+
     def install_with(
         self,
         *,
         pip_cmd: List[str],
         executable: str,
+        wheelhouse: Optional[Wheelhouse] = None,
+        offline: bool = False,
     ) -> None:
         rule(f"Installing {self}")
-        if self.install_command is not None:
+        pip_args = self.pip_args
+        if pip_args is not None and wheelhouse is not None:
+            wheelhouse.install(pip_cmd, pip_args, offline=offline)
+            return
+        if pip_args is not None:
+            result = traced_run(pip_cmd + ["install"] + pip_args)
+        elif self.install_command is not None:
             cmds = self.install_command.split()
             cmds = hijack_cmds(cmds, pip_cmd, executable)
-            result = subprocess.run(cmds)
-        elif self.git_url is not None:
-            result = subprocess.run(pip_cmd + ["install", self.git_url])
-        elif self.package_name is not None:
-            result = subprocess.run(pip_cmd + ["install", self.package_name])
-        elif self.requirement_file is not None:
-            result = subprocess.run(pip_cmd + ["install", "-r", self.requirement_file])
+            result = traced_run(cmds)
         else:
             raise ValueError(f"invalid requirement occurred: {self}")
         if result.returncode != 0:
@@ -128,7 +155,7 @@ def get_py_requirement(req: Union[str, Dict[str, Any], PyRequirement]) -> PyRequ
 @dataclass
 class Asset:
     """
-    Represents an asset with optional attributes such as name, URL, path, Git URL, ignores, flatten, and destination.
+    Represents an asset with optional attributes such as name, URL, path, Git URL, ignores, flatten, destination, sha256, sync, copy strategy and git options.
 
     Attributes
     ----------
@@ -146,11 +173,37 @@ class Asset:
         Indicates whether to flatten the asset directory structure during copying.
     dst : Optional[str], default=None
         The destination path of the asset.
+    sha256 : Optional[str], default=None
+        The expected sha256 of the file downloaded from `url`, used to verify the download.
+    sync : bool, default=True
+        Indicates whether to incrementally sync the asset to the workspace. A manifest of the
+        synced files is kept under the workspace, so only new or changed files are copied and
+        removed files are deleted when packaging again. Files fetched from `url` / `git_url`
+        are compared by their sha256, since they are re-fetched every time.
+    copy_strategy : str, default="auto"
+        The strategy used to copy files into the workspace, one of `hardlink`, `reflink`,
+        `copy_file_range`, `sendfile`, `copy` and `auto`. Unsupported strategies fall back
+        to the next one in this order, and `auto` starts from `reflink`. Notice that a
+        hardlinked file shares its content with the original file, so modifying it in place
+        will modify the original file as well.
+    git_ref : Optional[str], default=None
+        The branch, tag or commit of `git_url` to check out.
+    git_depth : Optional[int], default=None
+        If provided, `git_url` will be shallow cloned with this depth (e.g., `1`).
+    git_filter : Optional[str], default=None
+        If provided, `git_url` will be partially cloned with this filter (e.g., `blob:none`).
+    git_mirror : bool, default=False
+        Indicates whether to keep a local bare mirror of `git_url` in the user-level cache,
+        so later clones only need to fetch the new commits.
 
     Methods
     -------
-    fetch(workspace: Path) -> None
+    fetch(workspace: Path, *, stream: bool = False, offline: bool = False) -> None
         Fetches the asset and copies it to the specified workspace.
+        If `stream` is `True`, archives will be extracted while they are being downloaded.
+        If `offline` is `True`, the asset should be fetched from the local caches.
+    get_dst() -> str
+        Returns the destination path of the asset (relative to the workspace) before fetching it.
 
     Examples
     --------
@@ -179,36 +232,99 @@ class Asset:
     ignores: Optional[List[str]] = None
     flatten: bool = False
     dst: Optional[str] = None
-
-    def fetch(self, workspace: Path) -> None:
+    sha256: Optional[str] = None
+    sync: bool = True
+    copy_strategy: str = CopyStrategy.AUTO.value
+    git_ref: Optional[str] = None
+    git_depth: Optional[int] = None
+    git_filter: Optional[str] = None
+    git_mirror: bool = False
+
+    def _get_git_name(self) -> str:
+        if self.git_url is None:
+            raise ValueError(f"invalid asset occurred: {self}")
+        return self.name or self.git_url.split("/")[-1]
+
+    def get_dst(self) -> str:
+        if self.dst is not None:
+            return str(Path(self.dst))
+        if self.path is not None:
+            return Path(self.path).name
+        if self.url is not None:
+            name, suffix = parse_download_name(self.url, self.name)
+            return name if suffix in archive_suffixes else f"{name}{suffix}"
+        return self._get_git_name()
+
+    def fetch(
+        self,
+        workspace: Path,
+        *,
+        stream: bool = False,
+        offline: bool = False,
+    ) -> None:
         ignores = self.ignores
         with tempfile.TemporaryDirectory() as tmp_dir:
             tmp_root = Path(tmp_dir)
             if self.path is not None:
                 src = Path(self.path)
             elif self.url is not None:
-                src = download(self.url, root=tmp_root, name=self.name)
+                src = download(
+                    self.url,
+                    tmp_root,
+                    self.name,
+                    stream=stream,
+                    sha256=self.sha256,
+                    offline=offline,
+                )
             elif self.git_url is not None:
-                git_name = self.name or self.git_url.split("/")[-1]
-                src = git_clone(self.git_url, tmp_root / git_name)
+                git_name = self._get_git_name()
+                src = git_clone(
+                    self.git_url,
+                    tmp_root / git_name,
+                    ref=self.git_ref,
+                    depth=self.git_depth,
+                    filter_spec=self.git_filter,
+                    mirror=self.git_mirror,
+                    offline=offline,
+                )
                 if ignores is None:
                     ignores = [".git"]
             else:
                 raise ValueError(f"invalid asset occurred: {self}")
             dst = workspace / Path(self.dst or src.name)
             self.dst = str(dst.relative_to(workspace))
-            if src.is_file():
-                cp(src, dst)
+            if self.sync:
+                manifest_root = workspace / WORKSPACE_META_DIR / "assets"
+                manifest_name = hashlib.sha256(self.dst.encode()).hexdigest()
+                manifest_path = manifest_root / f"{manifest_name}.json"
+                stats = sync(
+                    src,
+                    dst,
+                    manifest_path,
+                    ignores=ignores if self.flatten else None,
+                    use_hash=self.path is None,
+                    strategy=self.copy_strategy,
+                )
+                strategies = stats["strategies"]
+                log(
+                    f"synced '{self.dst}': {stats['copied']} copied "
+                    f"({format_size(stats['copied_bytes'])}), {stats['skipped']} "
+                    f"unchanged, {stats['deleted']} deleted"
+                )
+            elif src.is_file() or not self.flatten:
+                strategies = cp(src, dst, self.copy_strategy)
             else:
-                if not self.flatten:
-                    cp(src, dst)
-                else:
-                    if ignores is None:
-                        ignores = []
-                    for p in src.iterdir():
-                        if p.name in ignores:
-                            continue
-                        cp(p, dst / p.name)
+                if ignores is None:
+                    ignores = []
+                strategies = {}
+                for p in src.iterdir():
+                    if p.name in ignores:
+                        continue
+                    for k, v in cp(p, dst / p.name, self.copy_strategy).items():
+                        strategies[k] = strategies.get(k, 0) + v
+            if strategies:
+                used = ", ".join(f"{k} x {v}" for k, v in strategies.items())
+                log(f"copied '{self.dst}' with {used}")
 
 
 TAsset = Union[str, Dict[str, Any], Asset]
@@ -251,6 +367,111 @@ class IConfig(ISerializableDataClass):
         The Python launch entry. It should relative to the `workspace`.
     external_blocks : Optional[List[str]], default=None
         The list of external blocks.
+    stream_extract : bool, default=False
+        Indicates whether to extract archives while they are being downloaded, which saves
+        disk space and overlaps network with disk work, but the archives will not be cached.
+    max_download_connections : int, default=DOWNLOAD_SEGMENTS
+        The maximum number of concurrent connections used by the `download` block. They
+        are shared among the files being downloaded, so fewer files will be downloaded with
+        more segments each.
+    fetch_assets_workers : int, default=4
+        The maximum number of assets to be fetched concurrently by the `fetch_assets` block.
+    batch_python_requirements : bool, default=False
+        Indicates whether to install consecutive `python_requirements` (except those with
+        `install_command`) with a single `pip install`, so they are resolved together.
+    use_wheelhouse : bool, default=False
+        Indicates whether to download / build the `python_requirements` (except those with
+        `install_command`) into a user-level wheelhouse, and install them from it.
+    offline : bool, default=False
+        Indicates whether to package without network access. Downloads and `url` assets
+        are then restored from the download cache, `git_url` assets are cloned from their
+        git mirrors, and `python_requirements` are installed from the wheelhouse, so the
+        same config should have been packaged online (with `use_wheelhouse`) before.
+    lock_file : Optional[str], default=None
+        If provided, the whole dependency closure of `python_requirements` will be resolved
+        into this lock file (relative paths are relative to the config file) with exact
+        versions, artifact urls and hashes, and later runs will install from it directly
+        (`--no-deps --require-hashes`), without resolving again. The lock is regenerated
+        when `python_requirements` change, or by `cfport lock --upgrade`. It is not used
+        in `offline` mode, and it requires `pip>=22.2`. If not provided, `cfport.lock` next
+        to the config file will be used if it exists (e.g., generated by `cfport lock`, or
+        by `cfport package --lock`).
+    upgrade_lock : bool, default=False
+        Indicates whether to regenerate the `lock_file` even if it is up to date.
+    installer : str, default="pip"
+        The backend used to install the wheels resolved by the wheelhouse (or the
+        `lock_file`). `parallel` unzips the wheels into the environment concurrently, which
+        is much faster than `pip` for large wheel sets.
+    build_source_wheels : bool, default=False
+        Indicates whether to build source requirements (`git_url` requirements, and the git
+        packages / sdists in the `lock_file`) into wheels before installing them. Every
+        source is built by its own `pip wheel` process (at most one per CPU at a time), and
+        the wheels are cached by the git commits / sha256 of the sources, so unchanged
+        sources will never be built again. Not used with the wheelhouse, which caches the
+        built wheels by itself.
+    skip_satisfied_requirements : bool, default=True
+        Indicates whether to skip the `python_requirements` (or the locked packages) which
+        are already satisfied in the workspace, together with their dependencies. Only
+        `package_name` and simple `requirement_file` entries can be checked, others are
+        always installed.
+    parallel_blocks : bool, default=True
+        Indicates whether to build the blocks concurrently, as soon as the blocks they
+        depend on are built (e.g. fetching assets will not wait for the downloads). Blocks
+        which do not declare their dependencies (e.g. `external_blocks`) are built after all
+        the blocks before them.
+    install_after_assets : bool, default=True
+        Indicates whether to install the `python_requirements` after the `assets` are
+        fetched, since they may refer to the fetched files (e.g. `-e ./repo`). Set it to
+        `False` to install them concurrently with the fetching (if `parallel_blocks` is
+        `True`), when they do not depend on the `assets`.
+    slim_site_packages : bool, default=False
+        Indicates whether to slim the `site-packages` after the requirements are installed,
+        which removes the files that are not needed at runtime (see `slim_strip`), and
+        replaces duplicate files with hardlinks. A size report (by distribution) will be
+        written to `.cfport/slim_report.json` in the workspace.
+    slim_strip : Optional[List[str]], default=None
+        The patterns of the files / directories to remove when slimming, defaults to
+        `default_slim_strip` (tests, `__pycache__`, `.pyi` stubs, headers and docs).
+        Patterns without `/` match the names at any depth (e.g. `*.pyi`), patterns with a
+        trailing `/` only match directories (e.g. `tests/`), and other patterns match the
+        paths relative to `site-packages` (e.g. `torch/include`).
+    slim_keep : Optional[List[str]], default=None
+        The patterns (same as `slim_strip`) of the files / directories to keep, even if they
+        match `slim_strip`. `.dist-info` directories are always kept.
+    slim_hardlink_duplicates : bool, default=True
+        Indicates whether to replace the files with identical contents by hardlinks when
+        slimming.
+    precompile_bytecode : bool, default=False
+        Indicates whether to compile the `site-packages` and the tree of
+        `python_launch_entry` into bytecode (`__pycache__`) when packaging, so it will not
+        be compiled at the first launch (or at every launch, if the project is read-only).
+    precompile_optimize : List[int], default=[0]
+        The optimization levels to compile the bytecode with. Levels `1` / `2` are only
+        used if the launch scripts run python with `-O` / `-OO`.
+    precompile_invalidation_mode : str, default="unchecked-hash"
+        How python checks whether the bytecode is stale, see `py_compile.PycInvalidationMode`.
+        `unchecked-hash` never checks the sources, which is the fastest and is not affected
+        by the modification times (which are reset in the exported archives), but the
+        bytecode should be compiled again (by packaging again) if the sources are modified.
+    precompile_interpreter : str, default="bundled"
+        The python used to compile the bytecode, which determines the magic number (and the
+        cache tag) of the bytecode. `bundled` uses the python in the workspace, so the
+        bytecode always matches it. `host` uses the python which runs `cfport`, which is
+        useful when the bundled python cannot run on this machine (e.g. packaging for
+        Windows on Linux), as long as the versions of the two are the same.
+    precompile_workers : int, default=0
+        The number of processes used to compile the bytecode, `0` means the number of CPUs.
+    pack_pure_python : bool, default=False
+        Indicates whether to move the pure-python distributions out of `site-packages`
+        into a zip archive (with their bytecode, see `precompile_invalidation_mode` and
+        `precompile_interpreter`) on `sys.path`, which saves a lot of file system calls
+        when importing them (e.g. on USB drives and network shares). Distributions which
+        are not safe to be imported from a zip archive (e.g. the ones which contain native
+        libraries or access files by `__file__`) are left as is. A report of the packed
+        (and skipped) distributions will be written to `.cfport/pack_report.json` in the
+        workspace.
+    pack_exclude : Optional[List[str]], default=None
+        The names of the distributions which should never be packed.
 
     Methods
     -------
@@ -269,6 +490,30 @@ class IConfig(ISerializableDataClass):
     python_launch_cli: Optional[str] = None
     python_launch_entry: Optional[str] = None
     external_blocks: Optional[List[str]] = None
+    stream_extract: bool = False
+    max_download_connections: int = DOWNLOAD_SEGMENTS
+    fetch_assets_workers: int = 4
+    batch_python_requirements: bool = False
+    use_wheelhouse: bool = False
+    offline: bool = False
+    lock_file: Optional[str] = None
+    upgrade_lock: bool = False
+    installer: str = "pip"
+    build_source_wheels: bool = False
+    skip_satisfied_requirements: bool = True
+    parallel_blocks: bool = True
+    install_after_assets: bool = True
+    slim_site_packages: bool = False
+    slim_strip: Optional[List[str]] = None
+    slim_keep: Optional[List[str]] = None
+    slim_hardlink_duplicates: bool = True
+    precompile_bytecode: bool = False
+    precompile_optimize: List[int] = field(default_factory=lambda: [0])
+    precompile_invalidation_mode: str = "unchecked-hash"
+    precompile_interpreter: str = "bundled"
+    precompile_workers: int = 0
+    pack_pure_python: bool = False
+    pack_exclude: Optional[List[str]] = None
     version: Optional[str] = None
 
     @classmethod
@@ -1,3 +1,5 @@
+import os
+
 from pathlib import Path
 
 
@@ -9,3 +11,35 @@ DEFAULT_SETTINGS_PATH = SETTINGS_DIR / "defaults.json"
 AUTO_KEY = "auto"
 DEFAULT_WORKSPACE = "cfport_package"
 DEFAULT_CONFIG_FILE = "cfport.json"
+DEFAULT_LOCK_FILE = "cfport.lock"
+WORKSPACE_META_DIR = ".cfport"
+
+CACHE_DIR = Path(os.environ.get("CFPORT_CACHE_DIR", Path.home() / ".cache" / "cfport"))
+DOWNLOAD_CACHE_DIR = CACHE_DIR / "downloads"
+DOWNLOAD_CACHE_MAX_SIZE = os.environ.get("CFPORT_CACHE_MAX_SIZE", "20G")
+GIT_CACHE_DIR = CACHE_DIR / "git"
+WHEELHOUSE_DIR = CACHE_DIR / "wheels"
+
+DOWNLOAD_SEGMENTS = 8
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_VERIFY_RETRIES = 1
+DOWNLOAD_TIMEOUT = 60
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+DOWNLOAD_PIECE_SIZE = 8 << 20
+DOWNLOAD_HASH_BUFFER_SIZE = 64 << 20
+
+EXTRACT_WORKERS = os.cpu_count() or 1
+EXTRACT_PARALLEL_MIN_MEMBERS = 512
+EXTRACT_PARALLEL_MIN_SIZE = 256 << 20
+EXTRACT_MEMBER_OVERHEAD = 64 << 10
+
+GIT_LFS_CONCURRENT_TRANSFERS = 8
+
+SOURCE_BUILD_WORKERS = os.cpu_count() or 1
+
+ARCHIVE_WORKERS = os.cpu_count() or 1
+ARCHIVE_CHUNK_SIZE = 1 << 20
+ARCHIVE_DEFLATE_LEVEL = 6
+ARCHIVE_ZSTD_LEVEL = 3
+# 1980-01-01, which is the earliest time that zip supports
+ARCHIVE_MTIME = int(os.environ.get("SOURCE_DATE_EPOCH", 315532800))
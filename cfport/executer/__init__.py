@@ -1,10 +1,35 @@
+import json
+import hashlib
+
+from typing import Any
+from typing import Dict
+from typing import Set
 from typing import List
 from typing import Type
+from typing import Union
+from typing import Optional
+from pathlib import Path
+from cftool.misc import shallow_copy_dict
+from cftool.console import log
+from cftool.pipeline import check_requirement
 from cftool.pipeline import IPipeline
+from concurrent.futures import wait
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import FIRST_COMPLETED
 
 from .schema import *
+from .checkpoint import *
 from .blocks import *
 from ..config import IConfig
+from ..tracing import trace
+from ..tracing import traced_submit
+from ..tracing import start_tracing
+from ..tracing import stop_tracing
+from ..constants import WORKSPACE_META_DIR
+
+
+FORCE_ALL = "all"
 
 
 def get_default_blocks() -> List[IExecuteBlock]:
@@ -13,17 +38,57 @@ def get_default_blocks() -> List[IExecuteBlock]:
         FetchAssetsBlock(),
         DownloadBlock(),
         PreparePythonBlock(),
+        LockPythonRequirementsBlock(),
         InstallPythonRequirementsBlock(),
+        SlimSitePackagesBlock(),
         HijackHFSpaceAppBlock(),
+        PackPurePythonBlock(),
+        PrecompileBytecodeBlock(),
         SetPythonLaunchScriptBlock(),
     ]
 
 
+def get_identifier(block: Union[str, Type[IExecuteBlock]]) -> str:
+    return block if isinstance(block, str) else block.__identifier__
+
+
+def get_digest(data: Any) -> str:
+    import cfport
+
+    info = dict(version=cfport.__version__, data=data)
+    return hashlib.sha256(json.dumps(info, sort_keys=True).encode()).hexdigest()
+
+
 @IPipeline.register("executer")
 class Executer(IPipeline):
+    """
+    Executes the blocks as a DAG: each block is built as soon as the blocks it depends on
+    (see `IExecuteBlock.get_dependencies`) are built, and independent blocks are built
+    concurrently if `parallel_blocks` is `True`.
+
+    Blocks which declare their `fingerprint`s will be skipped if they are up to date with
+    the `records` of the last successful run (which are persisted in `executer.json`),
+    unless they are listed in `force`.
+
+    The progress of every run is recorded in a `Checkpoint` (`.cfport/checkpoint.json` in
+    the workspace), so a failed run can be resumed with `resume=True`: the blocks which
+    were built are skipped, and long blocks skip the units which were done.
+
+    Every run is traced (see `cfport.tracing`), and the Chrome trace-event file & the
+    summary are written to `.cfport/trace` in the workspace.
+    """
+
     config: IConfig
     blocks: List[IExecuteBlock]
 
+    def __init__(self) -> None:
+        super().__init__()
+        self.force: List[str] = []
+        self.records: Dict[str, Dict[str, Any]] = {}
+        self.digests: Dict[str, str] = {}
+        self.trace_summary: Optional[Dict[str, Any]] = None
+        self.checkpoint: Optional[Checkpoint] = None
+
     @classmethod
     def init(cls: Type["Executer"], config: IConfig) -> "Executer":
         self = cls()
@@ -38,15 +103,194 @@ class Executer(IPipeline):
     def block_base(self) -> Type[IExecuteBlock]:
         return IExecuteBlock
 
-    def launch(self) -> None:
-        blocks = get_default_blocks()
-        if self.config.external_blocks is not None:
+    def to_info(self) -> Dict[str, Any]:
+        info = super().to_info()
+        info["fingerprints"] = self.records
+        return info
+
+    def from_info(self, info: Dict[str, Any]) -> None:
+        self.records = info.get("fingerprints", {})
+        super().from_info(info)
+
+    def load_records(self) -> None:
+        """Loads the `records` from the `executer.json` in the workspace, if any."""
+
+        path = Path(self.config.workspace) / "executer.json"
+        if not path.is_file():
+            return
+        try:
+            with path.open("r") as f:
+                self.records = json.load(f)["info"].get("fingerprints", {})
+        except (ValueError, KeyError):
+            log(f"'{path}' is broken, all blocks will be built")
+
+    def is_up_to_date(self, block: IExecuteBlock) -> bool:
+        name = block.__identifier__
+        fingerprint = block.fingerprint(self.config)
+        if fingerprint is None:
+            return False
+        digest = self.digests[name] = get_digest(fingerprint)
+        if self.is_forced(name):
+            log(f"'{name}' is forced to be built")
+            return False
+        record = self.records.get(name)
+        if record is None or record["fingerprint"] != digest:
+            return False
+        block.restore(self.config, record["state"])
+        if get_digest(block.artifacts(self.config)) != record["artifacts"]:
+            log(f"artifacts of '{name}' are modified, it will be built again")
+            return False
+        log(f"'{name}' is up to date, skipping")
+        return True
+
+    def is_forced(self, name: str) -> bool:
+        return name in self.force or FORCE_ALL in self.force
+
+    def get_record(self, block: IExecuteBlock) -> Dict[str, Any]:
+        return dict(
+            fingerprint=self.digests[block.__identifier__],
+            artifacts=get_digest(block.artifacts(self.config)),
+            state=block.get_state(),
+        )
+
+    def build_block(self, block: IExecuteBlock) -> None:
+        name = block.__identifier__
+        with trace(name, "block") as span:
+            self.before_block_build(block)
+            skipped = self.is_up_to_date(block)
+            if not skipped:
+                digest = self.digests.get(name)
+                block.checkpoint = self.checkpoint
+                if self.checkpoint is not None:
+                    reset = self.is_forced(name)
+                    self.checkpoint.start_units(name, digest, reset=reset)
+                block.build(self.config)
+                if self.checkpoint is not None and digest is not None:
+                    self.checkpoint.record_block(name, self.get_record(block))
+            self.after_block_build(block)
+            if span is not None:
+                span.args["skipped"] = skipped
+
+    def build(self, *blocks: IExecuteBlock) -> None:
+        previous: Dict[str, IExecuteBlock] = self.block_mappings
+        mappings: Dict[str, IExecuteBlock] = {}
+        dependencies: Dict[str, List[str]] = {}
+        ancestors: Dict[str, Set[str]] = {}
+        for block in blocks:
+            name = block.__identifier__
+            check_requirement(block, {**previous, **mappings})
+            declared = block.get_dependencies(self.config)
+            if declared is None:
+                names = list(mappings)
+            else:
+                names = [get_identifier(d) for d in declared]
+                # dependencies which are not used (or come later) are ignored
+                names = [d for d in names if d in mappings]
+            dependencies[name] = names
+            ancestors[name] = set(names).union(*(ancestors[d] for d in names))
+            block.previous = shallow_copy_dict(previous)
+            for k, b in mappings.items():
+                if k in ancestors[name]:
+                    block.previous[k] = b
+            mappings[name] = block
+        if not self.config.parallel_blocks or len(blocks) <= 1:
+            for block in blocks:
+                self.build_block(block)
+        else:
+            self.build_parallel(list(blocks), dependencies)
+        self.blocks.extend(blocks)
+
+    def build_parallel(
+        self,
+        blocks: List[IExecuteBlock],
+        dependencies: Dict[str, List[str]],
+    ) -> None:
+        built: Set[str] = set()
+        pending = list(blocks)
+        running: Dict[Future, IExecuteBlock] = {}
+        with ThreadPoolExecutor(len(blocks)) as executor:
+            while pending or running:
+                # ready blocks are submitted in order, so the schedule is deterministic
+                for block in list(pending):
+                    if all(d in built for d in dependencies[block.__identifier__]):
+                        pending.remove(block)
+                        future = traced_submit(executor, self.build_block, block)
+                        running[future] = block
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in sorted(finished, key=lambda f: blocks.index(running[f])):
+                    block = running.pop(future)
+                    future.result()
+                    built.add(block.__identifier__)
+
+    def update_records(self) -> None:
+        """Records the fingerprints, artifacts and states of the blocks after a run."""
+
+        records = {}
+        for block in self.blocks:
+            name = block.__identifier__
+            if name in self.digests:
+                records[name] = self.get_record(block)
+        self.records = records
+
+    def launch(
+        self,
+        blocks: Optional[List[IExecuteBlock]] = None,
+        *,
+        force: Optional[List[str]] = None,
+        resume: bool = False,
+        use_external_blocks: bool = True,
+        use_checkpoint: bool = True,
+    ) -> None:
+        """
+        Builds the `blocks` (defaults to `get_default_blocks()`), and the `external_blocks`
+        of the config if `use_external_blocks` is `True`.
+
+        If `use_checkpoint` is `False`, the checkpoint of the workspace is neither used nor
+        touched, so partial runs (e.g. `cfport lock`) do not discard the progress of a
+        failed `cfport package`.
+        """
+
+        if blocks is None:
+            blocks = get_default_blocks()
+        if use_external_blocks and self.config.external_blocks is not None:
             blocks.extend(
                 [
                     IExecuteBlock.make(external_block, {})
                     for external_block in self.config.external_blocks
                 ]
             )
-        self.build(*blocks)
-        for block in self.blocks:
-            block.cleanup(self.config)
+        self.force = list(force or [])
+        names = {block.__identifier__ for block in blocks} | {FORCE_ALL}
+        for name in self.force:
+            if name not in names:
+                raise ValueError(f"cannot force unknown block '{name}'")
+        if resume and not use_checkpoint:
+            raise ValueError("`resume` requires `use_checkpoint` to be `True`")
+        meta_dir = Path(self.config.workspace) / WORKSPACE_META_DIR
+        checkpoint = None
+        if use_checkpoint:
+            checkpoint = Checkpoint(meta_dir / "checkpoint.json")
+        self.checkpoint = checkpoint
+        tracer = start_tracing()
+        try:
+            self.load_records()
+            if checkpoint is not None:
+                if not resume:
+                    checkpoint.clear()
+                elif checkpoint.load():
+                    log(f"resuming from '{checkpoint.path}'")
+                    self.records.update(checkpoint.blocks)
+                else:
+                    log("nothing to resume, all blocks will be checked")
+            self.build(*blocks)
+            for block in self.blocks:
+                with trace(f"cleanup {block.__identifier__}", "cleanup"):
+                    block.cleanup(self.config)
+            self.update_records()
+            if checkpoint is not None:
+                checkpoint.clear()
+        finally:
+            stop_tracing()
+            trace_dir = meta_dir / "trace"
+            self.trace_summary = tracer.dump(trace_dir)
+            log(f"trace of this run is dumped to '{trace_dir}'")
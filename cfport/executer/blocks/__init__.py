@@ -3,5 +3,8 @@ from .assets import *
 from .hijack import *
 from .download import *
 from .install import *
+from .slim import *
+from .pack import *
+from .precompile import *
 from .launch import *
 from .third_party import *
@@ -1,24 +1,135 @@
+import time
+
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Tuple
+from typing import Optional
 from pathlib import Path
+from dataclasses import asdict
 from cftool.console import log
 from cftool.console import rule
+from concurrent.futures import as_completed
+from concurrent.futures import ThreadPoolExecutor
 
+from .prepare import PrepareBlock
 from ..schema import IExecuteBlock
+from ..schema import TDependencies
 from ...config import get_asset
+from ...config import Asset
 from ...config import IConfig
+from ...toolkit import resolve_git_commit
+from ...toolkit import get_stat_signature
+from ...tracing import trace
+from ...tracing import traced_submit
+from ...constants import WORKSPACE_META_DIR
+
+
+def _overlaps(a: Path, b: Path) -> bool:
+    return a == b or a in b.parents or b in a.parents
+
+
+def _group_by_dsts(assets: List[Asset]) -> List[List[Asset]]:
+    """
+    Groups the assets whose destinations overlap (e.g. an asset which is fetched to the
+    workspace itself overlaps with all the others), the assets in a group are fetched
+    sequentially (in the config order), while the groups are fetched concurrently.
+    """
+
+    groups: List[Tuple[List[Path], List[Asset]]] = []
+    for asset in assets:
+        dst = Path(asset.get_dst())
+        merged_dsts, merged_assets = [dst], []
+        remaining = []
+        for dsts, group in groups:
+            if any(_overlaps(dst, existing) for existing in dsts):
+                merged_dsts.extend(dsts)
+                merged_assets.extend(group)
+            else:
+                remaining.append((dsts, group))
+        # keep the config order inside the merged group
+        merged_assets.sort(key=assets.index)
+        merged_assets.append(asset)
+        groups = remaining + [(merged_dsts, merged_assets)]
+    return [group for _, group in groups]
 
 
 @IExecuteBlock.register("fetch_assets")
 class FetchAssetsBlock(IExecuteBlock):
+    def get_dependencies(self, config: IConfig) -> TDependencies:
+        return [PrepareBlock]
+
+    def fingerprint(self, config: IConfig) -> Optional[Any]:
+        infos = []
+        for asset in [get_asset(asset) for asset in config.assets or []]:
+            info: Dict[str, Any] = dict(asset=asdict(asset))
+            if asset.path is not None:
+                info["source"] = get_stat_signature(Path(asset.path))
+            elif asset.git_url is not None and not config.offline:
+                try:
+                    info["commit"] = resolve_git_commit(asset.git_url, asset.git_ref)
+                except RuntimeError:
+                    return None
+            infos.append(info)
+        return infos
+
+    def artifacts(self, config: IConfig) -> Any:
+        workspace = Path(config.workspace)
+        # assets might be fetched to the workspace itself, whose meta files always change
+        ignores = [WORKSPACE_META_DIR, "executer.json"]
+        return {
+            dst: get_stat_signature(workspace / dst, ignores)
+            for dst in [get_asset(asset).get_dst() for asset in config.assets or []]
+        }
+
     def build(self, config: IConfig) -> None:
-        assets = config.assets
-        if assets is None:
+        if config.assets is None:
+            return
+        assets = [get_asset(asset) for asset in config.assets]
+        if not assets:
             return
+        groups = _group_by_dsts(assets)
         workspace = Path(config.workspace)
         rule("Fetch Assets")
-        for asset in assets:
-            asset = get_asset(asset)
+
+        def _fetch(asset: Asset) -> float:
+            t = time.time()
+            dst = asset.get_dst()
+            if self.is_unit_done(dst):
+                # the workspace might be (partly) cleaned after the failed run
+                if (workspace / dst).exists():
+                    log(f"'{dst}' is fetched in the resumed run, skipping")
+                    return time.time() - t
+                log(f"'{dst}' is missing, it will be fetched again")
             log(f"fetching {asset}")
-            asset.fetch(workspace)
+            with trace(f"fetch {dst}", "asset", asset=str(asset)):
+                asset.fetch(
+                    workspace,
+                    stream=config.stream_extract,
+                    offline=config.offline,
+                )
+            self.mark_unit_done(dst)
+            return time.time() - t
+
+        def _fetch_group(group: List[Asset]) -> List[Tuple[Asset, float]]:
+            results = []
+            for asset in group:
+                try:
+                    results.append((asset, _fetch(asset)))
+                except Exception as err:
+                    raise RuntimeError(f"failed to fetch {asset}") from err
+            return results
+
+        num_workers = max(1, min(len(groups), config.fetch_assets_workers))
+        with ThreadPoolExecutor(num_workers) as executor:
+            futures = [traced_submit(executor, _fetch_group, g) for g in groups]
+            done = 0
+            for future in as_completed(futures):
+                for asset, elapsed in future.result():
+                    done += 1
+                    progress = f"{done}/{len(assets)}"
+                    dst = asset.get_dst()
+                    log(f"fetched '{dst}' in {elapsed:.2f}s ({progress} assets done)")
 
 
 __all__ = [
@@ -1,12 +1,20 @@
 import json
 
+from typing import Any
 from typing import Dict
+from typing import List
+from typing import Tuple
+from typing import Optional
 from pathlib import Path
 from cftool.console import log
+from concurrent.futures import ThreadPoolExecutor
 
 from ..schema import IExecuteBlock
+from ..schema import TDependencies
 from ...config import IConfig
 from ...toolkit import download
+from ...toolkit import get_stat_signature
+from ...tracing import traced_submit
 from ...constants import SETTINGS_DIR
 
 
@@ -14,10 +22,13 @@ from ...constants import SETTINGS_DIR
 class DownloadBlock(IExecuteBlock):
     downloaded: Dict[str, Dict[str, Path]]
 
-    def build(self, config: IConfig) -> None:
+    def get_dependencies(self, config: IConfig) -> TDependencies:
+        # `PrepareBlock` depends on this module, so it is referred by its identifier
+        return ["prepare"]
+
+    def get_jobs(self, config: IConfig) -> List[Tuple[str, str, Dict[str, Any]]]:
         platform = config.platform
-        workspace = Path(config.workspace)
-        self.downloaded = {}
+        jobs: List[Tuple[str, str, Dict[str, Any]]] = []
         for k, vs in config.downloads.items():
             if isinstance(vs, str):
                 vs = [vs]
@@ -25,18 +36,83 @@ class DownloadBlock(IExecuteBlock):
             k_urls_path = k_urls_root / f"{k}.json"
             with k_urls_path.open("r") as f:
                 k_urls = json.load(f)
-            k_workspace = workspace / k
-            k_downloaded = self.downloaded.setdefault(k, {})
             for v in vs:
-                v_url = k_urls.get(v)
-                if isinstance(v_url, dict):
-                    v_url = v_url.get(platform.value)
-                if v_url is None:
+                v_info = k_urls.get(v)
+                # platform specific urls
+                if isinstance(v_info, dict) and "url" not in v_info:
+                    v_info = v_info.get(platform.value)
+                if v_info is None:
                     log(f"\[{platform}] cannot find url for '{v}' in '{k}', skippping")
                     continue
-                k_workspace.mkdir(exist_ok=True)
-                kv_downloaded = download(v_url, k_workspace)
-                k_downloaded[v] = kv_downloaded
+                if isinstance(v_info, str):
+                    v_info = dict(url=v_info)
+                jobs.append((k, v, v_info))
+        return jobs
+
+    def fingerprint(self, config: IConfig) -> Optional[Any]:
+        return dict(platform=config.platform.value, jobs=self.get_jobs(config))
+
+    def artifacts(self, config: IConfig) -> Any:
+        return {
+            k: {v: get_stat_signature(path) for v, path in paths.items()}
+            for k, paths in self.downloaded.items()
+        }
+
+    def get_state(self) -> Dict[str, Any]:
+        return {
+            k: {v: str(path) for v, path in paths.items()}
+            for k, paths in self.downloaded.items()
+        }
+
+    def restore(self, config: IConfig, state: Dict[str, Any]) -> None:
+        self.downloaded = {
+            k: {v: Path(path) for v, path in paths.items()}
+            for k, paths in state.items()
+        }
+
+    def build(self, config: IConfig) -> None:
+        workspace = Path(config.workspace)
+        self.downloaded = {k: {} for k in config.downloads}
+        jobs = self.get_jobs(config)
+        for k, _, _ in jobs:
+            (workspace / k).mkdir(exist_ok=True)
+        if not jobs:
+            return
+        # the connections are shared among the downloads, so the total number of
+        # connections is bounded by `max_download_connections`
+        max_connections = max(1, config.max_download_connections)
+        num_workers = min(len(jobs), max_connections)
+        segments = max(1, max_connections // num_workers)
+
+        def _download(k: str, v: str, v_info: Dict[str, Any]) -> Path:
+            unit = f"{k}/{v}"
+            if self.is_unit_done(unit):
+                done_path = Path(self.get_unit_result(unit))
+                # the workspace might be (partly) cleaned after the failed run
+                if done_path.exists():
+                    log(f"'{unit}' is downloaded in the resumed run, skipping")
+                    return done_path
+                log(f"'{done_path}' is missing, '{unit}' will be downloaded again")
+            path = download(
+                v_info["url"],
+                workspace / k,
+                segments=segments,
+                stream=config.stream_extract,
+                sha256=v_info.get("sha256"),
+                size=v_info.get("size"),
+                offline=config.offline,
+            )
+            self.mark_unit_done(unit, str(path))
+            return path
+
+        with ThreadPoolExecutor(num_workers) as executor:
+            futures = [
+                traced_submit(executor, _download, k, v, v_info)
+                for k, v, v_info in jobs
+            ]
+            # collect in submission order, so `downloaded` is deterministic
+            for (k, v, _), future in zip(jobs, futures):
+                self.downloaded[k][v] = future.result()
 
 
 __all__ = [
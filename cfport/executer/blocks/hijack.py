@@ -1,9 +1,15 @@
+from typing import Any
+from typing import Optional
 from pathlib import Path
 from cftool.console import log
 
+from .assets import FetchAssetsBlock
 from ..schema import IExecuteBlock
+from ..schema import TDependencies
 from ...config import IConfig
 from ...toolkit import hijack_file
+from ...toolkit import get_stat_signature
+from ...tracing import trace
 
 
 import_spaces = "import spaces"
@@ -20,13 +26,26 @@ def hijack_hf_space_app(line: str) -> str:
 
 @IExecuteBlock.register("hijack_hf_space_app")
 class HijackHFSpaceAppBlock(IExecuteBlock):
+    def get_dependencies(self, config: IConfig) -> TDependencies:
+        return [FetchAssetsBlock]
+
+    def fingerprint(self, config: IConfig) -> Optional[Any]:
+        return dict(file=config.huggingface_space_app_file)
+
+    def artifacts(self, config: IConfig) -> Any:
+        hf_space_app = config.huggingface_space_app_file
+        if hf_space_app is None:
+            return None
+        return get_stat_signature(Path(config.workspace) / hf_space_app)
+
     def build(self, config: IConfig) -> None:
         hf_space_app = config.huggingface_space_app_file
         if hf_space_app is None:
             return
         workspace = Path(config.workspace)
         log(f"hijacking huggingface space app file '{hf_space_app}'")
-        hijack_file(workspace / hf_space_app, hijack_hf_space_app)
+        with trace(f"hijack {hf_space_app}", "hijack"):
+            hijack_file(workspace / hf_space_app, hijack_hf_space_app)
 
 
 __all__ = [
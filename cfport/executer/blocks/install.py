@@ -1,21 +1,290 @@
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from pathlib import Path
+from dataclasses import asdict
+from cftool.console import log
+from cftool.console import rule
+
+from .assets import FetchAssetsBlock
+from .prepare import PreparePythonBlock
 from .prepare import IWithPreparePythonBlock
 from ..schema import IExecuteBlock
+from ..schema import TDependencies
 from ...config import IConfig
 from ...config import PyRequirement
+from ...cache import hash_file
+from ...lock import install_lock
+from ...lock import lock_requirements
+from ...toolkit import check_requirements
+from ...toolkit import resolve_git_commit
+from ...toolkit import parse_git_requirement
+from ...installer import IInstaller
+from ...tracing import traced_run
+from ...wheelhouse import Wheelhouse
+
+
+def _install_batch(
+    requirements: List[PyRequirement],
+    *,
+    pip_cmd: List[str],
+    executable: str,
+    wheelhouse: Optional[Wheelhouse],
+    offline: bool,
+) -> None:
+    if len(requirements) == 1:
+        requirements[0].install_with(
+            pip_cmd=pip_cmd,
+            executable=executable,
+            wheelhouse=wheelhouse,
+            offline=offline,
+        )
+        return
+    rule(f"Installing {len(requirements)} requirements in one batch")
+    args = []
+    for r in requirements:
+        args.extend(r.pip_args or [])
+    if wheelhouse is not None:
+        wheelhouse.install(pip_cmd, args, offline=offline)
+    elif traced_run(pip_cmd + ["install"] + args).returncode != 0:
+        raise RuntimeError(f"failed to install requirements: {requirements}")
+
+
+def _get_requirements(config: IConfig) -> List[PyRequirement]:
+    return [
+        PyRequirement(package_name=r) if isinstance(r, str) else r
+        for r in config.python_requirements
+    ]
+
+
+def _get_specs(r: PyRequirement) -> Optional[List[str]]:
+    # returns `None` if `r` cannot be checked without installing it
+    if r.pip_args is None or r.git_url is not None:
+        return None
+    if r.package_name is not None:
+        return [r.package_name]
+    if r.requirement_file is None:
+        return None
+    path = Path(r.requirement_file)
+    if not path.is_file():
+        return None
+    specs = []
+    with path.open("r") as f:
+        for line in f:
+            line = line.split(" #")[0].strip()
+            if not line or line.startswith("#"):
+                continue
+            # options (e.g. `-r`, `--index-url`) are not supported
+            if line.startswith("-"):
+                return None
+            specs.append(line)
+    return specs
+
+
+def _get_dependencies(config: IConfig) -> TDependencies:
+    # requirements may refer to the fetched assets (e.g. `-e ./repo`), which cannot be
+    # reliably detected, so they wait for the assets unless it is opted out
+    if config.assets and config.install_after_assets:
+        return [PreparePythonBlock, FetchAssetsBlock]
+    return [PreparePythonBlock]
+
+
+@IExecuteBlock.register("lock_python_requirements")
+class LockPythonRequirementsBlock(IWithPreparePythonBlock):
+    # the lock of this run, `None` if the requirements are not locked
+    lock: Optional[Dict[str, Any]] = None
+
+    def get_dependencies(self, config: IConfig) -> TDependencies:
+        return _get_dependencies(config)
+
+    def build(self, config: IConfig) -> None:
+        # the lock is not used in offline mode
+        if config.lock_file is None or config.offline:
+            return
+        self.lock = lock_requirements(
+            Path(config.lock_file),
+            _get_requirements(config),
+            pip_cmd=self.prepare_python.pip_cmd,
+            upgrade=config.upgrade_lock,
+            batch=config.batch_python_requirements,
+        )
 
 
 @IExecuteBlock.register("install_python_requirements")
 class InstallPythonRequirementsBlock(IWithPreparePythonBlock):
+    def get_dependencies(self, config: IConfig) -> TDependencies:
+        # the lock file should be written before the fingerprint is computed
+        dependencies = _get_dependencies(config) or []
+        return [LockPythonRequirementsBlock] + dependencies
+
+    def fingerprint(self, config: IConfig) -> Optional[Any]:
+        if config.upgrade_lock:
+            return None
+        requirements = _get_requirements(config)
+        paths = [r.requirement_file for r in requirements] + [config.lock_file]
+        files = {p: hash_file(Path(p)) for p in paths if p and Path(p).is_file()}
+        commits = {}
+        if not config.offline:
+            for r in requirements:
+                if r.git_url is not None and r.install_command is None:
+                    _, url, ref, _ = parse_git_requirement(r.git_url)
+                    try:
+                        commits[r.git_url] = resolve_git_commit(url, ref)
+                    except RuntimeError:
+                        return None
+        return dict(
+            requirements=[asdict(r) for r in requirements],
+            files=files,
+            commits=commits,
+            batch_python_requirements=config.batch_python_requirements,
+            use_wheelhouse=config.use_wheelhouse,
+            installer=config.installer,
+            build_source_wheels=config.build_source_wheels,
+            python=self.prepare_python.get_state(),
+        )
+
+    def artifacts(self, config: IConfig) -> Any:
+        site_packages = self.prepare_python.site_packages
+        if site_packages is None:
+            return None
+        return sorted(
+            path.name
+            for pattern in ["*.dist-info", "*.egg-info", "*.egg-link"]
+            for path in site_packages.glob(pattern)
+        )
+
     def build(self, config: IConfig) -> None:
-        pip_cmd = self.prepare_python.pip_cmd
+        if config.lock_file is not None:
+            if config.offline:
+                log(
+                    "`lock_file` is not used in offline mode, using the wheelhouse instead"
+                )
+            elif self.install_from_lock(config, Path(config.lock_file)):
+                return
+        use_wheelhouse = config.use_wheelhouse or config.offline
+        installer = IInstaller.make(config.installer, {})
+        kw: Dict[str, Any] = dict(
+            pip_cmd=self.prepare_python.pip_cmd,
+            executable=str(self.prepare_python.executable),
+            wheelhouse=Wheelhouse(installer=installer) if use_wheelhouse else None,
+            offline=config.offline,
+        )
+        requirements = _get_requirements(config)
+        num_requirements = len(requirements)
+        if config.skip_satisfied_requirements:
+            requirements = self.filter_satisfied(requirements)
+        if config.build_source_wheels and not use_wheelhouse:
+            requirements = self.build_sources(requirements)
+        batch: List[PyRequirement] = []
+        for r in requirements:
+            if not config.batch_python_requirements:
+                self.install_unit([r], **kw)
+            elif r.pip_args is not None:
+                batch.append(r)
+            else:
+                # custom commands cannot be merged, so they split the batches and
+                # run in order
+                if batch:
+                    self.install_unit(batch, **kw)
+                    batch = []
+                self.install_unit([r], **kw)
+        if batch:
+            self.install_unit(batch, **kw)
+        num_skipped = num_requirements - len(requirements)
+        log(
+            f"{len(requirements)} requirements installed, "
+            f"{num_skipped} skipped (already satisfied)"
+        )
+
+    def install_unit(self, requirements: List[PyRequirement], **kw: Any) -> None:
+        """Installs `requirements` (a batch, or a single one) as a checkpointed unit."""
+
+        unit = " ".join(map(str, requirements))
+        if self.is_unit_done(unit):
+            log(f"'{unit}' is installed in the resumed run, skipping")
+            return
+        if len(requirements) == 1:
+            requirements[0].install_with(**kw)
+        else:
+            _install_batch(requirements, **kw)
+        self.mark_unit_done(unit)
+
+    def filter_satisfied(
+        self,
+        requirements: List[PyRequirement],
+    ) -> List[PyRequirement]:
+        all_specs = [_get_specs(r) for r in requirements]
+        flat_specs = []
+        for specs in all_specs:
+            flat_specs.extend(specs or [])
         executable = str(self.prepare_python.executable)
-        requirements = config.python_requirements
+        checked = dict(zip(flat_specs, check_requirements(executable, flat_specs)))
+        filtered = []
+        for r, specs in zip(requirements, all_specs):
+            if specs is not None and all(checked[spec] for spec in specs):
+                log(f"'{r}' is already satisfied, skipping")
+            else:
+                filtered.append(r)
+        return filtered
+
+    def build_sources(self, requirements: List[PyRequirement]) -> List[PyRequirement]:
+        pinned: Dict[str, str] = {}
+        for r in requirements:
+            if r.git_url is None or r.install_command is not None:
+                continue
+            prefix, url, ref, fragment = parse_git_requirement(r.git_url)
+            # pins the requirement to the commit, so it can be used as the source hash
+            source = f"git+{url}@{resolve_git_commit(url, ref)}"
+            if fragment:
+                source = f"{source}#{fragment}"
+            pinned[r.git_url] = source
+        if not pinned:
+            return requirements
+        rule("Building source requirements")
+        pip_cmd = self.prepare_python.pip_cmd
+        wheels = Wheelhouse().build_sources(pip_cmd, {s: s for s in pinned.values()})
+        built = []
         for r in requirements:
-            if isinstance(r, str):
-                r = PyRequirement(package_name=r)
-            r.install_with(pip_cmd=pip_cmd, executable=executable)
+            if r.git_url not in pinned:
+                built.append(r)
+                continue
+            prefix = parse_git_requirement(r.git_url)[0]
+            wheel = wheels[pinned[r.git_url]]
+            package_name = f"{prefix}{wheel.as_uri()}" if prefix else str(wheel)
+            built.append(PyRequirement(package_name=package_name))
+        return built
+
+    def install_from_lock(self, config: IConfig, lock_path: Path) -> bool:
+        """Returns `False` if the requirements cannot be locked (e.g. `pip` is too old)."""
+
+        pip_cmd = self.prepare_python.pip_cmd
+        installer = IInstaller.make(config.installer, {})
+        lock = lock_requirements(
+            lock_path,
+            _get_requirements(config),
+            pip_cmd=pip_cmd,
+            upgrade=config.upgrade_lock,
+            batch=config.batch_python_requirements,
+        )
+        if lock is None:
+            return False
+        install_lock(
+            lock,
+            pip_cmd=pip_cmd,
+            executable=str(self.prepare_python.executable),
+            skip_satisfied=config.skip_satisfied_requirements,
+            # `pip` can install the locked packages directly
+            installer=None if config.installer == "pip" else installer,
+            build_sources=config.build_source_wheels,
+            wheelhouse=(
+                Wheelhouse(installer=installer) if config.use_wheelhouse else None
+            ),
+        )
+        return True
 
 
 __all__ = [
+    "LockPythonRequirementsBlock",
     "InstallPythonRequirementsBlock",
 ]
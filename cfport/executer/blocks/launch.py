@@ -1,14 +1,62 @@
+import shlex
+
+from typing import Any
+from typing import List
+from typing import Optional
 from pathlib import Path
 from cftool.console import rule
 
+from .prepare import PreparePythonBlock
 from .prepare import IWithPreparePythonBlock
 from ..schema import IExecuteBlock
+from ..schema import TDependencies
 from ...config import IConfig
 from ...toolkit import Platform
+from ...toolkit import get_stat_signature
 
 
 @IExecuteBlock.register("set_python_launch_script")
 class SetPythonLaunchScriptBlock(IWithPreparePythonBlock):
+    def get_dependencies(self, config: IConfig) -> TDependencies:
+        return [PreparePythonBlock]
+
+    def fingerprint(self, config: IConfig) -> Optional[Any]:
+        return dict(
+            platform=config.platform.value,
+            python_launch_cli=config.python_launch_cli,
+            python_launch_entry=config.python_launch_entry,
+            python=self.prepare_python.get_state(),
+        )
+
+    def artifacts(self, config: IConfig) -> Any:
+        workspace = Path(config.workspace)
+        return [get_stat_signature(workspace / f) for f in ["run.bat", "run.sh"]]
+
+    def get_cli_path(self, config: IConfig, cli: str) -> Path:
+        """Returns the path (relative to the workspace) of `cli` in site-packages."""
+
+        workspace = Path(config.workspace)
+        if config.platform == Platform.WINDOWS:
+            path = self.prepare_python.root / "Lib" / "site-packages" / cli
+        else:
+            lib_dir = self.prepare_python.root / "lib"
+            py_dir = next(lib_dir.iterdir())
+            path = py_dir / "site-packages" / cli
+        return path.relative_to(workspace)
+
+    def get_launch_args(self, config: IConfig) -> Optional[List[str]]:
+        """
+        Returns the arguments which the launch script passes to python (relative to the
+        workspace), or `None` if there is nothing to launch.
+        """
+
+        if config.python_launch_cli is not None:
+            return [str(self.get_cli_path(config, config.python_launch_cli))]
+        if config.python_launch_entry is not None:
+            posix = config.platform != Platform.WINDOWS
+            return shlex.split(config.python_launch_entry, posix=posix)
+        return None
+
     def build(self, config: IConfig) -> None:
         platform = config.platform
         workspace = Path(config.workspace)
@@ -24,8 +72,7 @@ class SetPythonLaunchScriptBlock(IWithPreparePythonBlock):
             common_header = f"@echo off\ntitle Run\n"
             if launch_cli is not None:
                 rule(f"Generating '{bat_file}' to run '{launch_cli}' in site-packages")
-                cli = self.prepare_python.root / "Lib" / "site-packages" / launch_cli
-                cli = str(cli.relative_to(workspace))  # type: ignore
+                cli = str(self.get_cli_path(config, launch_cli))
                 with bat_path.open("w") as f:
                     f.write(
                         f"""{common_header}
@@ -50,10 +97,7 @@ which python
 """
             if launch_cli is not None:
                 rule(f"Generating '{sh_file}' to run '{launch_cli}' in site-packages")
-                lib_dir = self.prepare_python.root / "lib"
-                py_dir = next(lib_dir.iterdir())
-                cli = py_dir / "site-packages" / launch_cli
-                cli = str(cli.relative_to(workspace))  # type: ignore
+                cli = str(self.get_cli_path(config, launch_cli))
                 with sh_path.open("w") as f:
                     f.write(
                         f"""{common_header}
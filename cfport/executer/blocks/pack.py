@@ -0,0 +1,345 @@
+import os
+import re
+import csv
+import json
+import time
+import zipfile
+
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Tuple
+from typing import Optional
+from pathlib import Path
+from cftool.console import log
+from cftool.console import rule
+
+from .slim import SlimSitePackagesBlock
+from .install import InstallPythonRequirementsBlock
+from .prepare import IWithPreparePythonBlock
+from .precompile import precompile_invalidation_modes
+from ..schema import IExecuteBlock
+from ..schema import TDependencies
+from ...cache import format_size
+from ...config import IConfig
+from ...toolkit import Platform
+from ...toolkit import get_stat_signature
+from ...tracing import traced_run
+from ...constants import WORKSPACE_META_DIR
+
+
+PACKED_SITE_PACKAGES = "site-packages.zip"
+PACK_MARKER = "# added by cfport (pack_pure_python)"
+
+extension_suffixes = (".so", ".pyd", ".dll", ".dylib")
+source_suffixes = (".py", ".pyi", "py.typed")
+file_pattern = re.compile(rb"\b__file__\b")
+listdir_pattern = re.compile(rb"\b(listdir|scandir|iterdir|walk|glob)\(")
+
+# runs in the bundled python, so the bytecode matches its magic number
+_pack_script = """
+import os
+import sys
+import json
+import time
+import zipfile
+import tempfile
+import py_compile
+
+info = json.loads(sys.stdin.read())
+mode = info["invalidation_mode"].upper().replace("-", "_")
+mode = py_compile.PycInvalidationMode[mode]
+dirs = set()
+with tempfile.TemporaryDirectory() as tmp_dir:
+    cfile = os.path.join(tmp_dir, "module.pyc")
+    with zipfile.ZipFile(info["path"], "w") as zf:
+        for arcname, path in info["files"]:
+            parts = arcname.split("/")[:-1]
+            for i in range(1, len(parts) + 1):
+                dirname = "/".join(parts[:i]) + "/"
+                if dirname not in dirs:
+                    dirs.add(dirname)
+                    zf.writestr(zipfile.ZipInfo(dirname), b"")
+            st = os.stat(path)
+            # `zipimport` compares the time of the source with the timestamp-based pyc,
+            # otherwise a fixed time is used so the archive is reproducible
+            date_time = (1980, 1, 1, 0, 0, 0)
+            if mode == py_compile.PycInvalidationMode.TIMESTAMP:
+                date_time = time.localtime(max(st.st_mtime, 315532800))[:6]
+            zinfo = zipfile.ZipInfo(arcname, date_time)
+            zinfo.external_attr = (st.st_mode & 0xFFFF) << 16
+            with open(path, "rb") as f:
+                zf.writestr(zinfo, f.read())
+            if not arcname.endswith(".py"):
+                continue
+            try:
+                dfile = info["prefix"] + arcname
+                kw = dict(doraise=True, invalidation_mode=mode)
+                py_compile.compile(path, cfile, dfile, **kw)
+            except py_compile.PyCompileError as err:
+                print(err.msg)
+                continue
+            zinfo = zipfile.ZipInfo(arcname[:-3] + ".pyc", date_time)
+            zinfo.external_attr = 0o644 << 16
+            with open(cfile, "rb") as f:
+                zf.writestr(zinfo, f.read())
+"""
+
+
+def _read_dist(site_packages: Path, dist_info: Path) -> Tuple[List[str], Optional[str]]:
+    """
+    Returns the files (relative to `site-packages`) of the distribution, and the reason
+    why it cannot be imported from a zip archive (`None` if it can).
+    """
+
+    wheel = dist_info / "WHEEL"
+    record = dist_info / "RECORD"
+    if not wheel.is_file() or not record.is_file():
+        return [], "not installed from a wheel"
+    files = []
+    with record.open("r", newline="") as f:
+        for row in csv.reader(f):
+            if not row:
+                continue
+            rel = os.path.normpath(row[0]).replace(os.sep, "/")
+            # files outside `site-packages` (e.g. scripts) are left as is
+            if rel.startswith("../") or rel.startswith(f"{dist_info.name}/"):
+                continue
+            if "__pycache__" not in rel.split("/") and (site_packages / rel).is_file():
+                files.append(rel)
+    if "root-is-purelib: true" not in wheel.read_text().lower():
+        return files, "not a purelib wheel"
+    if (dist_info / "not-zip-safe").is_file():
+        return files, "marked as not zip safe"
+    has_data = False
+    for rel in files:
+        if rel.endswith(extension_suffixes) or ".so." in rel:
+            return files, f"contains native libraries ('{rel}')"
+        if not rel.endswith(source_suffixes):
+            if "/" not in rel:
+                return files, f"contains top-level data files ('{rel}')"
+            has_data = True
+    # `__file__` is harmless if there are no files to access by it, unless it is used
+    # to list the modules (e.g. plugins) of a package
+    for rel in files:
+        if rel.endswith(".py"):
+            source = (site_packages / rel).read_bytes()
+            if file_pattern.search(source):
+                if has_data or listdir_pattern.search(source):
+                    return files, f"accesses files by `__file__` ('{rel}')"
+    return files, None
+
+
+def _remove_files(site_packages: Path, rels: List[str]) -> None:
+    """Removes the files (and their bytecode), and the folders which become empty."""
+
+    parents = set()
+    for rel in rels:
+        path = site_packages / rel
+        path.unlink()
+        if path.suffix == ".py":
+            for pyc in path.parent.glob(f"__pycache__/{path.stem}.*.pyc"):
+                pyc.unlink()
+        parents.add(path.parent)
+    # deepest first
+    for parent in sorted(parents, key=lambda p: len(p.parts), reverse=True):
+        while parent != site_packages:
+            try:
+                pycache = parent / "__pycache__"
+                if pycache.is_dir():
+                    pycache.rmdir()
+                parent.rmdir()
+            except OSError:
+                break
+            parent = parent.parent
+
+
+@IExecuteBlock.register("pack_pure_python")
+class PackPurePythonBlock(IWithPreparePythonBlock):
+    """
+    Moves the pure-python distributions out of `site-packages` into a zip archive (with
+    their bytecode) which is on `sys.path` (if `pack_pure_python` is `True`), so importing
+    them does not `stat` / `open` the file system for every module, which is slow on USB
+    drives and network shares.
+
+    Only the distributions which are safe to be imported from a zip archive are packed:
+    the ones which are installed from purelib wheels, and which neither contain native
+    libraries nor access files by `__file__`. Their `.dist-info` folders are left in the
+    `site-packages`, so `importlib.metadata` (and `pip`) still works.
+    """
+
+    def get_dependencies(self, config: IConfig) -> TDependencies:
+        return [InstallPythonRequirementsBlock, SlimSitePackagesBlock]
+
+    @property
+    def zip_path(self) -> Path:
+        return self.prepare_python.root / PACKED_SITE_PACKAGES
+
+    def get_report_path(self, config: IConfig) -> Path:
+        return Path(config.workspace) / WORKSPACE_META_DIR / "pack_report.json"
+
+    def fingerprint(self, config: IConfig) -> Optional[Any]:
+        if not config.pack_pure_python:
+            return dict(pack_pure_python=False)
+        install_block = self.try_get_previous(InstallPythonRequirementsBlock)
+        installed = None
+        if install_block is not None:
+            installed = install_block.artifacts(config)
+        return dict(
+            exclude=config.pack_exclude,
+            invalidation_mode=config.precompile_invalidation_mode,
+            interpreter=config.precompile_interpreter,
+            python_launch_cli=config.python_launch_cli,
+            installed=installed,
+            python=self.prepare_python.get_state(),
+        )
+
+    def artifacts(self, config: IConfig) -> Any:
+        if not config.pack_pure_python:
+            return None
+        return get_stat_signature(self.zip_path)
+
+    def build(self, config: IConfig) -> None:
+        site_packages = self.prepare_python.site_packages
+        if site_packages is None:
+            return
+        report_path = self.get_report_path(config)
+        if not config.pack_pure_python:
+            if report_path.is_file():
+                rule("Unpacking pure-python distributions")
+                self.unpack(config, site_packages, report_path)
+            return
+        invalidation_mode = config.precompile_invalidation_mode
+        if invalidation_mode not in precompile_invalidation_modes:
+            raise ValueError(
+                f"unknown `precompile_invalidation_mode` '{invalidation_mode}', "
+                f"should be one of {precompile_invalidation_modes}"
+            )
+        rule("Packing pure-python distributions")
+        if report_path.is_file():
+            self.unpack(config, site_packages, report_path)
+        exclude = {name.lower().replace("-", "_") for name in config.pack_exclude or []}
+        dist_infos = sorted(site_packages.glob("*.dist-info"))
+        dists: Dict[str, List[str]] = {}
+        skipped: Dict[str, str] = {}
+        owners: Dict[str, List[str]] = {}
+        for dist_info in dist_infos:
+            name = dist_info.name.split("-")[0].lower().replace("-", "_")
+            files, reason = _read_dist(site_packages, dist_info)
+            if name in exclude:
+                reason = "excluded"
+            elif config.python_launch_cli in files:
+                reason = "owns `python_launch_cli`"
+            for top in {rel.split("/")[0] for rel in files}:
+                owners.setdefault(top, []).append(dist_info.name)
+            if reason is not None:
+                skipped[dist_info.name] = reason
+            else:
+                dists[dist_info.name] = files
+        # namespace packages which are shared with other distributions are not packed
+        for top, names in owners.items():
+            if len(names) > 1:
+                for name in names:
+                    if name in dists:
+                        dists.pop(name)
+                        skipped[name] = f"shares '{top}' with other distributions"
+        rels = sorted(rel for files in dists.values() for rel in files)
+        size = 0
+        if not rels:
+            log("no distribution can be packed")
+        else:
+            info = dict(
+                path=str(self.zip_path.absolute()),
+                files=[(rel, str((site_packages / rel).absolute())) for rel in rels],
+                prefix=f"{PACKED_SITE_PACKAGES}/",
+                invalidation_mode=invalidation_mode,
+            )
+            cmd = [self.prepare_python.get_compile_executable(config), "-c"]
+            cmd.append(_pack_script)
+            traced_run(cmd, input=json.dumps(info), text=True, check=True)
+            _remove_files(site_packages, rels)
+            self.set_sys_path(config, True)
+            size = self.zip_path.stat().st_size
+        report_path.parent.mkdir(parents=True, exist_ok=True)
+        with report_path.open("w") as f:
+            json.dump(dict(bytes=size, packed=dists, skipped=skipped), f, indent=2)
+        log(
+            f"{len(dists)} distributions ({len(rels)} files) are packed into "
+            f"'{self.zip_path}' ({format_size(size)}), "
+            f"{len(skipped)} distributions are skipped"
+        )
+        for name, reason in skipped.items():
+            log(f"  {name}: {reason}")
+
+    def unpack(self, config: IConfig, site_packages: Path, report_path: Path) -> None:
+        """Moves the packed distributions back to `site-packages`."""
+
+        with report_path.open("r") as f:
+            packed: Dict[str, List[str]] = json.load(f)["packed"]
+        if packed:
+            if not self.zip_path.is_file():
+                raise RuntimeError(
+                    f"'{self.zip_path}' is missing, so the packed distributions cannot "
+                    "be restored, please package again with `--force all`"
+                )
+            with zipfile.ZipFile(self.zip_path) as zf:
+                for dist_info, rels in packed.items():
+                    # distributions which are uninstalled (e.g. upgraded) are dropped
+                    if not (site_packages / dist_info).is_dir():
+                        continue
+                    for rel in rels:
+                        zinfo = zf.getinfo(rel)
+                        path = site_packages / rel
+                        path.parent.mkdir(parents=True, exist_ok=True)
+                        with path.open("wb") as f:
+                            f.write(zf.read(zinfo))
+                        path.chmod((zinfo.external_attr >> 16) & 0o777 or 0o644)
+                        mtime = time.mktime(zinfo.date_time + (0, 0, -1))
+                        os.utime(path, (mtime, mtime))
+            log(f"{len(packed)} packed distributions are restored")
+        if self.zip_path.is_file():
+            self.zip_path.unlink()
+        self.set_sys_path(config, False)
+        report_path.unlink()
+
+    def set_sys_path(self, config: IConfig, packed: bool) -> None:
+        """
+        Adds the zip archive to `sys.path` (or removes it): in the `._pth` file of the
+        Windows embeddable, or in the activation script (as `PYTHONPATH`) of the venv.
+        """
+
+        root = self.prepare_python.root
+        if config.platform == Platform.WINDOWS:
+            for path in root.glob("*._pth"):
+                with path.open("r") as f:
+                    lines = [line for line in f if line.strip() != PACKED_SITE_PACKAGES]
+                if packed:
+                    index = len(lines)
+                    for i, line in enumerate(lines):
+                        if "site-packages" in line:
+                            index = i + 1
+                    lines.insert(index, f"{PACKED_SITE_PACKAGES}\n")
+                with path.open("w") as f:
+                    f.writelines(lines)
+            return
+        path = root / "bin" / "activate"
+        if not path.is_file():
+            return
+        with path.open("r") as f:
+            lines = [line for line in f if PACK_MARKER not in line]
+        if packed:
+            index = len(lines)
+            for i, line in enumerate(lines):
+                if line.startswith("export VIRTUAL_ENV"):
+                    index = i + 1
+            zip_path = f"$VIRTUAL_ENV/{PACKED_SITE_PACKAGES}"
+            line = f'export PYTHONPATH="{zip_path}${{PYTHONPATH:+:$PYTHONPATH}}"'
+            lines.insert(index, f"{line}  {PACK_MARKER}\n")
+        with path.open("w") as f:
+            f.writelines(lines)
+
+
+__all__ = [
+    "PACKED_SITE_PACKAGES",
+    "PackPurePythonBlock",
+]
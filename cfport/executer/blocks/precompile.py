@@ -0,0 +1,180 @@
+import os
+import json
+import hashlib
+
+from typing import Any
+from typing import List
+from typing import Optional
+from pathlib import Path
+from cftool.console import log
+from cftool.console import rule
+
+from .slim import SlimSitePackagesBlock
+from .hijack import HijackHFSpaceAppBlock
+from .assets import FetchAssetsBlock
+from .install import InstallPythonRequirementsBlock
+from .prepare import IWithPreparePythonBlock
+from ..schema import IExecuteBlock
+from ..schema import TDependencies
+from ...config import IConfig
+from ...tracing import traced_run
+from ...constants import WORKSPACE_META_DIR
+
+
+precompile_invalidation_modes = ["timestamp", "checked-hash", "unchecked-hash"]
+
+# the exit code of `_compile_script` when some files cannot be compiled
+COMPILE_FAILED_EXIT_CODE = 3
+# `compileall` is called directly instead of through its CLI, whose `-s` / `-o` options
+# are not available before python 3.9
+_compile_script = f"""
+import os
+import sys
+import json
+import compileall
+import py_compile
+
+args = json.loads(sys.argv[1])
+mode = py_compile.PycInvalidationMode[args["invalidation_mode"]]
+success = True
+for level in args["optimize"]:
+    for target, ddir in args["targets"]:
+        kw = dict(ddir=ddir, quiet=1, invalidation_mode=mode, optimize=level)
+        if os.path.isdir(target):
+            kw["workers"] = args["workers"]
+            success = compileall.compile_dir(target, **kw) and success
+        else:
+            success = compileall.compile_file(target, **kw) and success
+sys.exit(0 if success else {COMPILE_FAILED_EXIT_CODE})
+"""
+
+
+def _get_signature(targets: List[Path], suffix: str) -> str:
+    """Returns a signature of the `suffix` files under `targets` (sizes & mtimes)."""
+
+    sha256 = hashlib.sha256()
+    for target in targets:
+        paths = [str(target)] if target.is_file() else []
+        for dirpath, dirnames, filenames in os.walk(target):
+            dirnames.sort()
+            paths.extend(os.path.join(dirpath, name) for name in sorted(filenames))
+        for path in paths:
+            if not path.endswith(suffix):
+                continue
+            stat = os.stat(path)
+            sha256.update(f"{path}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+    return sha256.hexdigest()
+
+
+@IExecuteBlock.register("precompile")
+class PrecompileBytecodeBlock(IWithPreparePythonBlock):
+    """
+    Compiles the `site-packages` and the tree of `python_launch_entry` into `__pycache__`
+    (if `precompile_bytecode` is `True`), with a pool of `compileall` processes, so the
+    first launch (or every launch, if the portable project is read-only) does not have to.
+    """
+
+    def get_dependencies(self, config: IConfig) -> TDependencies:
+        return [
+            InstallPythonRequirementsBlock,
+            SlimSitePackagesBlock,
+            FetchAssetsBlock,
+            HijackHFSpaceAppBlock,
+            # packed distributions are compiled into the zip archive
+            "pack_pure_python",
+        ]
+
+    def get_targets(self, config: IConfig) -> List[Path]:
+        workspace = Path(config.workspace).absolute()
+        site_packages = self.prepare_python.site_packages
+        targets = [] if site_packages is None else [site_packages.absolute()]
+        if config.python_launch_entry is not None:
+            entry = config.python_launch_entry.split()[0]
+            entry_dir = (workspace / entry).parent
+            if entry_dir != workspace:
+                targets.append(entry_dir)
+            else:
+                # the python itself lives in the workspace, so only the top-level files
+                # and the folders which do not contain it are compiled
+                root = self.prepare_python.root.absolute()
+                for path in sorted(workspace.iterdir()):
+                    if path.name == WORKSPACE_META_DIR:
+                        continue
+                    if path.is_dir() and path not in [root, *root.parents]:
+                        targets.append(path)
+                    elif path.is_file() and path.suffix == ".py":
+                        targets.append(path)
+        return [target for target in targets if target.exists()]
+
+    def fingerprint(self, config: IConfig) -> Optional[Any]:
+        if not config.precompile_bytecode:
+            return dict(precompile_bytecode=False)
+        install_block = self.try_get_previous(InstallPythonRequirementsBlock)
+        installed = None
+        if install_block is not None:
+            installed = install_block.artifacts(config)
+        targets = self.get_targets(config)
+        return dict(
+            optimize=config.precompile_optimize,
+            invalidation_mode=config.precompile_invalidation_mode,
+            interpreter=config.precompile_interpreter,
+            installed=installed,
+            sources=_get_signature(targets, ".py"),
+            python=self.prepare_python.get_state(),
+        )
+
+    def artifacts(self, config: IConfig) -> Any:
+        if not config.precompile_bytecode:
+            return None
+        return _get_signature(self.get_targets(config), ".pyc")
+
+    def build(self, config: IConfig) -> None:
+        if not config.precompile_bytecode:
+            return
+        invalidation_mode = config.precompile_invalidation_mode
+        if invalidation_mode not in precompile_invalidation_modes:
+            raise ValueError(
+                f"unknown `precompile_invalidation_mode` '{invalidation_mode}', "
+                f"should be one of {precompile_invalidation_modes}"
+            )
+        invalid_levels = set(config.precompile_optimize) - {0, 1, 2}
+        if invalid_levels:
+            msg = f"optimization levels should be 0, 1 or 2, but got {invalid_levels}"
+            raise ValueError(msg)
+        targets = self.get_targets(config)
+        if not targets:
+            return
+        rule("Precompiling bytecode")
+        executable = self.prepare_python.get_compile_executable(config)
+        workspace = Path(config.workspace).absolute()
+        # the paths in the bytecode are made relative to the workspace, so the bytecode
+        # does not depend on where the project is packaged
+        compile_targets = []
+        for target in targets:
+            ddir = None
+            folder = target if target.is_dir() else target.parent
+            if folder == workspace or workspace in folder.parents:
+                ddir = folder.relative_to(workspace).as_posix()
+                ddir = "" if ddir == "." else ddir
+            compile_targets.append((str(target), ddir))
+        args = dict(
+            targets=compile_targets,
+            optimize=sorted(set(config.precompile_optimize)),
+            invalidation_mode=invalidation_mode.replace("-", "_").upper(),
+            workers=config.precompile_workers,
+        )
+        cmd = [executable, "-c", _compile_script, json.dumps(args)]
+        returncode = traced_run(cmd).returncode
+        if returncode == COMPILE_FAILED_EXIT_CODE:
+            log(
+                "some files cannot be compiled (see above), they will be compiled when "
+                "they are imported (if they are valid at all)"
+            )
+        elif returncode != 0:
+            raise RuntimeError(f"failed to precompile bytecode with '{executable}'")
+
+
+__all__ = [
+    "precompile_invalidation_modes",
+    "PrecompileBytecodeBlock",
+]
@@ -1,7 +1,10 @@
 import re
+import sys
 import shutil
 import subprocess
 
+from typing import Any
+from typing import Dict
 from typing import List
 from typing import Optional
 from pathlib import Path
@@ -11,13 +14,23 @@ from cftool.console import rule
 
 from .download import DownloadBlock
 from ..schema import IExecuteBlock
+from ..schema import TDependencies
 from ...config import IConfig
 from ...toolkit import download
 from ...toolkit import Platform
+from ...toolkit import get_platform
+from ...toolkit import get_stat_signature
+from ...tracing import traced_run
+
+
+precompile_interpreters = ["bundled", "host"]
 
 
 @IExecuteBlock.register("prepare")
 class PrepareBlock(IExecuteBlock):
+    def get_dependencies(self, config: IConfig) -> TDependencies:
+        return []
+
     def build(self, config: IConfig) -> None:
         workspace = Path(config.workspace)
         while True:
@@ -52,10 +65,81 @@ class PreparePythonBlock(IExecuteBlock):
     def download_block(self) -> Optional[DownloadBlock]:
         return self.try_get_previous(DownloadBlock)
 
+    def get_dependencies(self, config: IConfig) -> TDependencies:
+        # venvs do not need the downloads
+        if config.platform != Platform.WINDOWS:
+            return [PrepareBlock]
+        return [PrepareBlock, DownloadBlock]
+
     @property
     def pip_cmd(self) -> List[str]:
         return [str(self.executable), "-m", "pip"]
 
+    def fingerprint(self, config: IConfig) -> Optional[Any]:
+        download_block = self.download_block
+        downloaded = None if download_block is None else download_block.get_state()
+        return dict(
+            platform=config.platform.value,
+            python_embeddables=(downloaded or {}).get("python_embeddables"),
+            python3=shutil.which("python3"),
+        )
+
+    @property
+    def site_packages(self) -> Optional[Path]:
+        for site_packages in [
+            self.root / "Lib" / "site-packages",
+            *sorted(self.root.glob("lib/python*/site-packages")),
+        ]:
+            if site_packages.is_dir():
+                return site_packages
+        return None
+
+    def get_compile_executable(self, config: IConfig) -> str:
+        """
+        Returns the python to compile the bytecode with (see `precompile_interpreter`),
+        which determines the magic number (and the cache tag) of the bytecode.
+        """
+
+        interpreter = config.precompile_interpreter
+        if interpreter not in precompile_interpreters:
+            raise ValueError(
+                f"unknown `precompile_interpreter` '{interpreter}', "
+                f"should be one of {precompile_interpreters}"
+            )
+        if interpreter == "host":
+            log(
+                f"compiling with the host python ({sys.implementation.cache_tag}), "
+                "whose version should match the bundled one"
+            )
+            return sys.executable
+        platform = config.platform
+        if platform != get_platform():
+            raise RuntimeError(
+                f"the bundled python for {platform.value} cannot run on this machine, "
+                "set `precompile_interpreter` to 'host' (with the same python version) "
+                "to compile with the current python instead"
+            )
+        return str(self.executable.absolute())
+
+    def artifacts(self, config: IConfig) -> Any:
+        if not hasattr(self, "executable"):
+            return None
+        # `pip` is checked as well, since it is installed separately
+        site_packages = self.site_packages
+        pip_dir = None if site_packages is None else site_packages / "pip"
+        pip_signature = None if pip_dir is None else get_stat_signature(pip_dir)
+        return [get_stat_signature(self.executable), pip_signature]
+
+    def get_state(self) -> Dict[str, Any]:
+        if not hasattr(self, "executable"):
+            return {}
+        return dict(root=str(self.root), executable=str(self.executable))
+
+    def restore(self, config: IConfig, state: Dict[str, Any]) -> None:
+        if state:
+            self.root = Path(state["root"])
+            self.executable = Path(state["executable"])
+
     def build(self, config: IConfig) -> None:
         platform = config.platform
         workspace = Path(config.workspace)
@@ -98,7 +182,7 @@ class PreparePythonBlock(IExecuteBlock):
             if self.executable.is_file():
                 log("Python venv is already created")
             else:
-                subprocess.run(
+                traced_run(
                     ["python3", "-m", "venv", "--copies", str(self.root.absolute())],
                     check=True,
                 )
@@ -125,8 +209,12 @@ class PreparePythonBlock(IExecuteBlock):
         temp_dir = workspace / "temp"
         temp_dir.mkdir()
         try:
-            get_pip_path = download("https://bootstrap.pypa.io/get-pip.py", temp_dir)
-            subprocess.run([self.executable, get_pip_path])
+            get_pip_path = download(
+                "https://bootstrap.pypa.io/get-pip.py",
+                temp_dir,
+                offline=config.offline,
+            )
+            traced_run([self.executable, get_pip_path])
         finally:
             ## remove temp dir
             shutil.rmtree(temp_dir)
@@ -159,6 +247,7 @@ class IWithPreparePythonBlock(IExecuteBlock):
 
 
 __all__ = [
+    "precompile_interpreters",
     "PrepareBlock",
     "PreparePythonBlock",
     "IWithPreparePythonBlock",
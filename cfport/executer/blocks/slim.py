@@ -0,0 +1,259 @@
+import os
+import csv
+import json
+import shutil
+
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Tuple
+from typing import Optional
+from fnmatch import fnmatch
+from pathlib import Path
+from cftool.console import log
+from cftool.console import rule
+
+from .install import InstallPythonRequirementsBlock
+from .prepare import IWithPreparePythonBlock
+from ..schema import IExecuteBlock
+from ..schema import TDependencies
+from ...cache import hash_file
+from ...cache import format_size
+from ...config import IConfig
+from ...toolkit import get_stat_signature
+from ...constants import WORKSPACE_META_DIR
+
+
+# patterns without `/` match the names at any depth, patterns with a trailing `/` only
+# match directories, and other patterns match the paths relative to `site-packages`
+default_slim_strip = [
+    "__pycache__/",
+    "tests/",
+    "test/",
+    "docs/",
+    "doc/",
+    "*.pyi",
+    "*.h",
+    "*.hpp",
+    "*.cuh",
+]
+UNKNOWN_DIST = "<unknown>"
+
+
+def _match(rel: str, is_dir: bool, patterns: List[str]) -> bool:
+    name = rel.rsplit("/", 1)[-1]
+    for pattern in patterns:
+        if pattern.endswith("/"):
+            if not is_dir:
+                continue
+            pattern = pattern[:-1]
+        if fnmatch(rel if "/" in pattern else name, pattern):
+            return True
+    return False
+
+
+def _get_owners(site_packages: Path) -> Dict[str, str]:
+    """Returns the distribution which owns each file (listed in the `RECORD`s)."""
+
+    owners = {}
+    for dist_info in sorted(site_packages.glob("*.dist-info")):
+        dist = dist_info.name[: -len(".dist-info")]
+        owners[f"{dist_info.name}/"] = dist
+        record = dist_info / "RECORD"
+        if not record.is_file():
+            continue
+        with record.open("r", newline="") as f:
+            for row in csv.reader(f):
+                if row:
+                    owners[os.path.normpath(row[0]).replace(os.sep, "/")] = dist
+    return owners
+
+
+def _scan(site_packages: Path) -> Dict[str, os.stat_result]:
+    files = {}
+    for dirpath, _, filenames in os.walk(site_packages):
+        for name in filenames:
+            path = Path(dirpath) / name
+            rel = path.relative_to(site_packages).as_posix()
+            files[rel] = os.lstat(path)
+    return files
+
+
+def _get_sizes(
+    files: Dict[str, os.stat_result],
+    owners: Dict[str, str],
+) -> Dict[str, Dict[str, int]]:
+    """Returns the number of files & the bytes on disk (hardlinks are counted once)."""
+
+    sizes: Dict[str, Dict[str, int]] = {}
+    inodes = set()
+    for rel in sorted(files):
+        st = files[rel]
+        stats = sizes.setdefault(owners.get(rel, UNKNOWN_DIST), dict(files=0, bytes=0))
+        stats["files"] += 1
+        if (st.st_dev, st.st_ino) not in inodes:
+            inodes.add((st.st_dev, st.st_ino))
+            stats["bytes"] += st.st_size
+    return sizes
+
+
+def _strip(site_packages: Path, strip: List[str], keep: List[str]) -> List[str]:
+    """Removes the files / directories which match `strip` but not `keep`."""
+
+    stripped = []
+    for dirpath, dirnames, filenames in os.walk(site_packages):
+        root = Path(dirpath)
+        for name in sorted(dirnames):
+            rel = (root / name).relative_to(site_packages).as_posix()
+            if name.endswith(".dist-info"):
+                dirnames.remove(name)
+            elif _match(rel, True, strip) and not _match(rel, True, keep):
+                shutil.rmtree(root / name)
+                dirnames.remove(name)
+                stripped.append(f"{rel}/")
+        for name in sorted(filenames):
+            rel = (root / name).relative_to(site_packages).as_posix()
+            if _match(rel, False, strip) and not _match(rel, False, keep):
+                (root / name).unlink()
+                stripped.append(rel)
+    return stripped
+
+
+def _hardlink_duplicates(
+    site_packages: Path,
+    files: Dict[str, os.stat_result],
+) -> List[Tuple[str, str]]:
+    """
+    Replaces the files with identical contents (& modes) by hardlinks to the first one,
+    returns the (duplicate, original) pairs. Only files of the same size are hashed.
+    """
+
+    by_size: Dict[int, Dict[Tuple[int, int], str]] = {}
+    for rel in sorted(files):
+        st = files[rel]
+        if st.st_size == 0 or not os.path.isfile(site_packages / rel):
+            continue
+        # files which are already hardlinked are hashed only once
+        by_size.setdefault(st.st_size, {}).setdefault((st.st_dev, st.st_ino), rel)
+    linked = []
+    for inodes in by_size.values():
+        if len(inodes) < 2:
+            continue
+        originals: Dict[Tuple[str, int], str] = {}
+        for rel in inodes.values():
+            path = site_packages / rel
+            key = hash_file(path), files[rel].st_mode
+            original = originals.setdefault(key, rel)
+            if original == rel:
+                continue
+            tmp_path = path.with_name(f"{path.name}.tmp")
+            try:
+                os.link(site_packages / original, tmp_path)
+            except OSError:
+                # e.g. the filesystem does not support hardlinks
+                continue
+            tmp_path.replace(path)
+            linked.append((rel, original))
+    return linked
+
+
+@IExecuteBlock.register("slim_site_packages")
+class SlimSitePackagesBlock(IWithPreparePythonBlock):
+    """
+    Slims the `site-packages` after the requirements are installed (if
+    `slim_site_packages` is `True`): files which are not needed at runtime (tests, caches,
+    stubs, headers, docs, see `default_slim_strip`) are removed, and duplicate files are
+    replaced by hardlinks. A size report (by distribution) is written to
+    `.cfport/slim_report.json` in the workspace.
+    """
+
+    def get_dependencies(self, config: IConfig) -> TDependencies:
+        return [InstallPythonRequirementsBlock]
+
+    def fingerprint(self, config: IConfig) -> Optional[Any]:
+        if not config.slim_site_packages:
+            return dict(slim_site_packages=False)
+        install_block = self.try_get_previous(InstallPythonRequirementsBlock)
+        installed = None
+        if install_block is not None:
+            installed = install_block.artifacts(config)
+        return dict(
+            strip=config.slim_strip,
+            keep=config.slim_keep,
+            hardlink_duplicates=config.slim_hardlink_duplicates,
+            installed=installed,
+            python=self.prepare_python.get_state(),
+        )
+
+    def artifacts(self, config: IConfig) -> Any:
+        site_packages = self.prepare_python.site_packages
+        if not config.slim_site_packages or site_packages is None:
+            return None
+        return get_stat_signature(site_packages)
+
+    def build(self, config: IConfig) -> None:
+        site_packages = self.prepare_python.site_packages
+        if not config.slim_site_packages or site_packages is None:
+            return
+        rule("Slimming site-packages")
+        owners = _get_owners(site_packages)
+        before = _get_sizes(_scan(site_packages), owners)
+        strip = default_slim_strip if config.slim_strip is None else config.slim_strip
+        stripped = _strip(site_packages, strip, config.slim_keep or [])
+        files = _scan(site_packages)
+        linked = []
+        if config.slim_hardlink_duplicates:
+            linked = _hardlink_duplicates(site_packages, files)
+            files = _scan(site_packages)
+        after = _get_sizes(files, owners)
+        report = self.get_report(before, after)
+        report["stripped"] = stripped
+        report["hardlinked"] = dict(linked)
+        report_path = Path(config.workspace) / WORKSPACE_META_DIR / "slim_report.json"
+        report_path.parent.mkdir(parents=True, exist_ok=True)
+        with report_path.open("w") as f:
+            json.dump(report, f, indent=2)
+        self.log_report(report)
+        log(f"slim report is dumped to '{report_path}'")
+
+    def get_report(
+        self,
+        before: Dict[str, Dict[str, int]],
+        after: Dict[str, Dict[str, int]],
+    ) -> Dict[str, Any]:
+        dists = {}
+        for dist in sorted(set(before) | set(after)):
+            b = before.get(dist, dict(files=0, bytes=0))
+            a = after.get(dist, dict(files=0, bytes=0))
+            dists[dist] = dict(
+                files_before=b["files"],
+                files_after=a["files"],
+                bytes_before=b["bytes"],
+                bytes_after=a["bytes"],
+                bytes_saved=b["bytes"] - a["bytes"],
+            )
+        bytes_before = sum(d["bytes_before"] for d in dists.values())
+        bytes_after = sum(d["bytes_after"] for d in dists.values())
+        return dict(
+            bytes_before=bytes_before,
+            bytes_after=bytes_after,
+            bytes_saved=bytes_before - bytes_after,
+            distributions=dists,
+        )
+
+    def log_report(self, report: Dict[str, Any], top: int = 10) -> None:
+        before = format_size(report["bytes_before"])
+        after = format_size(report["bytes_after"])
+        saved = format_size(report["bytes_saved"])
+        log(f"site-packages: {before} -> {after} ({saved} saved)")
+        dists = report["distributions"].items()
+        for dist, stats in sorted(dists, key=lambda kv: -kv[1]["bytes_after"])[:top]:
+            before = format_size(stats["bytes_before"])
+            after = format_size(stats["bytes_after"])
+            log(f"  {dist}: {before} -> {after}")
+
+
+__all__ = [
+    "default_slim_strip",
+    "SlimSitePackagesBlock",
+]
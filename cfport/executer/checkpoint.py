@@ -0,0 +1,106 @@
+import json
+import threading
+
+from typing import Any
+from typing import Dict
+from typing import Optional
+from pathlib import Path
+from cftool.console import log
+
+
+class Checkpoint:
+    """
+    Records the progress of a run in `path`: the records of the blocks which are built,
+    and the units (e.g. requirements, assets, downloads) which are done in the blocks
+    which are not, so a failed run can be resumed from the first incomplete unit.
+
+    Units are bound to the fingerprint of their block, so they are discarded if the
+    inputs of the block changed. Every update is dumped atomically, so the checkpoint
+    survives crashes as well.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.blocks: Dict[str, Dict[str, Any]] = {}
+        self.units: Dict[str, Dict[str, Any]] = {}
+
+    def load(self) -> bool:
+        """Loads the checkpoint from `path`, returns whether there is one to resume."""
+
+        if not self.path.is_file():
+            return False
+        try:
+            with self.path.open("r") as f:
+                data = json.load(f)
+            self.blocks = data["blocks"]
+            self.units = data["units"]
+        except (ValueError, KeyError):
+            log(f"'{self.path}' is broken, it will be ignored")
+            return False
+        return True
+
+    def clear(self) -> None:
+        with self.lock:
+            self.blocks = {}
+            self.units = {}
+            if self.path.is_file():
+                self.path.unlink()
+
+    def _dump(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(f"{self.path.name}.tmp")
+        with tmp_path.open("w") as f:
+            json.dump(dict(blocks=self.blocks, units=self.units), f)
+        tmp_path.replace(self.path)
+
+    def record_block(self, name: str, record: Dict[str, Any]) -> None:
+        with self.lock:
+            self.blocks[name] = record
+            self.units.pop(name, None)
+            self._dump()
+
+    def start_units(
+        self,
+        name: str,
+        fingerprint: Optional[str],
+        *,
+        reset: bool = False,
+    ) -> None:
+        """
+        Starts to record the units of the block `name`. The units of the block are kept
+        only if they were recorded with the same `fingerprint`, and units will not be
+        recorded at all if `fingerprint` is `None`.
+        """
+
+        with self.lock:
+            units = self.units.get(name)
+            if fingerprint is None:
+                self.units.pop(name, None)
+            elif reset or units is None or units["fingerprint"] != fingerprint:
+                self.units[name] = dict(fingerprint=fingerprint, done={})
+            elif units["done"]:
+                log(f"resuming '{name}' with {len(units['done'])} units done")
+
+    def is_done(self, name: str, unit: str) -> bool:
+        with self.lock:
+            units = self.units.get(name)
+            return units is not None and unit in units["done"]
+
+    def get_result(self, name: str, unit: str) -> Any:
+        with self.lock:
+            units = self.units.get(name)
+            return None if units is None else units["done"].get(unit)
+
+    def mark_done(self, name: str, unit: str, result: Any = None) -> None:
+        with self.lock:
+            units = self.units.get(name)
+            if units is None:
+                return
+            units["done"][unit] = result
+            self._dump()
+
+
+__all__ = [
+    "Checkpoint",
+]
@@ -1,13 +1,88 @@
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Type
+from typing import Union
+from typing import Optional
 from cftool.pipeline import IBlock
 
+from .checkpoint import Checkpoint
 from ..config import IConfig
 
 
+TDependencies = Optional[List[Union[str, Type["IExecuteBlock"]]]]
+
+
 class IExecuteBlock(IBlock):
+    checkpoint: Optional[Checkpoint] = None
+
+    def get_dependencies(self, config: IConfig) -> TDependencies:
+        """
+        Returns the blocks (or their identifiers) that should be built before this block
+        (if they are used), and only these blocks (and their dependencies) will be
+        accessible in `previous`.
+
+        If `None` is returned (the default), the block depends on all the blocks before it,
+        so it will be built in order.
+        """
+
+        return None
+
+    def fingerprint(self, config: IConfig) -> Optional[Any]:
+        """
+        Returns the (json serializable) inputs of the block, e.g. the relevant slice of the
+        `config` and the outputs of the upstream blocks. The block will be skipped if
+        neither its fingerprint nor its `artifacts` changed since the last successful run.
+
+        If `None` is returned (the default), the block will always run.
+        """
+
+        return None
+
+    def artifacts(self, config: IConfig) -> Any:
+        """
+        Returns the signature of the on-disk artifacts of the block. It is recorded after
+        the whole run, and the block will be built again if its artifacts are modified.
+        """
+
+        return None
+
+    def get_state(self) -> Dict[str, Any]:
+        """Returns the (json serializable) outputs that the downstream blocks rely on."""
+
+        return {}
+
+    def restore(self, config: IConfig, state: Dict[str, Any]) -> None:
+        """Restores the outputs (from `get_state`) of the block when it is skipped."""
+
+    def is_unit_done(self, unit: str) -> bool:
+        """
+        Returns whether `unit` (e.g. a requirement) of the block is already done in the
+        run which is being resumed, long blocks should skip such units.
+        """
+
+        if self.checkpoint is None:
+            return False
+        return self.checkpoint.is_done(self.__identifier__, unit)
+
+    def get_unit_result(self, unit: str) -> Any:
+        """Returns the `result` that `unit` was marked done with."""
+
+        if self.checkpoint is None:
+            return None
+        return self.checkpoint.get_result(self.__identifier__, unit)
+
+    def mark_unit_done(self, unit: str, result: Any = None) -> None:
+        """Records that `unit` is done, `result` should be json serializable."""
+
+        if self.checkpoint is not None:
+            self.checkpoint.mark_done(self.__identifier__, unit, result)
+
     def cleanup(self, config: IConfig) -> None:
         pass
 
 
 __all__ = [
     "IExecuteBlock",
+    "TDependencies",
 ]
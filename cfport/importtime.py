@@ -0,0 +1,220 @@
+import json
+import time
+import statistics
+import subprocess
+
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Tuple
+from typing import Optional
+from pathlib import Path
+from cftool.console import log
+
+from .config import IConfig
+from .toolkit import Platform
+from .executer import PreparePythonBlock
+from .executer import SetPythonLaunchScriptBlock
+from .constants import WORKSPACE_META_DIR
+
+
+IMPORTTIME_PREFIX = "import time:"
+
+
+class ImportNode:
+    """An import reported by `-X importtime`, times are in seconds."""
+
+    def __init__(self, module: str, self_time: float, cumulative: float):
+        self.module = module
+        self.self_time = self_time
+        self.cumulative = cumulative
+        self.children: List["ImportNode"] = []
+
+    @property
+    def package(self) -> str:
+        return self.module.split(".")[0]
+
+
+def parse_importtime(stderr: str) -> List[ImportNode]:
+    """
+    Parses the `-X importtime` output into trees of imports, returns the roots. Imports
+    are reported after the imports they trigger (which are indented one level deeper).
+    """
+
+    pending: List[Tuple[int, ImportNode]] = []
+    for line in stderr.splitlines():
+        if not line.startswith(IMPORTTIME_PREFIX):
+            continue
+        fields = line[len(IMPORTTIME_PREFIX) :].split("|")
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            # the header line
+            continue
+        name = fields[2][1:]
+        level = (len(name) - len(name.lstrip())) // 2
+        self_us, cumulative_us = int(fields[0]), int(fields[1])
+        node = ImportNode(name.strip(), self_us * 1.0e-6, cumulative_us * 1.0e-6)
+        while pending and pending[-1][0] > level:
+            node.children.insert(0, pending.pop()[1])
+        pending.append((level, node))
+    return [node for _, node in pending]
+
+
+def aggregate_imports(roots: List[ImportNode]) -> Dict[str, Dict[str, Any]]:
+    """
+    Aggregates the imports by top-level packages: `self` is the time spent in the modules
+    of the package, `cumulative` also includes the imports they trigger (but the nested
+    imports of the package itself are only counted once).
+    """
+
+    packages: Dict[str, Dict[str, Any]] = {}
+
+    def _visit(node: ImportNode, ancestors: Tuple[str, ...]) -> None:
+        package = node.package
+        stats = packages.setdefault(package, dict(self=0.0, cumulative=0.0, modules=0))
+        stats["self"] += node.self_time
+        stats["modules"] += 1
+        if package not in ancestors:
+            stats["cumulative"] += node.cumulative
+        for child in node.children:
+            _visit(child, ancestors + (package,))
+
+    for root in roots:
+        _visit(root, ())
+    return packages
+
+
+def get_launch_command(config: IConfig) -> List[str]:
+    """
+    Returns the command which launches the packaged project like its launch script (in
+    the workspace), with `-X importtime`.
+    """
+
+    workspace = Path(config.workspace)
+    path = workspace / "executer.json"
+    if not path.is_file():
+        raise RuntimeError(f"'{path}' is not found, please run `cfport package` first")
+    with path.open("r") as f:
+        records = json.load(f)["info"].get("fingerprints", {})
+    prepare_python = PreparePythonBlock()
+    prepare_python.restore(config, records.get("prepare_python", {}).get("state", {}))
+    if not hasattr(prepare_python, "executable"):
+        raise RuntimeError("python is not prepared, please run `cfport package` first")
+    launch_block = SetPythonLaunchScriptBlock()
+    launch_block.previous = {prepare_python.__identifier__: prepare_python}
+    args = launch_block.get_launch_args(config)
+    if args is None:
+        msg = "neither `python_launch_cli` nor `python_launch_entry` is provided"
+        raise ValueError(msg)
+    if config.platform == Platform.WINDOWS:
+        executable = str(prepare_python.executable.absolute())
+        return [executable, "-X", "importtime", *args]
+    # the activation script is sourced like `run.sh` does, since it may modify the
+    # environment (e.g. `PYTHONPATH`)
+    activate = str((prepare_python.root / "bin" / "activate").relative_to(workspace))
+    script = 'source "$0" && exec python -X importtime "$@"'
+    return ["bash", "-c", script, activate, *args]
+
+
+def profile_launch(
+    config: IConfig,
+    *,
+    runs: int = 5,
+    warmup: int = 1,
+    timeout: float = 60.0,
+    top: int = 20,
+    path: Optional[Path] = None,
+) -> Dict[str, Any]:
+    """
+    Launches the packaged project `warmup + runs` times under `-X importtime`, and
+    aggregates the import times of each top-level package (medians over the `runs`).
+
+    Long running projects (e.g. servers) are killed after `timeout` seconds, and the
+    imports until then are profiled. The report is logged (the `top` packages, sorted by
+    their cumulative time) and dumped to `path` (defaults to `.cfport/importtime.json` in
+    the workspace), which can be compared across builds (e.g. in CI).
+    """
+
+    workspace = Path(config.workspace)
+    cmd = get_launch_command(config)
+    if path is None:
+        path = workspace / WORKSPACE_META_DIR / "importtime.json"
+    results = []
+    for i in range(warmup + runs):
+        if i < warmup:
+            label = f"warmup {i + 1}/{warmup}"
+        else:
+            label = f"run {i - warmup + 1}/{runs}"
+        t = time.perf_counter()
+        try:
+            result = subprocess.run(
+                cmd,
+                cwd=workspace,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+                text=True,
+                timeout=timeout,
+            )
+            stderr, returncode = result.stderr, result.returncode
+        except subprocess.TimeoutExpired as err:
+            # the output is not decoded on timeout
+            output = err.stderr or b""
+            if isinstance(output, str):
+                stderr = output
+            else:
+                stderr = output.decode(errors="replace")
+            returncode = None
+        wall = time.perf_counter() - t
+        roots = parse_importtime(stderr)
+        total = sum(root.cumulative for root in roots)
+        status = "killed" if returncode is None else f"exited with {returncode}"
+        log(f"{label}: {total:.3f}s importing, {wall:.3f}s wall ({status})")
+        if i >= warmup:
+            results.append((wall, total, aggregate_imports(roots)))
+    if not results:
+        raise ValueError("`runs` should be at least 1")
+
+    def _median(values: List[float]) -> float:
+        return round(statistics.median(values), 6)
+
+    names = sorted({name for _, _, packages in results for name in packages})
+    packages = []
+    for name in names:
+        empty = dict(self=0.0, cumulative=0.0, modules=0)
+        stats = [p.get(name, empty) for *_, p in results]
+        packages.append(
+            dict(
+                name=name,
+                self=_median([s["self"] for s in stats]),
+                cumulative=_median([s["cumulative"] for s in stats]),
+                modules=max(s["modules"] for s in stats),
+            )
+        )
+    packages.sort(key=lambda p: (-p["cumulative"], p["name"]))
+    report = dict(
+        command=cmd,
+        runs=runs,
+        warmup=warmup,
+        wall=_median([wall for wall, *_ in results]),
+        total=_median([total for _, total, _ in results]),
+        packages=packages,
+    )
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open("w") as f:
+        json.dump(report, f, indent=2)
+    log(f"median import time: {report['total']:.3f}s (wall: {report['wall']:.3f}s)")
+    for p in packages[:top]:
+        log(
+            f"  {p['name']}: {p['cumulative']:.3f}s cumulative, {p['self']:.3f}s self "
+            f"({p['modules']} modules)"
+        )
+    log(f"import time report is dumped to '{path}'")
+    return report
+
+
+__all__ = [
+    "ImportNode",
+    "parse_importtime",
+    "aggregate_imports",
+    "get_launch_command",
+    "profile_launch",
+]
@@ -0,0 +1,338 @@
+import os
+import csv
+import json
+import base64
+import shutil
+import hashlib
+
+from abc import abstractmethod
+from abc import ABCMeta
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Type
+from typing import Tuple
+from typing import Optional
+from pathlib import Path
+from zipfile import ZipFile
+from zipfile import ZipInfo
+from cftool.misc import WithRegister
+from cftool.console import log
+from configparser import ConfigParser
+from concurrent.futures import ThreadPoolExecutor
+
+from .tracing import trace
+from .tracing import traced_run
+from .tracing import traced_submit
+
+
+installers: Dict[str, Type["IInstaller"]] = {}
+
+
+class IInstaller(WithRegister["IInstaller"], metaclass=ABCMeta):
+    """
+    Installs wheels which are already resolved (e.g., by the wheelhouse or the lock file),
+    so their dependencies will not be resolved again.
+    """
+
+    d = installers
+
+    @abstractmethod
+    def install(
+        self,
+        wheels: List[Path],
+        *,
+        pip_cmd: List[str],
+        executable: str,
+    ) -> None:
+        pass
+
+
+@IInstaller.register("pip")
+class PipInstaller(IInstaller):
+    def install(
+        self,
+        wheels: List[Path],
+        *,
+        pip_cmd: List[str],
+        executable: str,
+    ) -> None:
+        cmd = pip_cmd + ["install", "--no-deps", "--no-index"]
+        if traced_run(cmd + [str(wheel) for wheel in wheels]).returncode != 0:
+            raise RuntimeError(f"failed to install {len(wheels)} wheels with `pip`")
+
+
+_get_scheme_script = """
+import sys
+import json
+import sysconfig
+
+paths = sysconfig.get_paths()
+paths["headers"] = paths["include"]
+print(json.dumps(dict(paths, windows=sys.platform.startswith("win"))))
+"""
+
+# a sh / python polyglot which runs the `python` next to the script, so the environment
+# can be relocated freely
+_posix_shebang = """#!/bin/sh
+'''exec' "$(dirname -- "$0")/python" "$0" "$@"
+' '''
+"""
+
+_posix_script_template = (
+    _posix_shebang
+    + """# -*- coding: utf-8 -*-
+import re
+import sys
+from {module} import {import_name}
+if __name__ == "__main__":
+    sys.argv[0] = re.sub(r"(-script\\.pyw|\\.exe)?$", "", sys.argv[0])
+    sys.exit({func}())
+"""
+)
+
+_windows_script_template = """# -*- coding: utf-8 -*-
+import re
+import sys
+from {module} import {import_name}
+if __name__ == "__main__":
+    sys.argv[0] = re.sub(r"(-script\\.pyw|\\.exe|\\.cmd)?$", "", sys.argv[0])
+    sys.exit({func}())
+"""
+
+# the embeddable layout is `python.exe` + `Scripts/`, so launchers are relative to it
+_windows_launcher_template = """@"%~dp0..\\{python}" "%~dp0{name}-script.py" %*
+"""
+
+
+def _canonicalize(name: str) -> str:
+    return name.replace("-", "_").replace(".", "_").lower()
+
+
+def _record_hash(data: bytes) -> str:
+    digest = base64.urlsafe_b64encode(hashlib.sha256(data).digest()).rstrip(b"=")
+    return f"sha256={digest.decode()}"
+
+
+def _find_dist_info(zip_ref: ZipFile) -> str:
+    for name in zip_ref.namelist():
+        parts = name.split("/")
+        if len(parts) == 2 and parts[0].endswith(".dist-info") and parts[1] == "WHEEL":
+            return parts[0]
+    raise RuntimeError(f"cannot find `.dist-info` in '{zip_ref.filename}'")
+
+
+def _read_metadata(text: str) -> Dict[str, str]:
+    metadata: Dict[str, str] = {}
+    for line in text.splitlines():
+        if not line.strip():
+            break
+        if ":" in line:
+            k, v = line.split(":", 1)
+            metadata.setdefault(k.strip(), v.strip())
+    return metadata
+
+
+def _uninstall(site_packages: Path, name: str) -> None:
+    """Remove the files (listed in `RECORD`) of installed distributions named `name`."""
+
+    if not site_packages.is_dir():
+        return
+    for dist_info in site_packages.glob("*.dist-info"):
+        dist_name = dist_info.name[: -len(".dist-info")].rsplit("-", 1)[0]
+        if _canonicalize(dist_name) != name:
+            continue
+        log(f"uninstalling '{dist_info.name}'")
+        record = dist_info / "RECORD"
+        parents = set()
+        if record.is_file():
+            with record.open("r", newline="") as f:
+                rows = [row for row in csv.reader(f) if row]
+            for row in rows:
+                path = site_packages / row[0]
+                if path.is_file() or path.is_symlink():
+                    path.unlink()
+                if path.suffix == ".py":
+                    for pyc in path.parent.glob(f"__pycache__/{path.stem}.*.pyc"):
+                        pyc.unlink()
+                parents.add(path.parent)
+        if dist_info.is_dir():
+            shutil.rmtree(dist_info)
+        # remove the directories which become empty, deepest first
+        for parent in sorted(parents, key=lambda p: len(p.parts), reverse=True):
+            for directory in [parent / "__pycache__", parent]:
+                try:
+                    directory.rmdir()
+                except OSError:
+                    pass
+
+
+@IInstaller.register("parallel")
+class ParallelInstaller(IInstaller):
+    """
+    Unzips the wheels into the target environment concurrently, which is much faster than
+    `pip` for large wheel sets. It follows the wheel spec (`.data` schemes, `RECORD`,
+    `INSTALLER`), and generates console-script launchers that fit the portable layout:
+    scripts which run the `python` next to them on Linux / macOS, and `.cmd` launchers
+    which call the `python.exe` next to `Scripts/` on Windows.
+
+    Bytecode is not compiled here (see the `precompile` block if needed).
+    """
+
+    def __init__(self, workers: Optional[int] = None):
+        self.workers = workers
+
+    def _get_scheme(self, executable: str) -> Dict[str, Any]:
+        cmd = [executable, "-c", _get_scheme_script]
+        result = traced_run(cmd, capture_output=True, text=True, check=True)
+        return json.loads(result.stdout)
+
+    def _write_scripts(
+        self,
+        entry_points: str,
+        scheme: Dict[str, Any],
+        python: str,
+        written: List[Tuple[Path, str, int]],
+    ) -> None:
+        parser = ConfigParser(delimiters=("=",))
+        parser.optionxform = str  # type: ignore
+        parser.read_string(entry_points)
+        scripts_dir = Path(scheme["scripts"])
+        scripts_dir.mkdir(parents=True, exist_ok=True)
+        for section in ["console_scripts", "gui_scripts"]:
+            if not parser.has_section(section):
+                continue
+            for name, value in parser.items(section):
+                module, _, func = value.split("[")[0].strip().partition(":")
+                import_name = func.split(".")[0]
+                kw = dict(module=module.strip(), import_name=import_name, func=func)
+                if not scheme["windows"]:
+                    data = _posix_script_template.format(**kw).encode()
+                    written.append(self._write_script(scripts_dir / name, data))
+                else:
+                    script = _windows_script_template.format(**kw).encode()
+                    path = scripts_dir / name
+                    written.extend(self._write_windows_script(path, script, python))
+
+    def _write_script(self, path: Path, data: bytes) -> Tuple[Path, str, int]:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if path.is_file() or path.is_symlink():
+            path.unlink()
+        path.write_bytes(data)
+        path.chmod(0o755)
+        return path, _record_hash(data), len(data)
+
+    def _write_windows_script(
+        self,
+        path: Path,
+        script: bytes,
+        python: str,
+    ) -> List[Tuple[Path, str, int]]:
+        # `path.cmd` runs `script` (written to `path-script.py`) with the `python.exe`
+        # next to `Scripts/`
+        name = path.name
+        launcher = _windows_launcher_template.format(name=name, python=python)
+        return [
+            self._write_script(path.with_name(f"{name}-script.py"), script),
+            self._write_script(path.with_name(f"{name}.cmd"), launcher.encode()),
+        ]
+
+    def _install_wheel(self, wheel: Path, scheme: Dict[str, Any], python: str) -> None:
+        written: List[Tuple[Path, str, int]] = []
+        with ZipFile(wheel, "r") as zip_ref:
+            dist_info = _find_dist_info(zip_ref)
+            wheel_metadata = _read_metadata(zip_ref.read(f"{dist_info}/WHEEL").decode())
+            is_purelib = wheel_metadata.get("Root-Is-Purelib", "true").lower() == "true"
+            lib_dir = Path(scheme["purelib" if is_purelib else "platlib"])
+            data_prefix = f"{dist_info[: -len('.dist-info')]}.data/"
+            for info in zip_ref.infolist():
+                if info.is_dir() or info.filename in (f"{dist_info}/RECORD",):
+                    continue
+                if not info.filename.startswith(data_prefix):
+                    dst = lib_dir / info.filename
+                    is_script = False
+                else:
+                    data_name = info.filename[len(data_prefix) :]
+                    scheme_name, _, rel = data_name.partition("/")
+                    dst = Path(scheme[scheme_name]) / rel
+                    is_script = scheme_name == "scripts"
+                args = zip_ref, info, dst, is_script, scheme, python
+                written.extend(self._extract(*args))
+            entry_points_name = f"{dist_info}/entry_points.txt"
+            if entry_points_name in zip_ref.namelist():
+                entry_points = zip_ref.read(entry_points_name).decode()
+                self._write_scripts(entry_points, scheme, python, written)
+        installer_path = lib_dir / dist_info / "INSTALLER"
+        installer_path.write_bytes(b"cfport\n")
+        written.append((installer_path, _record_hash(b"cfport\n"), len(b"cfport\n")))
+        with (lib_dir / dist_info / "RECORD").open("w", newline="") as f:
+            writer = csv.writer(f, lineterminator="\n")
+            for path, h, size in written:
+                rel_path = os.path.relpath(path, lib_dir).replace(os.sep, "/")
+                writer.writerow([rel_path, h, size])
+            writer.writerow([f"{dist_info}/RECORD", "", ""])
+
+    def _extract(
+        self,
+        zip_ref: ZipFile,
+        info: ZipInfo,
+        dst: Path,
+        is_script: bool,
+        scheme: Dict[str, Any],
+        python: str,
+    ) -> List[Tuple[Path, str, int]]:
+        data = zip_ref.read(info)
+        if is_script and data.startswith(b"#!python"):
+            # scripts which should run with the target python get launchers just like
+            # the console scripts
+            body = data[data.find(b"\n") + 1 :]
+            if scheme["windows"]:
+                if dst.suffix.lower() in (".py", ".pyw"):
+                    dst = dst.with_suffix("")
+                return self._write_windows_script(dst, body, python)
+            data = _posix_shebang.encode() + body
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        if dst.is_file() or dst.is_symlink():
+            dst.unlink()
+        dst.write_bytes(data)
+        mode = (info.external_attr >> 16) & 0o777
+        if is_script or mode & 0o111:
+            dst.chmod(0o755)
+        return [(dst, _record_hash(data), len(data))]
+
+    def install(
+        self,
+        wheels: List[Path],
+        *,
+        pip_cmd: List[str],
+        executable: str,
+    ) -> None:
+        scheme = self._get_scheme(executable)
+        python = Path(executable).name
+        if scheme["windows"] and not python.endswith(".exe"):
+            python = f"{python}.exe"
+        # uninstall the existing versions first, just like `pip`
+        for wheel in wheels:
+            name = _canonicalize(wheel.name.split("-")[0])
+            _uninstall(Path(scheme["purelib"]), name)
+            if scheme["platlib"] != scheme["purelib"]:
+                _uninstall(Path(scheme["platlib"]), name)
+        log(f"installing {len(wheels)} wheels concurrently")
+        name = f"install {len(wheels)} wheels"
+        with trace(name, "install"), ThreadPoolExecutor(self.workers) as executor:
+            futures = [
+                traced_submit(executor, self._install_wheel, wheel, scheme, python)
+                for wheel in wheels
+            ]
+            for wheel, future in zip(wheels, futures):
+                try:
+                    future.result()
+                except Exception as err:
+                    raise RuntimeError(f"failed to install '{wheel.name}'") from err
+
+
+__all__ = [
+    "IInstaller",
+    "PipInstaller",
+    "ParallelInstaller",
+]
@@ -0,0 +1,356 @@
+import json
+import tempfile
+
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Set
+from typing import Tuple
+from typing import Optional
+from pathlib import Path
+from cftool.console import log
+from cftool.console import rule
+from cftool.console import warn
+
+from .config import PyRequirement
+from .toolkit import check_requirements
+from .installer import IInstaller
+from .installer import PipInstaller
+from .wheelhouse import Wheelhouse
+from .wheelhouse import get_python_tag
+from .wheelhouse import get_requirements_key
+from .tracing import traced_run
+
+
+LOCK_VERSION = 1
+# `pip install --report` is added in pip 22.2
+RESOLVE_MIN_PIP_VERSION = (22, 2)
+
+_pip_versions: Dict[str, Tuple[int, ...]] = {}
+
+
+def _split_steps(
+    requirements: List[PyRequirement],
+    batch: bool,
+) -> List[Dict[str, Any]]:
+    # consecutive mergeable requirements are resolved together if `batch` is `True`
+    # (just like `batch_python_requirements`), while custom commands cannot be locked,
+    # so they are kept as is and run in order
+    steps: List[Dict[str, Any]] = []
+    for r in requirements:
+        pip_args = r.pip_args
+        if pip_args is None:
+            steps.append(dict(install_command=r.install_command))
+        elif batch and steps and "args" in steps[-1]:
+            steps[-1]["args"].extend(pip_args)
+        else:
+            steps.append(dict(args=list(pip_args)))
+    return steps
+
+
+def _get_key(pip_cmd: List[str], steps: List[Dict[str, Any]]) -> str:
+    args_list = [step.get("args") or [step["install_command"]] for step in steps]
+    return get_requirements_key(pip_cmd, args_list)
+
+
+def _parse_report_item(item: Dict[str, Any]) -> Dict[str, Any]:
+    metadata = item["metadata"]
+    info = item["download_info"]
+    package = dict(name=metadata["name"], version=metadata["version"], url=info["url"])
+    vcs_info = info.get("vcs_info")
+    archive_info = info.get("archive_info")
+    if vcs_info is not None:
+        package["url"] = f"{vcs_info['vcs']}+{info['url']}@{vcs_info['commit_id']}"
+    elif archive_info is not None:
+        sha256 = archive_info.get("hashes", {}).get("sha256")
+        if sha256 is None and archive_info.get("hash", "").startswith("sha256="):
+            sha256 = archive_info["hash"][len("sha256=") :]
+        if sha256 is not None:
+            package["sha256"] = sha256
+    return package
+
+
+def _get_id(package: Dict[str, Any]) -> str:
+    return f"{package['name']}=={package['version']}"
+
+
+def _get_wheel_id(wheel: Path) -> str:
+    # names in wheel file names are normalized, so both sides should be canonicalized
+    name, version = wheel.name.split("-")[:2]
+    return _canonicalize_id(f"{name}=={version}")
+
+
+def _canonicalize_id(package_id: str) -> str:
+    name, version = package_id.split("==")
+    name = name.replace("-", "_").replace(".", "_").lower()
+    return f"{name}=={version.replace('-', '_')}"
+
+
+def _get_locked_line(package: Dict[str, Any]) -> str:
+    url = package["url"]
+    sha256 = package.get("sha256")
+    if sha256 is not None and "#" not in url:
+        # pip verifies the hash in the fragment
+        url = f"{url}#sha256={sha256}"
+    return f"{package['name']} @ {url}"
+
+
+def _get_source(package: Dict[str, Any]) -> Optional[Tuple[str, str]]:
+    # returns the requirement to build and the hash of its source, or `None` if the
+    # package is a wheel, or its source cannot be hashed (e.g. a local directory)
+    url = package["url"]
+    if url.startswith("git+"):
+        return f"{package['name']} @ {url}", url
+    sha256 = package.get("sha256")
+    if sha256 is None or url.split("#")[0].endswith(".whl"):
+        return None
+    # pip verifies the hash in the fragment
+    return f"{package['name']} @ {url}#sha256={sha256}", f"sha256={sha256}"
+
+
+def get_pip_version(pip_cmd: List[str]) -> Tuple[int, ...]:
+    """Returns the version of `pip_cmd`, or an empty tuple if it cannot be detected."""
+
+    key = "\0".join(pip_cmd)
+    pip_version = _pip_versions.get(key)
+    if pip_version is None:
+        cmd = pip_cmd + ["--version"]
+        result = traced_run(cmd, capture_output=True, text=True)
+        parts = []
+        if result.returncode == 0 and result.stdout.startswith("pip "):
+            for part in result.stdout.split()[1].split("."):
+                if not part.isdigit():
+                    break
+                parts.append(int(part))
+        pip_version = _pip_versions[key] = tuple(parts)
+    return pip_version
+
+
+def resolve(pip_cmd: List[str], args: List[str]) -> List[Dict[str, Any]]:
+    """
+    Resolve the whole dependency closure of `args` with `pip install --dry-run --report`,
+    returns the exact version, artifact url and sha256 (if available) of every package.
+    """
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        report_path = Path(tmp_dir) / "report.json"
+        cmd = pip_cmd + ["install", "--dry-run", "--ignore-installed", "--quiet"]
+        cmd += ["--report", str(report_path)]
+        if traced_run(cmd + args).returncode != 0:
+            raise RuntimeError(f"failed to resolve {args}")
+        with report_path.open("r") as f:
+            report = json.load(f)
+    return [_parse_report_item(item) for item in report["install"]]
+
+
+def load_lock(path: Path) -> Optional[Dict[str, Any]]:
+    if not path.is_file():
+        return None
+    with path.open("r") as f:
+        lock = json.load(f)
+    if lock.get("version") != LOCK_VERSION:
+        return None
+    return lock
+
+
+def lock_requirements(
+    path: Path,
+    requirements: List[PyRequirement],
+    *,
+    pip_cmd: List[str],
+    upgrade: bool = False,
+    batch: bool = True,
+) -> Optional[Dict[str, Any]]:
+    """
+    Returns the lock of `requirements` at `path`. The lock will be (re)generated if it does
+    not exist, if it is out of date (the requirements or the target interpreter changed),
+    or if `upgrade` is `True`.
+
+    Consecutive requirements are resolved together if `batch` is `True`, otherwise every
+    requirement is resolved (and installed) on its own.
+
+    Returns `None` (with a warning) if the lock should be generated but the `pip` is too
+    old to resolve the requirements (see `RESOLVE_MIN_PIP_VERSION`).
+    """
+
+    steps = _split_steps(requirements, batch)
+    key = _get_key(pip_cmd, steps)
+    lock = load_lock(path)
+    if lock is not None and lock["key"] == key and not upgrade:
+        log(f"'{path}' is up to date")
+        return lock
+    pip_version = get_pip_version(pip_cmd)
+    if pip_version < RESOLVE_MIN_PIP_VERSION:
+        min_version = ".".join(map(str, RESOLVE_MIN_PIP_VERSION))
+        current = ".".join(map(str, pip_version)) or "unknown"
+        warn(
+            f"pip>={min_version} is required to lock the requirements, but the version "
+            f"of `{' '.join(pip_cmd)}` is {current}, so they will be installed without "
+            f"'{path}'"
+        )
+        return None
+    rule(f"Locking python requirements to '{path}'")
+    for step in steps:
+        if "args" in step:
+            step["packages"] = resolve(pip_cmd, step["args"])
+    python = get_python_tag(pip_cmd[0])
+    lock = dict(version=LOCK_VERSION, key=key, python=python, steps=steps)
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    with tmp_path.open("w") as f:
+        json.dump(lock, f, indent=2)
+    tmp_path.replace(path)
+    return lock
+
+
+def _install_step_from_wheelhouse(
+    step: Dict[str, Any],
+    wheelhouse: Wheelhouse,
+    *,
+    pip_cmd: List[str],
+    executable: str,
+    satisfied: Set[str],
+) -> int:
+    # returns the number of skipped (already satisfied) packages
+    key = get_requirements_key(pip_cmd, [step["args"]])
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        requirements_path = Path(tmp_dir) / "requirements.txt"
+        with requirements_path.open("w") as f:
+            for p in step["packages"]:
+                f.write(f"{_get_locked_line(p)}\n")
+        args = ["--no-deps", "-r", str(requirements_path)]
+        wheels = wheelhouse.build(pip_cmd, args, key)
+    satisfied = {_canonicalize_id(spec) for spec in satisfied}
+    to_install = [wheel for wheel in wheels if _get_wheel_id(wheel) not in satisfied]
+    if to_install:
+        rule(f"Installing {len(to_install)} locked packages from the wheelhouse")
+        wheelhouse.installer.install(to_install, pip_cmd=pip_cmd, executable=executable)
+    return len(wheels) - len(to_install)
+
+
+def install_lock(
+    lock: Dict[str, Any],
+    *,
+    pip_cmd: List[str],
+    executable: str,
+    skip_satisfied: bool = False,
+    installer: Optional[IInstaller] = None,
+    build_sources: bool = False,
+    wheelhouse: Optional[Wheelhouse] = None,
+) -> None:
+    """
+    Install the locked packages without resolving them again (`--no-deps`). Packages with
+    sha256 are installed with `--require-hashes`, and `install_command`s run in order.
+
+    If `skip_satisfied` is `True`, packages with sha256 that are already installed with the
+    locked versions will be skipped.
+
+    If `installer` is provided, packages with sha256 will be downloaded (and verified) by
+    `pip download` first, and the downloaded wheels will be installed by the `installer`.
+
+    If `build_sources` is `True`, git packages and sdists will be built into wheels in
+    parallel before installing (see `Wheelhouse.build_sources`).
+
+    If `wheelhouse` is provided, the locked packages of every step will be put into it
+    (under the key of the unlocked arguments, so they can be installed in `offline` mode
+    later), and installed from it by its installer. `installer` and `build_sources` are
+    not used in this case.
+    """
+
+    satisfied = set()
+    if skip_satisfied:
+        specs = [
+            _get_id(p)
+            for step in lock["steps"]
+            for p in step.get("packages", [])
+            if "sha256" in p
+        ]
+        checked = check_requirements(executable, specs)
+        satisfied = {spec for spec, ok in zip(specs, checked) if ok}
+    built: Dict[str, Path] = {}
+    if build_sources and wheelhouse is None:
+        sources: Dict[str, Tuple[str, str]] = {}
+        for step in lock["steps"]:
+            for p in step.get("packages", []):
+                source = _get_source(p)
+                if source is not None and _get_id(p) not in satisfied:
+                    sources[_get_id(p)] = source
+        source_wheels = Wheelhouse().build_sources(pip_cmd, dict(sources.values()))
+        built = {k: source_wheels[r] for k, (r, _) in sources.items()}
+    num_skipped = 0
+    for step in lock["steps"]:
+        if "install_command" in step:
+            r = PyRequirement(install_command=step["install_command"])
+            r.install_with(pip_cmd=pip_cmd, executable=executable)
+            continue
+        if wheelhouse is not None:
+            num_skipped += _install_step_from_wheelhouse(
+                step,
+                wheelhouse,
+                pip_cmd=pip_cmd,
+                executable=executable,
+                satisfied=satisfied,
+            )
+            continue
+        packages = [
+            p
+            for p in step["packages"]
+            if _get_id(p) not in satisfied or "sha256" not in p
+        ]
+        num_skipped += len(step["packages"]) - len(packages)
+        if not packages:
+            continue
+        rule(f"Installing {len(packages)} locked packages")
+        built_wheels = [built[_get_id(p)] for p in packages if _get_id(p) in built]
+        packages = [p for p in packages if _get_id(p) not in built]
+        if built_wheels:
+            (installer or PipInstaller()).install(
+                built_wheels,
+                pip_cmd=pip_cmd,
+                executable=executable,
+            )
+        hashed = [p for p in packages if "sha256" in p]
+        unhashed = [p for p in packages if "sha256" not in p]
+        install_cmd = pip_cmd + ["install", "--no-deps"]
+        if hashed:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                requirements_path = Path(tmp_dir) / "requirements.txt"
+                with requirements_path.open("w") as f:
+                    for p in hashed:
+                        line = f"{p['name']} @ {p['url']} --hash=sha256:{p['sha256']}"
+                        f.write(f"{line}\n")
+                args = ["--require-hashes", "-r", str(requirements_path)]
+                if installer is None:
+                    if traced_run(install_cmd + args).returncode != 0:
+                        raise RuntimeError("failed to install locked packages")
+                else:
+                    download_dir = Path(tmp_dir) / "downloads"
+                    download_cmd = pip_cmd + ["download", "--no-deps"]
+                    download_cmd += ["-d", str(download_dir)]
+                    if traced_run(download_cmd + args).returncode != 0:
+                        raise RuntimeError("failed to download locked packages")
+                    files = sorted(download_dir.iterdir())
+                    wheels = [file for file in files if file.suffix == ".whl"]
+                    others = [str(file) for file in files if file.suffix != ".whl"]
+                    if wheels:
+                        installer.install(
+                            wheels,
+                            pip_cmd=pip_cmd,
+                            executable=executable,
+                        )
+                    if others and traced_run(install_cmd + others).returncode != 0:
+                        raise RuntimeError("failed to install locked packages")
+        if unhashed:
+            cmd = install_cmd + [f"{p['name']} @ {p['url']}" for p in unhashed]
+            if traced_run(cmd).returncode != 0:
+                raise RuntimeError("failed to install locked packages")
+    if num_skipped > 0:
+        log(f"{num_skipped} locked packages are already installed, skipped")
+
+
+__all__ = [
+    "RESOLVE_MIN_PIP_VERSION",
+    "get_pip_version",
+    "load_lock",
+    "lock_requirements",
+    "install_lock",
+]
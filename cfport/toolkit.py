@@ -1,18 +1,60 @@
+import io
+import os
+import re
+import bz2
 import sys
+import json
+import time
+import zlib
 import shutil
+import struct
+import heapq
+import hashlib
 import tarfile
+import threading
 import subprocess
+import urllib.error
 import urllib.request
 
 from enum import Enum
+from typing import Any
+from typing import Dict
 from typing import List
+from typing import Tuple
 from typing import Callable
 from typing import Optional
 from pathlib import Path
 from zipfile import ZipFile
+from zipfile import ZipInfo
+from zipfile import ZIP_BZIP2
+from zipfile import ZIP_STORED
+from zipfile import ZIP_DEFLATED
+from concurrent.futures import ThreadPoolExecutor
 from cftool.misc import DownloadProgressBar
 from cftool.console import log
 
+from .cache import hash_file
+from .tracing import trace
+from .tracing import add_count
+from .tracing import traced_run
+from .tracing import traced_submit
+from .tracing import COPIED_BYTES
+from .tracing import DOWNLOADED_BYTES
+from .cache import get_download_cache
+from .constants import GIT_CACHE_DIR
+from .constants import EXTRACT_WORKERS
+from .constants import DOWNLOAD_RETRIES
+from .constants import DOWNLOAD_TIMEOUT
+from .constants import DOWNLOAD_SEGMENTS
+from .constants import DOWNLOAD_CHUNK_SIZE
+from .constants import DOWNLOAD_PIECE_SIZE
+from .constants import DOWNLOAD_VERIFY_RETRIES
+from .constants import EXTRACT_MEMBER_OVERHEAD
+from .constants import DOWNLOAD_HASH_BUFFER_SIZE
+from .constants import EXTRACT_PARALLEL_MIN_SIZE
+from .constants import EXTRACT_PARALLEL_MIN_MEMBERS
+from .constants import GIT_LFS_CONCURRENT_TRANSFERS
+
 
 class Platform(str, Enum):
     LINUX = "linux"
@@ -32,22 +74,648 @@ def get_platform() -> Platform:
         raise ValueError(f"unknown platform: {platform}")
 
 
+def _open_url(url: str, headers: Optional[Dict[str, str]] = None) -> Any:
+    request = urllib.request.Request(url, headers=headers or {})
+    return urllib.request.urlopen(request, timeout=DOWNLOAD_TIMEOUT)
+
+
+def _probe_url(url: str) -> Tuple[Any, Optional[int]]:
+    """
+    Returns the opened response and the size of `url`. The size will be `None` if `Range`
+    is not supported, and the response can then be used as a complete single stream.
+    """
+
+    try:
+        response = _open_url(url, {"Range": "bytes=0-0"})
+    except urllib.error.HTTPError as err:
+        # 416 means the file is empty, and `Range` makes no sense
+        if err.code != 416:
+            raise
+        return _open_url(url), None
+    if response.getcode() != 206:
+        return response, None
+    content_range = response.headers.get("Content-Range")
+    if content_range is not None:
+        size_str = content_range.rsplit("/", 1)[-1]
+        if size_str.isdigit():
+            return response, int(size_str)
+    # the total size is unknown (e.g. `bytes 0-0/*`), and the partial body is useless,
+    # so the whole file is requested again
+    response.close()
+    return _open_url(url), None
+
+
+def _get_content_length(response: Any) -> Optional[int]:
+    content_length = response.headers.get("Content-Length")
+    if content_length is None or not content_length.isdigit():
+        return None
+    return int(content_length)
+
+
+def _check_size(url: str, remote_size: Optional[int], size: Optional[int]) -> None:
+    if size is not None and remote_size is not None and remote_size != size:
+        raise RuntimeError(f"size of '{url}' is {remote_size}, but {size} is expected")
+
+
+def _verify(url: str, digest: str, downloaded: int, sha256: Any, size: Any) -> str:
+    """Returns the error message if the verification fails, otherwise returns ''."""
+
+    if size is not None and downloaded != size:
+        return f"'{url}' has {downloaded} bytes, but {size} bytes are expected"
+    if sha256 is not None and digest != sha256.lower():
+        return f"sha256 of '{url}' is {digest}, but {sha256} is expected"
+    return ""
+
+
+class _IncrementalHasher:
+    """
+    Computes the sha256 of a file while its chunks are being written, possibly out of order.
+
+    Chunks which are ahead of the hashed prefix are buffered (up to `max_pending` bytes), so
+    nothing needs to be read back from disk as long as the chunks arrive roughly in order.
+    Only the chunks that overflow the buffer (or were written by a previous, interrupted
+    run) will be read back from `path` when the hashed prefix catches up with them.
+    """
+
+    def __init__(self, path: Path, max_pending: int = DOWNLOAD_HASH_BUFFER_SIZE):
+        self.path = path
+        self.max_pending = max_pending
+        self.sha256 = hashlib.sha256()
+        self.position = 0
+        self.pending: Dict[int, bytes] = {}
+        self.pending_size = 0
+        self.lock = threading.Lock()
+
+    def _consume(self, data: bytes) -> None:
+        self.sha256.update(data)
+        self.position += len(data)
+        while self.position in self.pending:
+            data = self.pending.pop(self.position)
+            self.pending_size -= len(data)
+            self.sha256.update(data)
+            self.position += len(data)
+
+    def feed(self, offset: int, data: bytes) -> None:
+        with self.lock:
+            if offset == self.position:
+                self._consume(data)
+            elif offset > self.position:
+                if self.pending_size + len(data) <= self.max_pending:
+                    self.pending[offset] = data
+                    self.pending_size += len(data)
+
+    def hexdigest(self, size: int) -> str:
+        with self.lock:
+            if self.position < size:
+                with self.path.open("rb") as f:
+                    while self.position < size:
+                        offsets = [o for o in self.pending if o > self.position]
+                        next_offset = min(offsets, default=size)
+                        f.seek(self.position)
+                        n = min(next_offset - self.position, DOWNLOAD_CHUNK_SIZE)
+                        data = f.read(n)
+                        if len(data) != n:
+                            raise RuntimeError(f"'{self.path}' is truncated")
+                        self._consume(data)
+            return self.sha256.hexdigest()
+
+
+def _stream_to(
+    response: Any,
+    path: Path,
+    progress: DownloadProgressBar,
+    hasher: _IncrementalHasher,
+) -> int:
+    size = 0
+    with path.open("wb") as f:
+        while True:
+            chunk = response.read(DOWNLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            f.write(chunk)
+            hasher.feed(size, chunk)
+            size += len(chunk)
+            progress.update(len(chunk))
+            add_count(DOWNLOADED_BYTES, len(chunk))
+    return size
+
+
+def _load_range_map(path: Path, url: str) -> Optional[Dict[str, Any]]:
+    if not path.is_file():
+        return None
+    try:
+        with path.open("r") as f:
+            range_map = json.load(f)
+    except ValueError:
+        return None
+    if range_map.get("url") != url:
+        return None
+    return range_map
+
+
+def _dump_range_map(path: Path, range_map: Dict[str, Any]) -> None:
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    with tmp_path.open("w") as f:
+        json.dump(range_map, f)
+    tmp_path.replace(path)
+
+
+def _download_pieces(
+    url: str,
+    partial_path: Path,
+    size: int,
+    segments: int,
+    progress: DownloadProgressBar,
+    hasher: _IncrementalHasher,
+) -> None:
+    range_map_path = partial_path.with_name(f"{partial_path.name}.json")
+    range_map = None
+    if partial_path.is_file():
+        range_map = _load_range_map(range_map_path, url)
+    if range_map is None or range_map["size"] != size:
+        ranges = []
+        for start in range(0, size, DOWNLOAD_PIECE_SIZE):
+            end = min(start + DOWNLOAD_PIECE_SIZE, size) - 1
+            ranges.append([start, end, 0])
+        range_map = dict(url=url, size=size, ranges=ranges)
+        with partial_path.open("wb") as f:
+            f.truncate(size)
+    else:
+        log(f"resuming '{partial_path}'")
+    ranges = range_map["ranges"]
+    progress.update(sum(r[2] for r in ranges))
+    lock = threading.Lock()
+    stop = threading.Event()
+    last_dumped = [time.time()]
+
+    def _download(r: List[int]) -> None:
+        start, end = r[:2]
+        for i in range(DOWNLOAD_RETRIES):
+            if stop.is_set() or start + r[2] > end:
+                return
+            headers = {"Range": f"bytes={start + r[2]}-{end}"}
+            try:
+                with _open_url(url, headers) as response:
+                    if response.getcode() != 206:
+                        raise RuntimeError(f"'{url}' stopped supporting `Range`")
+                    with partial_path.open("r+b") as f:
+                        f.seek(start + r[2])
+                        while not stop.is_set():
+                            remaining = end - (start + r[2]) + 1
+                            if remaining <= 0:
+                                break
+                            chunk = response.read(min(remaining, DOWNLOAD_CHUNK_SIZE))
+                            if not chunk:
+                                break
+                            f.write(chunk)
+                            f.flush()
+                            hasher.feed(start + r[2], chunk)
+                            with lock:
+                                r[2] += len(chunk)
+                                progress.update(len(chunk))
+                                add_count(DOWNLOADED_BYTES, len(chunk))
+                                now = time.time()
+                                if now - last_dumped[0] >= 1.0:
+                                    _dump_range_map(range_map_path, range_map)
+                                    last_dumped[0] = now
+                if stop.is_set():
+                    return
+            except (OSError, urllib.error.URLError):
+                if i == DOWNLOAD_RETRIES - 1:
+                    raise
+        if start + r[2] <= end:
+            raise RuntimeError(f"failed to download bytes {start}-{end} of '{url}'")
+
+    # pieces are submitted (and therefore downloaded) in order, so the hashed prefix
+    # can keep up with the download
+    try:
+        with ThreadPoolExecutor(min(segments, len(ranges))) as pool:
+            futures = [traced_submit(pool, _download, r) for r in ranges]
+            try:
+                for future in futures:
+                    future.result()
+            finally:
+                stop.set()
+    finally:
+        with lock:
+            _dump_range_map(range_map_path, range_map)
+    range_map_path.unlink()
+
+
+def _download_file(
+    url: str,
+    partial_path: Path,
+    segments: int,
+    desc: Optional[str],
+    size: Optional[int],
+) -> Tuple[str, int]:
+    hasher = _IncrementalHasher(partial_path)
+    with DownloadProgressBar(unit="B", unit_scale=True, miniters=1, desc=desc) as t:
+        response, remote_size = _probe_url(url)
+        with response:
+            if remote_size is None:
+                # `Range` is not supported, so we can only use a single stream
+                t.total = _get_content_length(response)
+                _check_size(url, t.total, size)
+                downloaded = _stream_to(response, partial_path, t, hasher)
+        if remote_size is not None:
+            _check_size(url, remote_size, size)
+            t.total = downloaded = remote_size
+            _download_pieces(url, partial_path, remote_size, segments, t, hasher)
+    return hasher.hexdigest(downloaded), downloaded
+
+
+def download_file(
+    url: str,
+    path: Path,
+    *,
+    segments: int = DOWNLOAD_SEGMENTS,
+    desc: Optional[str] = None,
+    sha256: Optional[str] = None,
+    size: Optional[int] = None,
+) -> str:
+    """
+    Download `url` to `path` with at most `segments` concurrent connections, returns the
+    sha256 of the downloaded content.
+
+    The file is split into byte ranges (pieces), which are written to a `.partial` file
+    and tracked in a sidecar `.partial.json` range map, so an interrupted download will be
+    resumed next time. If the server ignores `Range`, a single stream will be used instead.
+
+    The content is hashed while it streams in, so if `sha256` / `size` are provided, the
+    download can be verified without reading the whole file back.
+    """
+
+    partial_path = path.with_name(f"{path.name}.partial")
+    for i in range(DOWNLOAD_VERIFY_RETRIES + 1):
+        digest, downloaded = _download_file(url, partial_path, segments, desc, size)
+        msg = _verify(url, digest, downloaded, sha256, size)
+        if not msg:
+            break
+        partial_path.unlink()
+        if i == DOWNLOAD_VERIFY_RETRIES:
+            raise RuntimeError(msg)
+        log(f"{msg}, retrying")
+    partial_path.replace(path)
+    return digest
+
+
+archive_suffixes = [".tar.gz", ".tgz", ".tar", ".zip"]
+
+
+def _get_topmost_names(names: List[str]) -> List[str]:
+    return [name.rstrip("/") for name in names if "/" not in name.rstrip("/")]
+
+
+def _safe_join(root: Path, name: str) -> Path:
+    parts = name.replace("\\", "/").split("/")
+    parts = [p for p in parts if p not in ("", ".", "..") and not p.endswith(":")]
+    return root.joinpath(*parts)
+
+
+def _move_extracted(staging: Path, dst: Path, topmost_names: List[str]) -> None:
+    if topmost_names == [dst.name]:
+        (staging / dst.name).replace(dst)
+        shutil.rmtree(staging)
+    else:
+        staging.replace(dst)
+
+
+class _StreamReader(io.RawIOBase):
+    """Wraps a response, so we can track (and hash) the bytes read from it."""
+
+    def __init__(self, response: Any, progress: DownloadProgressBar, hasher: Any):
+        self.response = response
+        self.progress = progress
+        self.hasher = hasher
+        self.position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: Any) -> int:
+        data = self.response.read(len(buffer))
+        n = len(data)
+        buffer[:n] = data
+        self.hasher.update(data)
+        self.position += n
+        self.progress.update(n)
+        add_count(DOWNLOADED_BYTES, n)
+        return n
+
+    def read_exactly(self, n: int) -> bytes:
+        data = self.read(n) if n > 0 else b""
+        while len(data) < n:
+            chunk = self.read(n - len(data))
+            if not chunk:
+                raise RuntimeError("unexpected end of stream")
+            data += chunk
+        return data
+
+    def skip_to(self, position: int) -> None:
+        while self.position < position:
+            self.read_exactly(min(position - self.position, DOWNLOAD_CHUNK_SIZE))
+
+
+class _TailNotEnough(Exception):
+    def __init__(self, position: int):
+        super().__init__(f"bytes before {position} are not fetched")
+        self.position = position
+
+
+class _TailFile:
+    """A readonly 'file' which only holds the tail of a remote zip archive."""
+
+    def __init__(self, size: int, offset: int, data: bytes):
+        self.size = size
+        self.offset = offset
+        self.data = data
+        self.position = 0
+
+    def seekable(self) -> bool:
+        return True
+
+    def seek(self, position: int, whence: int = 0) -> int:
+        if whence == 1:
+            position += self.position
+        elif whence == 2:
+            position += self.size
+        self.position = position
+        return position
+
+    def tell(self) -> int:
+        return self.position
+
+    def read(self, n: int = -1) -> bytes:
+        if self.position < self.offset:
+            raise _TailNotEnough(self.position)
+        start = self.position - self.offset
+        data = self.data[start:] if n < 0 else self.data[start : start + n]
+        self.position += len(data)
+        return data
+
+
+def _read_zip_central_directory(url: str, size: int) -> List[ZipInfo]:
+    offset = max(0, size - (1 << 16))
+    while True:
+        with _open_url(url, {"Range": f"bytes={offset}-{size - 1}"}) as response:
+            data = response.read()
+        try:
+            with ZipFile(_TailFile(size, offset, data), "r") as zip_ref:  # type: ignore
+                return zip_ref.infolist()
+        except _TailNotEnough as err:
+            offset = err.position
+
+
+def _stream_extract_zip(
+    url: str,
+    staging: Path,
+    progress: DownloadProgressBar,
+    hasher: Any,
+    size: Optional[int],
+) -> Optional[Tuple[List[str], int]]:
+    """
+    Extract the remote zip archive while downloading it, returns `None` if streaming
+    is not possible, in which case the archive should be downloaded first.
+
+    The central directory locates at the end of a zip archive, so we fetch (spool) it with
+    a `Range` request first, and then every member can be decompressed sequentially as the
+    body of the archive streams in.
+    """
+
+    response, remote_size = _probe_url(url)
+    response.close()
+    if remote_size is None:
+        return None
+    _check_size(url, remote_size, size)
+    infos = _read_zip_central_directory(url, remote_size)
+    supported_types = {ZIP_STORED, ZIP_DEFLATED, ZIP_BZIP2}
+    for info in infos:
+        if info.flag_bits & 0x1 or info.compress_type not in supported_types:
+            return None
+    progress.total = remote_size
+    with _open_url(url) as response:
+        reader = _StreamReader(response, progress, hasher)
+        for info in sorted(infos, key=lambda info: info.header_offset):
+            reader.skip_to(info.header_offset)
+            header = struct.unpack("<4s5H3L2H", reader.read_exactly(30))
+            if header[0] != b"PK\x03\x04":
+                raise RuntimeError(f"bad local file header for '{info.filename}'")
+            reader.read_exactly(header[-2] + header[-1])
+            path = _safe_join(staging, info.filename)
+            if info.is_dir():
+                path.mkdir(parents=True, exist_ok=True)
+                continue
+            path.parent.mkdir(parents=True, exist_ok=True)
+            decompressor: Any = None
+            if info.compress_type == ZIP_DEFLATED:
+                decompressor = zlib.decompressobj(-15)
+            elif info.compress_type == ZIP_BZIP2:
+                decompressor = bz2.BZ2Decompressor()
+            crc = 0
+            remaining = info.compress_size
+            with path.open("wb") as f:
+                while remaining > 0:
+                    chunk = reader.read_exactly(min(remaining, DOWNLOAD_CHUNK_SIZE))
+                    remaining -= len(chunk)
+                    if decompressor is not None:
+                        chunk = decompressor.decompress(chunk)
+                    f.write(chunk)
+                    crc = zlib.crc32(chunk, crc)
+                if info.compress_type == ZIP_DEFLATED:
+                    chunk = decompressor.flush()
+                    f.write(chunk)
+                    crc = zlib.crc32(chunk, crc)
+            if crc != info.CRC:
+                raise RuntimeError(f"bad CRC-32 for '{info.filename}'")
+        reader.skip_to(remote_size)
+        # the whole body must be consumed, otherwise the hash will be incomplete
+        if reader.read(1):
+            raise RuntimeError(f"'{url}' is larger than {remote_size} bytes")
+    return [info.filename for info in infos], reader.position
+
+
+def _stream_extract_tar(
+    url: str,
+    staging: Path,
+    progress: DownloadProgressBar,
+    hasher: Any,
+    size: Optional[int],
+) -> Tuple[List[str], int]:
+    with _open_url(url) as response:
+        progress.total = _get_content_length(response)
+        _check_size(url, progress.total, size)
+        raw_reader = _StreamReader(response, progress, hasher)
+        reader = io.BufferedReader(raw_reader)
+        with tarfile.open(fileobj=reader, mode="r|*") as tar_ref:
+            names = []
+            for member in tar_ref:
+                names.append(member.name)
+                tar_ref.extract(member, staging)
+        # the whole body must be consumed, otherwise the hash will be incomplete
+        while reader.read(DOWNLOAD_CHUNK_SIZE):
+            pass
+    return names, raw_reader.position
+
+
+def _stream_download(
+    url: str,
+    staging: Path,
+    desc: str,
+    sha256: Optional[str],
+    size: Optional[int],
+) -> Optional[List[str]]:
+    result: Optional[Tuple[List[str], int]]
+    for i in range(DOWNLOAD_VERIFY_RETRIES + 1):
+        if staging.is_dir():
+            shutil.rmtree(staging)
+        hasher = hashlib.sha256()
+        with DownloadProgressBar(unit="B", unit_scale=True, desc=desc) as t:
+            if url.split("/")[-1].endswith(".zip"):
+                result = _stream_extract_zip(url, staging, t, hasher, size)
+            else:
+                result = _stream_extract_tar(url, staging, t, hasher, size)
+        if result is None:
+            return None
+        names, downloaded = result
+        msg = _verify(url, hasher.hexdigest(), downloaded, sha256, size)
+        if not msg:
+            return names
+        shutil.rmtree(staging)
+        if i == DOWNLOAD_VERIFY_RETRIES:
+            raise RuntimeError(msg)
+        log(f"{msg}, retrying")
+    return None
+
+
+def _extract_zip_members(path: str, staging: str, names: List[str]) -> None:
+    # runs in a worker thread, so it opens its own handle to the archive
+    with ZipFile(path, "r") as zip_ref:
+        for name in names:
+            zip_ref.extract(name, staging)
+
+
+def _split_zip_members(infos: List[ZipInfo], num_buckets: int) -> List[List[str]]:
+    # greedily assign the heaviest members to the lightest bucket, where every member
+    # also carries a fixed overhead so that tons of small files are balanced as well
+    buckets: List[List[ZipInfo]] = [[] for _ in range(num_buckets)]
+    heap = [(0, i) for i in range(num_buckets)]
+
+    def weight(info: ZipInfo) -> int:
+        return info.file_size + EXTRACT_MEMBER_OVERHEAD
+
+    for info in sorted(infos, key=weight, reverse=True):
+        load, i = heapq.heappop(heap)
+        buckets[i].append(info)
+        heapq.heappush(heap, (load + weight(info), i))
+    # extract in archive order within each bucket to keep reads mostly sequential
+    return [
+        [info.filename for info in sorted(bucket, key=lambda info: info.header_offset)]
+        for bucket in buckets
+        if bucket
+    ]
+
+
+def _extract_zip(
+    path: Path,
+    staging: Path,
+    workers: int = EXTRACT_WORKERS,
+) -> List[str]:
+    """
+    Extract the zip archive at `path` to `staging`, returns the names of its members.
+
+    Large archives (many members, or large in total) are extracted by a pool of threads
+    (`zlib` releases the GIL while inflating), each of which opens its own handle to the
+    archive and extracts a balanced subset of the members. Small archives are not worth
+    the overhead. Processes are not used, since forking from the threads of the callers
+    (e.g. concurrent asset fetches) may deadlock.
+    """
+
+    with ZipFile(path, "r") as zip_ref:
+        infos = zip_ref.infolist()
+        names = [info.filename for info in infos]
+        files = [info for info in infos if not info.is_dir()]
+        total_size = sum(info.file_size for info in files)
+        workers = min(workers, len(files))
+        if workers <= 1 or (
+            len(files) < EXTRACT_PARALLEL_MIN_MEMBERS
+            and total_size < EXTRACT_PARALLEL_MIN_SIZE
+        ):
+            zip_ref.extractall(staging)
+            return names
+        # create the (possibly empty) directories up front
+        for info in infos:
+            if info.is_dir():
+                zip_ref.extract(info, staging)
+    buckets = _split_zip_members(files, workers)
+    with ThreadPoolExecutor(len(buckets)) as executor:
+        futures = [
+            executor.submit(_extract_zip_members, str(path), str(staging), bucket)
+            for bucket in buckets
+        ]
+        for future in futures:
+            future.result()
+    return names
+
+
+def _extract(path: Path, dst: Path) -> None:
+    staging = dst.with_name(f".{dst.name}.partial")
+    if staging.is_dir():
+        shutil.rmtree(staging)
+    if path.name.endswith(".zip"):
+        names = _extract_zip(path, staging)
+    else:
+        with tarfile.open(path) as tar_ref:
+            names = tar_ref.getnames()
+            tar_ref.extractall(staging)
+    _move_extracted(staging, dst, _get_topmost_names(names))
+
+
+def parse_download_name(url: str, name: Optional[str] = None) -> Tuple[str, str]:
+    """Returns the `name` and the `suffix` which `download` will use for `url`."""
+
+    file_name = url.split("/")[-1]
+    suffix = Path(file_name).suffix
+    for archive_suffix in archive_suffixes:
+        if file_name.endswith(archive_suffix):
+            suffix = archive_suffix
+            break
+    if name is None:
+        name = file_name[: len(file_name) - len(suffix)]
+    return name, suffix
+
+
 def download(
     url: str,
     root: Path = Path.cwd(),
     name: Optional[str] = None,
     *,
     remove_compressed: bool = True,
+    segments: int = DOWNLOAD_SEGMENTS,
+    use_cache: bool = True,
+    stream: bool = False,
+    sha256: Optional[str] = None,
+    size: Optional[int] = None,
+    offline: bool = False,
 ) -> Path:
-    file = Path(url.split("/")[-1])
-    if name is None:
-        name = file.stem
-    else:
-        file = file.with_name(f"{name}{file.suffix}")
-    path = root / file
-    is_zip = file.suffix == ".zip"
-    is_tar = file.suffix in {".tar", ".tar.gz", ".tgz"}
-    is_compressed = is_zip or is_tar
+    """
+    Download `url` into `root`, archives (`.zip` / `.tar` / `.tar.gz` / `.tgz`) will be
+    extracted to `root / name`, other files will be saved to `root / f"{name}{suffix}"`.
+
+    If `stream` is `True`, archives will be extracted while they are being downloaded, so
+    they never need to be stored on disk. In this case, the archives will not be put into
+    the download cache either.
+
+    If `sha256` / `size` are provided, the download will be verified (incrementally, while
+    the bytes stream in), and a mismatch will be retried once before raising an error.
+
+    If `offline` is `True`, `url` should be found in the download cache, otherwise an error
+    will be raised.
+    """
+
+    name, suffix = parse_download_name(url, name)
+    path = root / f"{name}{suffix}"
+    is_compressed = suffix in archive_suffixes
     uncompressed_folder_path = root / name
     if is_compressed and uncompressed_folder_path.is_dir():
         log(f"'{uncompressed_folder_path}' already exists, skipping")
@@ -55,61 +723,540 @@ def download(
     if not is_compressed and path.is_file():
         log(f"'{path}' already exists, skipping")
         return path
-    with DownloadProgressBar(unit="B", unit_scale=True, miniters=1, desc=name) as t:
-        urllib.request.urlretrieve(
-            url,
-            filename=path,
-            reporthook=t.update_to,
-        )
-    if not is_compressed:
-        return path
-    if is_zip:
-        with ZipFile(path, "r") as zip_ref:
-            topmost_names = [name for name in zip_ref.namelist() if "/" not in name]
-            if topmost_names == [name]:
-                dst = root
-            else:
-                dst = uncompressed_folder_path
-            zip_ref.extractall(dst)
-    elif is_tar:
-        with tarfile.open(path) as tar_ref:
-            topmost_names = [name for name in tar_ref.getnames() if "/" not in name]
-            if topmost_names == [name]:
-                dst = root
-            else:
-                dst = uncompressed_folder_path
-            tar_ref.extractall(dst)
-    else:
-        raise RuntimeError(f"unknown compressed file type: {file.suffix}")
-    if remove_compressed:
-        path.unlink()
-    return uncompressed_folder_path
+    with trace(f"download {name}", "download", url=url):
+        cache = get_download_cache() if use_cache else None
+        # archives will be removed after extraction, so it is safe to hardlink them
+        link = is_compressed and remove_compressed
+        restored = False
+        if cache is not None:
+            restored = cache.restore(url, path, sha256=sha256, link=link)
+        if not restored and offline:
+            msg = f"'{url}' is not found in the download cache (offline mode)"
+            raise RuntimeError(msg)
+        if not restored and is_compressed and stream:
+            staging = root / f".{name}.partial"
+            names = _stream_download(url, staging, name, sha256, size)
+            if names is not None:
+                topmost_names = _get_topmost_names(names)
+                _move_extracted(staging, uncompressed_folder_path, topmost_names)
+                return uncompressed_folder_path
+            log(f"'{url}' cannot be extracted while downloading, downloading it first")
+        if not restored:
+            digest = download_file(
+                url,
+                path,
+                segments=segments,
+                desc=name,
+                sha256=sha256,
+                size=size,
+            )
+            if cache is not None:
+                cache.put(url, path, sha256=digest, link=link)
+        if not is_compressed:
+            return path
+        with trace(f"extract {name}", "extract", path=str(path)):
+            _extract(path, uncompressed_folder_path)
+        if remove_compressed:
+            path.unlink()
+        return uncompressed_folder_path
+
+
+class CopyStrategy(str, Enum):
+    AUTO = "auto"
+    HARDLINK = "hardlink"
+    REFLINK = "reflink"
+    COPY_FILE_RANGE = "copy_file_range"
+    SENDFILE = "sendfile"
+    COPY = "copy"
+
+
+# the `FICLONE` ioctl request on Linux, which is supported by btrfs / xfs / ...
+FICLONE = 0x40049409
+# strategies are tried in this order, starting from the selected one
+copy_strategies = [
+    CopyStrategy.HARDLINK,
+    CopyStrategy.REFLINK,
+    CopyStrategy.COPY_FILE_RANGE,
+    CopyStrategy.SENDFILE,
+    CopyStrategy.COPY,
+]
+
+
+def _reflink(src: Path, dst: Path) -> None:
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError("reflink is not supported on this platform")
+    with src.open("rb") as fsrc, dst.open("wb") as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
 
 
-def cp(src: Path, dst: Path) -> None:
+def _copy_file_range(src: Path, dst: Path) -> None:
+    if not hasattr(os, "copy_file_range"):
+        raise OSError("copy_file_range is not supported on this platform")
+    with src.open("rb") as fsrc, dst.open("wb") as fdst:
+        left = os.fstat(fsrc.fileno()).st_size
+        while left > 0:
+            n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), min(left, 1 << 30))
+            if n == 0:
+                raise OSError(f"copy_file_range stopped early at '{src}'")
+            left -= n
+
+
+def _sendfile(src: Path, dst: Path) -> None:
+    if not hasattr(os, "sendfile"):
+        raise OSError("sendfile is not supported on this platform")
+    with src.open("rb") as fsrc, dst.open("wb") as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        offset = 0
+        while offset < size:
+            n = os.sendfile(fdst.fileno(), fsrc.fileno(), offset, size - offset)
+            if n == 0:
+                raise OSError(f"sendfile stopped early at '{src}'")
+            offset += n
+
+
+copy_functions: Dict[CopyStrategy, Callable[[Path, Path], Any]] = {
+    CopyStrategy.HARDLINK: os.link,
+    CopyStrategy.REFLINK: _reflink,
+    CopyStrategy.COPY_FILE_RANGE: _copy_file_range,
+    CopyStrategy.SENDFILE: _sendfile,
+    CopyStrategy.COPY: shutil.copyfile,
+}
+
+
+def copy_file(
+    src: Path,
+    dst: Path,
+    strategy: str = CopyStrategy.AUTO,
+) -> CopyStrategy:
+    """
+    Copy the file `src` to `dst` with `strategy`, returns the strategy actually used.
+
+    If the selected strategy is not supported (e.g. hardlinks across devices, or reflinks on
+    filesystems without copy-on-write), the following strategies in `copy_strategies` will
+    be tried instead. `auto` starts from `reflink`, because a hardlink shares its content
+    with `src`, so modifying `dst` in place will modify `src` as well.
+    """
+
+    strategy = CopyStrategy(strategy)
+    if strategy == CopyStrategy.AUTO:
+        strategy = CopyStrategy.REFLINK
+    for candidate in copy_strategies[copy_strategies.index(strategy) :]:
+        try:
+            copy_functions[candidate](src, dst)
+            break
+        except OSError:
+            # plain copying is the last resort, so its errors should be raised
+            if candidate == CopyStrategy.COPY:
+                raise
+            if dst.is_file():
+                dst.unlink()
+    if candidate != CopyStrategy.HARDLINK:
+        shutil.copystat(src, dst)
+    # hardlinks & reflinks share their contents with `src`, so nothing is copied
+    if candidate not in (CopyStrategy.HARDLINK, CopyStrategy.REFLINK):
+        add_count(COPIED_BYTES, dst.stat().st_size)
+    return candidate
+
+
+def cp(src: Path, dst: Path, strategy: str = CopyStrategy.AUTO) -> Dict[str, int]:
+    """Copy the file / directory `src` to `dst`, returns the usage count of each strategy."""
+
+    strategies: Dict[str, int] = {}
+
+    def _copy(src_file: str, dst_file: str) -> None:
+        used = copy_file(Path(src_file), Path(dst_file), strategy)
+        strategies[used.value] = strategies.get(used.value, 0) + 1
+
     if src.is_file():
-        shutil.copyfile(src, dst)
+        _copy(str(src), str(dst))
     else:
-        shutil.copytree(src, dst)
+        shutil.copytree(src, dst, copy_function=_copy)
+    return strategies
+
+
+def _scan_files(
+    root: Path,
+    ignores: Optional[List[str]],
+) -> Tuple[Dict[str, os.stat_result], List[str]]:
+    if root.is_file():
+        return {"": root.stat()}, []
+    files = {}
+    dirs: List[str] = []
+    for dirpath, dirnames, filenames in os.walk(root, followlinks=True):
+        if ignores and dirpath == str(root):
+            dirnames[:] = [name for name in dirnames if name not in ignores]
+            filenames = [name for name in filenames if name not in ignores]
+        rel_dir = Path(dirpath).relative_to(root).as_posix()
+        prefix = "" if rel_dir == "." else f"{rel_dir}/"
+        dirs.extend(f"{prefix}{name}" for name in dirnames)
+        for name in filenames:
+            files[f"{prefix}{name}"] = os.stat(os.path.join(dirpath, name))
+    return files, dirs
+
+
+def _remove_empty_parents(path: Path, root: Path) -> None:
+    parent = path.parent
+    while parent != root and root in parent.parents:
+        try:
+            parent.rmdir()
+        except OSError:
+            break
+        parent = parent.parent
+
+
+def sync(
+    src: Path,
+    dst: Path,
+    manifest_path: Path,
+    *,
+    ignores: Optional[List[str]] = None,
+    use_hash: bool = False,
+    strategy: str = CopyStrategy.AUTO,
+) -> Dict[str, Any]:
+    """
+    Incrementally sync `src` (a file or a directory) to `dst`, like `rsync`.
+
+    The relative path, size and mtime (and sha256, if `use_hash` is `True`) of every synced
+    file are recorded in the manifest at `manifest_path`, so only new or changed files will
+    be copied next time, and files that were removed from `src` will be deleted from `dst`.
+    Files in `dst` which are not tracked by the manifest are left untouched.
+
+    `use_hash` should be `True` if `src` is re-created on every run (e.g. downloaded or
+    cloned to a temporary directory), since the mtimes will always change in this case.
+
+    Files are copied with `copy_file` and `strategy`.
 
+    Returns the number of `copied` / `skipped` / `deleted` files, the `copied_bytes`, and
+    the usage count of each copy strategy (`strategies`).
+    """
+
+    old_files: Dict[str, Dict[str, Any]] = {}
+    if manifest_path.is_file():
+        with manifest_path.open("r") as f:
+            old_files = json.load(f).get("files", {})
+    files, dirs = _scan_files(src, ignores)
+    for rel in dirs:
+        (dst / rel).mkdir(parents=True, exist_ok=True)
+    stats = dict(copied=0, skipped=0, deleted=0, copied_bytes=0)
+    strategies: Dict[str, int] = {}
+    new_files = {}
+    for rel, stat in files.items():
+        src_path = src / rel if rel else src
+        dst_path = dst / rel if rel else dst
+        entry: Dict[str, Any] = dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+        old_entry = old_files.get(rel)
+        if old_entry is None or old_entry["size"] != stat.st_size:
+            changed = True
+            if use_hash:
+                entry["sha256"] = hash_file(src_path)
+        elif use_hash:
+            entry["sha256"] = hash_file(src_path)
+            changed = old_entry.get("sha256") != entry["sha256"]
+        else:
+            changed = old_entry["mtime_ns"] != stat.st_mtime_ns
+        if not changed:
+            # `dst` might be modified or removed outside of the manifest
+            changed = not dst_path.is_file() or dst_path.stat().st_size != stat.st_size
+        if not changed:
+            stats["skipped"] += 1
+        else:
+            dst_path.parent.mkdir(parents=True, exist_ok=True)
+            # unlink first, so files which share content with others are not modified
+            if dst_path.is_file() or dst_path.is_symlink():
+                dst_path.unlink()
+            used = copy_file(src_path, dst_path, strategy).value
+            strategies[used] = strategies.get(used, 0) + 1
+            stats["copied"] += 1
+            stats["copied_bytes"] += stat.st_size
+        new_files[rel] = entry
+    for rel in old_files:
+        if rel in files:
+            continue
+        dst_path = dst / rel if rel else dst
+        if dst_path.is_file():
+            dst_path.unlink()
+            _remove_empty_parents(dst_path, dst)
+            stats["deleted"] += 1
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_manifest_path = manifest_path.with_name(f"{manifest_path.name}.tmp")
+    with tmp_manifest_path.open("w") as f:
+        json.dump(dict(src=str(src), dst=str(dst), files=new_files), f)
+    tmp_manifest_path.replace(manifest_path)
+    return dict(**stats, strategies=strategies)
+
+
+def get_stat_signature(
+    path: Path,
+    ignores: Optional[List[str]] = None,
+) -> Optional[str]:
+    """
+    Returns a cheap signature of `path` (a file or a directory), which is based on the
+    sizes and the modification times of the files, or `None` if `path` does not exist.
+
+    Top-level files / directories whose names are in `ignores` are not included.
+    """
+
+    if path.is_file():
+        stat = path.stat()
+        return f"{stat.st_size}-{stat.st_mtime_ns}"
+    if not path.is_dir():
+        return None
+    sha256 = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        if ignores and root == str(path):
+            dirs[:] = [name for name in dirs if name not in ignores]
+            files = [name for name in files if name not in ignores]
+        dirs.sort()
+        for file in sorted(files):
+            file_path = Path(root) / file
+            try:
+                stat = file_path.stat()
+            except OSError:
+                # e.g. dangling symlinks
+                stat = file_path.lstat()
+            rel = file_path.relative_to(path).as_posix()
+            sha256.update(f"{rel}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+    return sha256.hexdigest()
+
+
+_git_mirror_lock = threading.Lock()
+
+
+def _git(
+    *args: str,
+    cwd: Optional[Path] = None,
+    env: Optional[Dict[str, str]] = None,
+) -> bool:
+    return traced_run(["git", *args], cwd=cwd, env=env).returncode == 0
+
+
+def _has_git_lfs() -> bool:
+    cmd = ["git", "lfs", "version"]
+    return subprocess.run(cmd, capture_output=True).returncode == 0
+
+
+def _update_git_mirror(url: str, offline: bool) -> Path:
+    mirror = GIT_CACHE_DIR / hashlib.sha256(url.encode()).hexdigest()
+    with _git_mirror_lock:
+        if offline:
+            if not mirror.is_dir():
+                raise RuntimeError(f"git mirror of '{url}' is not found (offline mode)")
+            log(f"using git mirror of '{url}' without updating it (offline mode)")
+        elif mirror.is_dir():
+            log(f"updating git mirror of '{url}'")
+            if not _git("remote", "update", "--prune", cwd=mirror):
+                raise RuntimeError(f"failed to update the git mirror of '{url}'")
+        else:
+            log(f"creating git mirror of '{url}'")
+            GIT_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            tmp_mirror = mirror.with_name(f"{mirror.name}.partial")
+            if tmp_mirror.is_dir():
+                shutil.rmtree(tmp_mirror)
+            if not _git("clone", "--mirror", url, str(tmp_mirror)):
+                raise RuntimeError(f"failed to mirror '{url}'")
+            # allows partial clones / fetching any commit from the mirror
+            for key in ["uploadpack.allowFilter", "uploadpack.allowAnySHA1InWant"]:
+                _git("config", key, "true", cwd=tmp_mirror)
+            tmp_mirror.replace(mirror)
+    return mirror
+
+
+def git_clone(
+    url: str,
+    dst: Path,
+    *,
+    ref: Optional[str] = None,
+    depth: Optional[int] = None,
+    filter_spec: Optional[str] = None,
+    mirror: bool = False,
+    lfs_concurrency: int = GIT_LFS_CONCURRENT_TRANSFERS,
+    offline: bool = False,
+) -> Path:
+    """
+    Clone the git repository at `url` to `dst`.
+
+    * `ref` pins the clone to a branch, tag or commit, which will be checked out detached.
+    * `depth` / `filter_spec` are passed to `--depth` / `--filter` (e.g. `1` / `blob:none`), so
+    history and blobs that are not needed will not be downloaded.
+    * if `mirror` is `True`, a bare mirror of `url` is kept under `GIT_CACHE_DIR`, and is
+    updated with a fetch before cloning from it locally. The `origin` of the clone still
+    points to `url`.
+
+    LFS objects are not downloaded one by one during the checkout, but by a single
+    `git lfs pull` with `lfs_concurrency` concurrent transfers afterwards.
+
+    If `offline` is `True`, the clone can only be made from an existing mirror, which will
+    not be updated, and LFS objects will not be pulled.
+    """
 
-def git_clone(url: str, dst: Path) -> Path:
     if dst.is_dir():
         log(f"'{dst}' already exists, skipping")
         return dst
-    subprocess.run(["git", "lfs", "install"])
-    if subprocess.run(["git", "clone", url, str(dst)]).returncode != 0:
-        raise RuntimeError(f"failed to clone '{url}'")
+    if offline and not mirror:
+        raise RuntimeError(f"cannot clone '{url}' without a git mirror (offline mode)")
+    source = url
+    if mirror:
+        source = _update_git_mirror(url, offline).absolute().as_uri()
+    options = []
+    if depth is not None:
+        options.append(f"--depth={depth}")
+    if filter_spec is not None:
+        options.append(f"--filter={filter_spec}")
+    env = dict(os.environ, GIT_LFS_SKIP_SMUDGE="1")
+    if ref is None:
+        if not _git("clone", *options, source, str(dst), env=env):
+            raise RuntimeError(f"failed to clone '{url}'")
+    else:
+        dst.mkdir(parents=True)
+        if not (
+            _git("init", "--quiet", cwd=dst)
+            and _git("remote", "add", "origin", source, cwd=dst)
+            and _git("fetch", *options, "origin", ref, cwd=dst, env=env)
+            and _git("checkout", "--quiet", "FETCH_HEAD", cwd=dst, env=env)
+        ):
+            raise RuntimeError(f"failed to clone '{ref}' of '{url}'")
+    if mirror and not _git("remote", "set-url", "origin", url, cwd=dst):
+        raise RuntimeError(f"failed to set the remote url of '{dst}'")
+    if offline:
+        log("LFS objects will not be downloaded (offline mode)")
+    elif not _has_git_lfs():
+        log("`git lfs` is not available, LFS objects will not be downloaded")
+    else:
+        lfs_config = f"lfs.concurrenttransfers={lfs_concurrency}"
+        if not (
+            _git("lfs", "install", "--local", cwd=dst)
+            and _git("-c", lfs_config, "lfs", "pull", cwd=dst)
+        ):
+            raise RuntimeError(f"failed to pull LFS objects of '{url}'")
     return dst
 
 
+def parse_git_requirement(requirement: str) -> Tuple[str, str, Optional[str], str]:
+    """
+    Split a pip git requirement (e.g. `name @ git+https://host/repo.git@ref#egg=name`)
+    into `(prefix, url, ref, fragment)`, where `prefix` is the `name @ ` part (if any).
+    Plain urls (without `git+`) are treated as git urls as well.
+    """
+
+    name, sep, spec = requirement.rpartition(" @ ")
+    spec = spec.strip()
+    if spec.startswith("git+"):
+        spec = spec[len("git+") :]
+    spec, _, fragment = spec.partition("#")
+    rest = spec.partition("://")[2] or spec
+    path_start = rest.find("/")
+    ref = None
+    if path_start >= 0 and "@" in rest[path_start:]:
+        spec, ref = spec.rsplit("@", 1)
+    return f"{name}{sep}", spec, ref, fragment
+
+
+def resolve_git_commit(url: str, ref: Optional[str] = None) -> str:
+    """Returns the commit that `ref` (defaults to `HEAD`) of the git repository points to."""
+
+    if ref is not None and re.fullmatch(r"[0-9a-fA-F]{7,40}", ref):
+        return ref.lower()
+    cmd = ["git", "ls-remote", url, ref or "HEAD"]
+    if ref is not None:
+        # peeled tags are only listed if they are asked for
+        cmd.append(f"{ref}^{{}}")
+    result = traced_run(cmd, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"failed to resolve '{ref or 'HEAD'}' of '{url}'")
+    refs = dict(line.split("\t")[::-1] for line in result.stdout.splitlines() if line)
+    if not refs:
+        raise RuntimeError(f"'{ref}' is not found in '{url}'")
+    # annotated tags are resolved to the commits they point to
+    for name in [f"refs/tags/{ref}^{{}}", f"refs/tags/{ref}", f"refs/heads/{ref}"]:
+        if name in refs:
+            return refs[name]
+    return list(refs.values())[0]
+
+
+# runs in the target interpreter, and uses the `packaging` vendored by its `pip`
+_check_requirements_script = """
+import sys
+import json
+from importlib import metadata
+from pip._vendor.packaging.utils import canonicalize_name
+from pip._vendor.packaging.requirements import Requirement
+from pip._vendor.packaging.requirements import InvalidRequirement
+
+installed = {}
+for dist in metadata.distributions():
+    name = dist.metadata["Name"]
+    if name:
+        installed.setdefault(canonicalize_name(name), dist)
+
+
+def check(req, extras, seen):
+    if req.marker is not None:
+        envs = [{"extra": extra} for extra in [""] + sorted(extras)]
+        if not any(req.marker.evaluate(env) for env in envs):
+            return True
+    if req.url:
+        return False
+    name = canonicalize_name(req.name)
+    dist = installed.get(name)
+    if dist is None:
+        return False
+    if not req.specifier.contains(dist.version, prereleases=True):
+        return False
+    key = name, tuple(sorted(req.extras))
+    if key in seen:
+        return True
+    seen.add(key)
+    return all(check(Requirement(dep), req.extras, seen) for dep in dist.requires or [])
+
+
+def check_str(req_str):
+    try:
+        req = Requirement(req_str)
+    except InvalidRequirement:
+        return False
+    return check(req, set(), set())
+
+
+print(json.dumps([check_str(req_str) for req_str in json.load(sys.stdin)]))
+"""
+
+
+def check_requirements(executable: str, requirements: List[str]) -> List[bool]:
+    """
+    Check whether each of the `requirements` (PEP 508 strings) is already satisfied in the
+    environment of `executable`, together with its dependencies, by running `executable`
+    only once to read the metadata of the installed distributions.
+
+    Requirements are treated as not satisfied if they cannot be checked for any reason.
+    """
+
+    if not requirements:
+        return []
+    result = traced_run(
+        [executable, "-c", _check_requirements_script],
+        input=json.dumps(requirements),
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        log(f"failed to check installed requirements: {result.stderr.strip()}")
+        return [False] * len(requirements)
+    return json.loads(result.stdout)
+
+
 def hijack_file(path: Path, callback: Callable[[str], str]) -> None:
     with path.open("r") as f:
         lines = f.readlines()
     for i, line in enumerate(lines):
         lines[i] = callback(line)
-    with path.open("w") as f:
+    # replace instead of writing in place, in case `path` is hardlinked to its source
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    with tmp_path.open("w") as f:
         f.writelines(lines)
+    shutil.copymode(path, tmp_path)
+    tmp_path.replace(path)
 
 
 def hijack_cmds(cmds: List[str], pip_cmd: List[str], executable: str) -> List[str]:
@@ -0,0 +1,317 @@
+import os
+import sys
+import json
+import time
+import threading
+import subprocess
+
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Callable
+from typing import Iterator
+from typing import Optional
+from pathlib import Path
+from contextlib import contextmanager
+from contextvars import copy_context
+from contextvars import ContextVar
+from concurrent.futures import Future
+from concurrent.futures import Executor
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    # `resource` is not available on Windows, so peak RSS will not be recorded
+    resource = None  # type: ignore
+
+
+DOWNLOADED_BYTES = "downloaded_bytes"
+COPIED_BYTES = "copied_bytes"
+
+
+def _get_peak_rss() -> Optional[int]:
+    """Returns the peak RSS (in bytes) of this process and its (waited) children."""
+
+    if resource is None:
+        return None
+    # `ru_maxrss` is in kilobytes on Linux, but in bytes on macOS
+    unit = 1 if sys.platform == "darwin" else 1024
+    peak_self = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(peak_self, peak_children) * unit
+
+
+def _get_children_cpu() -> Optional[float]:
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Span:
+    """
+    A traced operation. `cpu` is the CPU time of the thread which runs the span, and
+    `counters` accumulate the counters (e.g. `downloaded_bytes`) of the span and of all
+    the spans nested in it, including the ones which run in other threads.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        category: str,
+        args: Dict[str, Any],
+        parent: Optional["Span"],
+    ):
+        self.name = name
+        self.category = category
+        self.args = args
+        self.parent = parent
+        self.tid = threading.get_ident()
+        self.thread_name = threading.current_thread().name
+        self.start = time.perf_counter()
+        self.end: Optional[float] = None
+        self.cpu = 0.0
+        self.peak_rss: Optional[int] = None
+        self.counters: Dict[str, int] = {}
+
+    @property
+    def wall(self) -> float:
+        return (self.end or time.perf_counter()) - self.start
+
+    @property
+    def block(self) -> Optional[str]:
+        span: Optional[Span] = self
+        while span is not None:
+            if span.category == "block":
+                return span.name
+            span = span.parent
+        return None
+
+    def to_summary(self) -> Dict[str, Any]:
+        return dict(
+            name=self.name,
+            category=self.category,
+            block=self.block,
+            wall=round(self.wall, 6),
+            cpu=round(self.cpu, 6),
+            peak_rss=self.peak_rss,
+            **self.counters,
+        )
+
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("cfport_span", default=None)
+
+
+class Tracer:
+    """
+    Records the spans of a packaging run (thread-safe), which can be exported as a
+    Chrome trace-event file (open it with `chrome://tracing` or https://ui.perfetto.dev)
+    and as a summary of the blocks & the hotspots.
+    """
+
+    def __init__(self) -> None:
+        self.spans: List[Span] = []
+        self.counters: Dict[str, int] = {}
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.start_cpu = time.process_time()
+        self.start_children_cpu = _get_children_cpu()
+        self.end: Optional[float] = None
+        self.end_cpu: Optional[float] = None
+        self.end_children_cpu: Optional[float] = None
+
+    @contextmanager
+    def span(self, name: str, category: str, **args: Any) -> Iterator[Span]:
+        span = Span(name, category, args, _current_span.get())
+        token = _current_span.set(span)
+        start_cpu = time.thread_time()
+        try:
+            yield span
+        finally:
+            span.cpu = time.thread_time() - start_cpu
+            span.end = time.perf_counter()
+            span.peak_rss = _get_peak_rss()
+            _current_span.reset(token)
+            with self.lock:
+                self.spans.append(span)
+
+    def count(self, name: str, value: int) -> None:
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+            span = _current_span.get()
+            while span is not None:
+                span.counters[name] = span.counters.get(name, 0) + value
+                span = span.parent
+
+    def stop(self) -> None:
+        self.end = time.perf_counter()
+        self.end_cpu = time.process_time()
+        self.end_children_cpu = _get_children_cpu()
+
+    def to_chrome_trace(self) -> Dict[str, Any]:
+        pid = os.getpid()
+        events: List[Dict[str, Any]] = []
+        thread_names: Dict[int, str] = {}
+        with self.lock:
+            spans = sorted(self.spans, key=lambda s: s.start)
+        for span in spans:
+            thread_names.setdefault(span.tid, span.thread_name)
+            args = dict(span.args, cpu=round(span.cpu, 6), **span.counters)
+            if span.peak_rss is not None:
+                args["peak_rss"] = span.peak_rss
+            events.append(
+                dict(
+                    name=span.name,
+                    cat=span.category,
+                    ph="X",
+                    ts=round((span.start - self.start) * 1.0e6, 3),
+                    dur=round(span.wall * 1.0e6, 3),
+                    pid=pid,
+                    tid=span.tid,
+                    args=args,
+                )
+            )
+        for tid, thread_name in thread_names.items():
+            args = dict(name=thread_name)
+            events.append(dict(name="thread_name", ph="M", pid=pid, tid=tid, args=args))
+        return dict(traceEvents=events, displayTimeUnit="ms")
+
+    def summarize(self, top: int = 10) -> Dict[str, Any]:
+        """
+        Returns the totals of the run, the metrics of each block, the metrics aggregated
+        by category (e.g. `subprocess`, `download`), and the `top` slowest operations.
+        """
+
+        end = self.end or time.perf_counter()
+        end_cpu = self.end_cpu or time.process_time()
+        total = dict(
+            wall=round(end - self.start, 6),
+            cpu=round(end_cpu - self.start_cpu, 6),
+            peak_rss=_get_peak_rss(),
+            **self.counters,
+        )
+        end_children_cpu = self.end_children_cpu or _get_children_cpu()
+        if self.start_children_cpu is not None and end_children_cpu is not None:
+            total["children_cpu"] = round(end_children_cpu - self.start_children_cpu, 6)
+        with self.lock:
+            spans = sorted(self.spans, key=lambda s: s.start)
+        blocks = {}
+        categories: Dict[str, Dict[str, Any]] = {}
+        operations = []
+        for span in spans:
+            if span.category == "block":
+                blocks[span.name] = span.to_summary()
+                continue
+            operations.append(span)
+            stats = categories.setdefault(span.category, dict(count=0, wall=0.0))
+            stats["count"] += 1
+            stats["wall"] = round(stats["wall"] + span.wall, 6)
+            for k, v in span.counters.items():
+                stats[k] = stats.get(k, 0) + v
+        operations.sort(key=lambda s: s.wall, reverse=True)
+        return dict(
+            total=total,
+            blocks=blocks,
+            categories=categories,
+            hotspots=[span.to_summary() for span in operations[:top]],
+        )
+
+    def dump(self, folder: Path) -> Dict[str, Any]:
+        """Writes `trace.json` & `summary.json` to `folder`, returns the summary."""
+
+        folder.mkdir(parents=True, exist_ok=True)
+        with (folder / "trace.json").open("w") as f:
+            json.dump(self.to_chrome_trace(), f)
+        summary = self.summarize()
+        with (folder / "summary.json").open("w") as f:
+            json.dump(summary, f, indent=2)
+        return summary
+
+
+_tracer: Optional[Tracer] = None
+
+
+def start_tracing() -> Tracer:
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+
+def stop_tracing() -> Optional[Tracer]:
+    global _tracer
+    tracer = _tracer
+    _tracer = None
+    if tracer is not None:
+        tracer.stop()
+    return tracer
+
+
+def get_tracer() -> Optional[Tracer]:
+    return _tracer
+
+
+@contextmanager
+def trace(name: str, category: str, **args: Any) -> Iterator[Optional[Span]]:
+    """Traces the enclosed operation, which is a no-op if tracing is not started."""
+
+    tracer = _tracer
+    if tracer is None:
+        yield None
+    else:
+        with tracer.span(name, category, **args) as span:
+            yield span
+
+
+def add_count(name: str, value: int) -> None:
+    """Adds `value` to the counter `name` of the current span (and of its ancestors)."""
+
+    tracer = _tracer
+    if tracer is not None:
+        tracer.count(name, value)
+
+
+def traced_submit(
+    executor: Executor,
+    fn: Callable,
+    *args: Any,
+    **kwargs: Any,
+) -> Future:
+    """
+    `executor.submit`, but `fn` runs in the current context, so the spans it creates are
+    nested in the current span.
+    """
+
+    return executor.submit(copy_context().run, fn, *args, **kwargs)
+
+
+def traced_run(cmd: List[Any], **kwargs: Any) -> subprocess.CompletedProcess:
+    """`subprocess.run`, but traced as a `subprocess` span."""
+
+    args = [str(arg) for arg in cmd]
+    name = " ".join([Path(args[0]).name] + args[1:3])
+    with trace(name, "subprocess", cmd=args) as span:
+        start_children_cpu = _get_children_cpu()
+        result = subprocess.run(cmd, **kwargs)
+        end_children_cpu = _get_children_cpu()
+        if span is not None:
+            span.args["returncode"] = result.returncode
+            if start_children_cpu is not None and end_children_cpu is not None:
+                # other subprocesses may exit meanwhile, so this is an approximation
+                children_cpu = end_children_cpu - start_children_cpu
+                span.args["children_cpu"] = round(children_cpu, 6)
+        return result
+
+
+__all__ = [
+    "DOWNLOADED_BYTES",
+    "COPIED_BYTES",
+    "Span",
+    "Tracer",
+    "start_tracing",
+    "stop_tracing",
+    "get_tracer",
+    "trace",
+    "add_count",
+    "traced_submit",
+    "traced_run",
+]
@@ -0,0 +1,251 @@
+import json
+import time
+import hashlib
+import tempfile
+import threading
+
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from pathlib import Path
+from cftool.console import log
+from cftool.console import warn
+from concurrent.futures import ThreadPoolExecutor
+
+from .cache import hash_file
+from .installer import IInstaller
+from .installer import PipInstaller
+from .constants import WHEELHOUSE_DIR
+from .constants import SOURCE_BUILD_WORKERS
+from .tracing import traced_run
+from .tracing import traced_submit
+
+
+_python_tags: Dict[str, str] = {}
+
+
+def get_python_tag(executable: str) -> str:
+    """Returns the version and the platform of the interpreter at `executable`."""
+
+    tag = _python_tags.get(executable)
+    if tag is None:
+        cmd = "import sys, sysconfig; print(sys.version, sysconfig.get_platform())"
+        result = traced_run(
+            [executable, "-c", cmd],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        tag = _python_tags[executable] = result.stdout.strip()
+    return tag
+
+
+def get_requirements_key(pip_cmd: List[str], args_list: List[List[str]]) -> str:
+    """
+    Returns the key of the `pip install` arguments in `args_list`, which changes whenever
+    the arguments, the contents of the requirement files or the target interpreter change.
+    """
+
+    files = {}
+    for args in args_list:
+        for i, arg in enumerate(args[:-1]):
+            if arg in ("-r", "--requirement"):
+                path = Path(args[i + 1])
+                if path.is_file():
+                    files[args[i + 1]] = hash_file(path)
+    python = get_python_tag(pip_cmd[0])
+    info = dict(python=python, args=args_list, files=files)
+    return hashlib.sha256(json.dumps(info, sort_keys=True).encode()).hexdigest()
+
+
+class Wheelhouse:
+    """
+    A user-level directory of wheels, shared across workspaces.
+
+    Every set of requirements is downloaded (or built) into wheels by `pip wheel` once,
+    and then installed from the wheelhouse by the `installer` (`pip` by default).
+    The sha256 of every wheel is recorded in `index.json`, together with the exact wheels
+    that each set of requirements (keyed by the arguments, the contents of the requirement
+    files and the target interpreter) resolved to, so they can be installed offline later.
+
+    When online, `pip wheel` still resolves the requirements against the index, but wheels
+    that already exist in the wheelhouse are preferred over (and not downloaded from) the
+    index, so only new wheels will be downloaded.
+
+    Source requirements (e.g. git repositories, sdists) can also be built into wheels in
+    parallel by `build_sources`, and these wheels are cached under `sources/` by the
+    hashes of their sources.
+    """
+
+    def __init__(
+        self,
+        root: Path = WHEELHOUSE_DIR,
+        installer: Optional[IInstaller] = None,
+    ):
+        self.root = root
+        self.installer = installer or PipInstaller()
+        self.index_path = root / "index.json"
+        self.lock = threading.Lock()
+
+    def _load_index(self) -> Dict[str, Any]:
+        if not self.index_path.is_file():
+            return dict(wheels={}, requirements={})
+        with self.index_path.open("r") as f:
+            return json.load(f)
+
+    def _dump_index(self, index: Dict[str, Any]) -> None:
+        tmp_index_path = self.index_path.with_name(f"{self.index_path.name}.tmp")
+        with tmp_index_path.open("w") as f:
+            json.dump(index, f, indent=2)
+        tmp_index_path.replace(self.index_path)
+
+    def resolve(self, key: str) -> Optional[List[Path]]:
+        """Returns the wheels that `key` resolved to, or `None` if any of them is missing."""
+
+        names = self._load_index()["requirements"].get(key)
+        if names is None:
+            return None
+        wheels = [self.root / name for name in names]
+        if not all(wheel.is_file() for wheel in wheels):
+            return None
+        return wheels
+
+    def build(self, pip_cmd: List[str], args: List[str], key: str) -> List[Path]:
+        """Download / build the wheels of `args` into the wheelhouse, returns them."""
+
+        self.root.mkdir(parents=True, exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=self.root, prefix=".tmp") as tmp_dir:
+            wheel_cmd = pip_cmd + ["wheel", "--wheel-dir", tmp_dir]
+            wheel_cmd += ["--find-links", str(self.root)]
+            if traced_run(wheel_cmd + args).returncode != 0:
+                raise RuntimeError(f"failed to build wheels for {args}")
+            built = sorted(Path(tmp_dir).glob("*.whl"))
+            with self.lock:
+                index = self._load_index()
+                for wheel in built:
+                    sha256 = hash_file(wheel)
+                    existing = index["wheels"].get(wheel.name)
+                    dst = self.root / wheel.name
+                    if existing is not None and dst.is_file():
+                        if existing != sha256:
+                            warn(f"'{wheel.name}' is rebuilt with a different sha256")
+                        continue
+                    wheel.replace(dst)
+                    index["wheels"][wheel.name] = sha256
+                index["requirements"][key] = [wheel.name for wheel in built]
+                self._dump_index(index)
+        return [self.root / wheel.name for wheel in built]
+
+    def _build_source(
+        self,
+        pip_cmd: List[str],
+        requirement: str,
+        cache_dir: Path,
+    ) -> Path:
+        t = time.time()
+        sources_dir = cache_dir.parent
+        with tempfile.TemporaryDirectory(dir=sources_dir, prefix=".tmp") as tmp_dir:
+            wheel_dir = Path(tmp_dir) / "wheels"
+            cmd = pip_cmd + ["wheel", "--no-deps", "--wheel-dir", str(wheel_dir)]
+            # outputs are captured, otherwise concurrent builds will be interleaved
+            result = traced_run(cmd + [requirement], capture_output=True, text=True)
+            if result.returncode != 0:
+                raise RuntimeError(
+                    f"failed to build '{requirement}':\n{result.stdout}{result.stderr}"
+                )
+            built = list(wheel_dir.glob("*.whl"))
+            if len(built) != 1:
+                raise RuntimeError(f"expected 1 wheel of '{requirement}', got {built}")
+            try:
+                wheel_dir.replace(cache_dir)
+            except OSError:
+                # the same source might be built by another process at the same time
+                if not cache_dir.is_dir():
+                    raise
+        log(f"built '{built[0].name}' in {time.time() - t:.2f}s")
+        return cache_dir / built[0].name
+
+    def build_sources(
+        self,
+        pip_cmd: List[str],
+        sources: Dict[str, str],
+        *,
+        workers: int = SOURCE_BUILD_WORKERS,
+    ) -> Dict[str, Path]:
+        """
+        Build the source requirements into wheels, returns the wheel of each requirement.
+
+        `sources` maps each requirement (in the format of `pip wheel`) to the hash of its
+        source (e.g. the git commit, or the sha256 of the sdist). Every requirement is built
+        by its own `pip wheel --no-deps` process, at most `workers` at a time, and the wheels
+        are cached by the source hashes and the target interpreter, so unchanged sources
+        will never be built again.
+        """
+
+        python = get_python_tag(pip_cmd[0])
+        sources_dir = self.root / "sources"
+        wheels: Dict[str, Path] = {}
+        jobs: Dict[str, Path] = {}
+        for requirement, source_hash in sources.items():
+            info = dict(source=source_hash, python=python)
+            key = hashlib.sha256(json.dumps(info, sort_keys=True).encode()).hexdigest()
+            cache_dir = sources_dir / key
+            cached = sorted(cache_dir.glob("*.whl"))
+            if cached:
+                log(f"using the cached '{cached[0].name}' of '{requirement}'")
+                wheels[requirement] = cached[0]
+            else:
+                jobs[requirement] = cache_dir
+        if not jobs:
+            return wheels
+        sources_dir.mkdir(parents=True, exist_ok=True)
+        num_workers = max(1, min(workers, len(jobs)))
+        log(f"building {len(jobs)} source requirements with {num_workers} workers")
+        with ThreadPoolExecutor(num_workers) as executor:
+            futures = {
+                requirement: traced_submit(
+                    executor,
+                    self._build_source,
+                    pip_cmd,
+                    requirement,
+                    cache_dir,
+                )
+                for requirement, cache_dir in jobs.items()
+            }
+            for requirement, future in futures.items():
+                wheels[requirement] = future.result()
+        return wheels
+
+    def install(
+        self,
+        pip_cmd: List[str],
+        args: List[str],
+        *,
+        offline: bool = False,
+    ) -> None:
+        """
+        Install `args` from the wheelhouse. If `offline` is `True`, the wheels should have
+        been put into the wheelhouse by a previous (online) run.
+        """
+
+        key = get_requirements_key(pip_cmd, [args])
+        if not offline:
+            wheels = self.build(pip_cmd, args, key)
+        else:
+            resolved = self.resolve(key)
+            if resolved is None:
+                raise RuntimeError(
+                    f"wheels of {args} are not found in the wheelhouse, please package "
+                    "once without `offline` first"
+                )
+            log(f"installing {args} from the wheelhouse")
+            wheels = resolved
+        self.installer.install(wheels, pip_cmd=pip_cmd, executable=pip_cmd[0])
+
+
+__all__ = [
+    "Wheelhouse",
+    "get_python_tag",
+    "get_requirements_key",
+]
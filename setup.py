@@ -10,13 +10,14 @@ with open("README.md", encoding="utf-8") as f:
 setup(
     name=PACKAGE_NAME,
     version=VERSION,
-    packages=find_packages(exclude=("tests",)),
+    packages=find_packages(exclude=("tests", "tests.*")),
     include_package_data=True,
     entry_points={"console_scripts": ["cfport = cfport.cli:main"]},
     install_requires=[
         "click>=8.1.3",
         "carefree-toolkit>=0.3.10",
     ],
+    extras_require={"zstd": ["zstandard"]},
     author="carefree0910",
     author_email="syameimaru.saki@gmail.com",
     description=DESCRIPTION,
@@ -0,0 +1,106 @@
+"""
+Compares `shutil.make_archive` against `export_archive` (zip / tar.gz / tar.zst), on a
+synthetic workspace with many small source files, a few large compressible files and a
+few large incompressible ones (weights, wheels). Every archiver runs in its own process,
+so its peak memory (RSS) can be reported.
+
+    python -m tests.benchmarks.archive --small 20000 --large 4 --large-size 256
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+from pathlib import Path
+from importlib.util import find_spec
+
+from cfport.archive import export_archive
+from cfport.tracing import _get_peak_rss
+from cfport.constants import ARCHIVE_WORKERS
+
+
+def _make_workspace(
+    root: Path,
+    num_small: int,
+    num_large: int,
+    large_size: int,
+) -> None:
+    source = b"def f(x):\n    return x + 1\n" * 100
+    for i in range(num_small):
+        path = root / "lib" / f"pkg{i % 200}" / f"m{i}.py"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(source)
+    # half random (incompressible) and half repeated, like real binaries
+    half = large_size // 2
+    for i in range(num_large):
+        path = root / "lib" / f"large{i}.so"
+        path.write_bytes(os.urandom(half) + b"x" * (large_size - half))
+        weights = root / "models" / f"model{i}.safetensors"
+        weights.parent.mkdir(parents=True, exist_ok=True)
+        weights.write_bytes(os.urandom(large_size))
+
+
+def _run(args: argparse.Namespace) -> None:
+    root = Path(args.root)
+    if args.run == "workspace":
+        _make_workspace(root, args.small, args.large, args.large_size << 20)
+        return
+    dst = root.parent / "archives"
+    dst.mkdir(exist_ok=True)
+    t = time.perf_counter()
+    if args.run == "make_archive":
+        shutil.make_archive(str(dst / root.name), "zip", root.parent, root.name)
+    else:
+        path = dst / f"{root.name}.{args.run}"
+        export_archive(root, args.run, path, workers=args.workers)
+    elapsed = time.perf_counter() - t
+    print(json.dumps(dict(elapsed=elapsed, peak_rss=_get_peak_rss())))
+
+
+def _spawn(root: Path, mode: str) -> str:
+    # the peak RSS is inherited by the child processes, so everything (including the
+    # generation of the workspace) runs in child processes of this small one
+    cmd = [sys.executable, "-m", "tests.benchmarks.archive", *sys.argv[1:]]
+    cmd += ["--run", mode, "--root", str(root)]
+    return subprocess.run(cmd, capture_output=True, text=True, check=True).stdout
+
+
+def _measure(root: Path, mode: str) -> None:
+    result = json.loads(_spawn(root, mode).strip().splitlines()[-1])
+    peak_rss = result["peak_rss"]
+    peak = "n/a" if peak_rss is None else f"{peak_rss / (1 << 20):.1f} MB"
+    print(f"{mode:<24} {result['elapsed']:8.2f}s    peak memory: {peak}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--small", type=int, default=20000, help="small files")
+    parser.add_argument("--large", type=int, default=4, help="large files (per kind)")
+    parser.add_argument("--large-size", type=int, default=256, help="MB per large file")
+    parser.add_argument("--workers", type=int, default=ARCHIVE_WORKERS)
+    parser.add_argument("--run", help=argparse.SUPPRESS)
+    parser.add_argument("--root", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run is not None:
+        _run(args)
+        return
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        root = Path(tmp_dir) / "workspace"
+        _spawn(root, "workspace")
+        total = sum(path.stat().st_size for path in root.rglob("*") if path.is_file())
+        print(f"workspace: {total / (1 << 20):.2f} MB, workers: {args.workers}")
+        modes = ["make_archive", "zip", "tar.gz"]
+        if find_spec("zstandard") is not None:
+            modes.append("tar.zst")
+        for mode in modes:
+            _measure(root, mode)
+            shutil.rmtree(root.parent / "archives")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""
+Compares the throughput of `download_file` (with 1 and several segments) against the
+former single-stream `urlretrieve`, on a local server whose connections are throttled.
+
+    python -m tests.benchmarks.download --size 64 --rate 8
+"""
+
+import os
+import time
+import argparse
+import tempfile
+import urllib.request
+
+from typing import Callable
+from pathlib import Path
+
+from cfport.toolkit import download_file
+from ..utils import FileServer
+
+
+def _measure(name: str, size: int, fn: Callable[[Path], None]) -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir) / "data.bin"
+        t = time.perf_counter()
+        fn(path)
+        elapsed = time.perf_counter() - t
+        assert path.stat().st_size == size
+    print(f"{name:<24} {elapsed:8.2f}s {size / elapsed / (1 << 20):8.2f} MB/s")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=64, help="file size (MB)")
+    parser.add_argument("--rate", type=float, default=8.0, help="MB/s per connection")
+    parser.add_argument("--segments", type=int, default=8)
+    args = parser.parse_args()
+    size = args.size << 20
+    data = os.urandom(size)
+    with FileServer({"data.bin": data}, rate=args.rate * (1 << 20)) as server:
+        url = server.url("data.bin")
+        _measure("urlretrieve", size, lambda p: urllib.request.urlretrieve(url, p))
+        _measure("segments=1", size, lambda p: download_file(url, p, segments=1))
+        _measure(
+            f"segments={args.segments}",
+            size,
+            lambda p: download_file(url, p, segments=args.segments),
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Compares `ZipFile.extractall` against the parallel zip extraction, on a synthetic archive
+with many small files and a few huge ones.
+
+    python -m tests.benchmarks.extract --small 20000 --huge 4 --huge-size 128
+"""
+
+import os
+import time
+import shutil
+import zipfile
+import argparse
+import tempfile
+
+from typing import Callable
+from pathlib import Path
+
+from cfport.toolkit import _extract_zip
+from cfport.constants import EXTRACT_WORKERS
+
+
+def _make_archive(path: Path, num_small: int, num_huge: int, huge_size: int) -> None:
+    # half random (incompressible) and half repeated, like real bundles
+    small = os.urandom(2048) + b"x" * 2048
+    huge = os.urandom(huge_size // 2) + b"x" * (huge_size - huge_size // 2)
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zip_ref:
+        for i in range(num_small):
+            zip_ref.writestr(f"bundle/small/{i % 100}/{i}.txt", small)
+        for i in range(num_huge):
+            zip_ref.writestr(f"bundle/huge/{i}.bin", huge)
+
+
+def _measure(name: str, archive: Path, fn: Callable[[Path], None]) -> None:
+    dst = archive.with_name("extracted")
+    t = time.perf_counter()
+    fn(dst)
+    elapsed = time.perf_counter() - t
+    shutil.rmtree(dst)
+    print(f"{name:<24} {elapsed:8.2f}s")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--small", type=int, default=20000, help="small files")
+    parser.add_argument("--huge", type=int, default=4, help="huge files")
+    parser.add_argument("--huge-size", type=int, default=128, help="MB per huge file")
+    parser.add_argument("--workers", type=int, default=EXTRACT_WORKERS)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        archive = Path(tmp_dir) / "bundle.zip"
+        _make_archive(archive, args.small, args.huge, args.huge_size << 20)
+        print(f"archive: {archive.stat().st_size / (1 << 20):.2f} MB")
+
+        def _serial(dst: Path) -> None:
+            with zipfile.ZipFile(archive, "r") as zip_ref:
+                zip_ref.extractall(dst)
+
+        def _parallel(dst: Path) -> None:
+            _extract_zip(archive, dst, args.workers)
+
+        _measure("extractall", archive, _serial)
+        _measure(f"parallel (workers={args.workers})", archive, _parallel)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Compares installing python requirements one by one against installing them in batches,
+on a local file-based package index (PEP 503) with `--requirements` packages, each of
+which depends on a few shared packages.
+
+    python -m tests.benchmarks.install --requirements 30
+"""
+
+import os
+import time
+import argparse
+import tempfile
+
+from types import SimpleNamespace
+from pathlib import Path
+
+from cfport.config import IConfig
+from cfport.executer.blocks.install import InstallPythonRequirementsBlock
+from cfport.executer.blocks.prepare import PreparePythonBlock
+from ..utils import make_venv
+from ..utils import make_wheel
+
+
+def _make_index(root: Path, num_requirements: int, num_shared: int) -> Path:
+    wheels = root / "wheels"
+    for i in range(num_shared):
+        for version in ["1.0", "1.1", "2.0"]:
+            make_wheel(wheels, f"shared{i}", version)
+    for i in range(num_requirements):
+        requires = [f"shared{(i + j) % num_shared}<2" for j in range(3)]
+        make_wheel(wheels, f"pkg{i}", requires=requires)
+    simple = root / "simple"
+    for wheel in wheels.iterdir():
+        project = simple / wheel.name.split("-")[0]
+        project.mkdir(parents=True, exist_ok=True)
+        with (project / "index.html").open("a") as f:
+            f.write(f'<a href="{wheel.absolute().as_uri()}">{wheel.name}</a>\n')
+    return simple
+
+
+def _measure(root: Path, num_requirements: int, batch: bool) -> float:
+    executable = make_venv(root / f"venv_{batch}")
+    block = InstallPythonRequirementsBlock()
+    prepare_python = SimpleNamespace(
+        executable=executable,
+        pip_cmd=[str(executable), "-m", "pip"],
+    )
+    block.previous = {PreparePythonBlock.__identifier__: prepare_python}
+    config = IConfig(
+        python_requirements=[f"pkg{i}" for i in range(num_requirements)],
+        batch_python_requirements=batch,
+    )
+    t = time.perf_counter()
+    block.build(config)
+    return time.perf_counter() - t
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requirements", type=int, default=30)
+    parser.add_argument("--shared", type=int, default=10, help="shared dependencies")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        root = Path(tmp_dir)
+        simple = _make_index(root, args.requirements, args.shared)
+        os.environ["PIP_INDEX_URL"] = simple.absolute().as_uri()
+        os.environ["PIP_EXTRA_INDEX_URL"] = ""
+        os.environ["PIP_DISABLE_PIP_VERSION_CHECK"] = "1"
+        os.environ["PIP_QUIET"] = "1"
+        one_by_one = _measure(root, args.requirements, False)
+        batched = _measure(root, args.requirements, True)
+        print(f"{'one by one':<24} {one_by_one:8.2f}s")
+        print(f"{'batched':<24} {batched:8.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Compares the `pip` installer backend against the parallel one, on a synthetic set of
+already resolved wheels (like the ones from a lock file or the wheelhouse). Notice that
+`pip` compiles the bytecode as well, which is left to the `precompile` block by the
+parallel backend.
+
+    python -m tests.benchmarks.installer --wheels 100 --files 200
+"""
+
+import os
+import time
+import argparse
+import tempfile
+
+from typing import Dict
+from typing import List
+from pathlib import Path
+
+from cfport.installer import IInstaller
+from ..utils import make_venv
+from ..utils import make_wheel
+
+
+def _make_wheels(root: Path, num_wheels: int, num_files: int) -> List[Path]:
+    wheels = []
+    for i in range(num_wheels):
+        files: Dict[str, str] = {f"pkg{i}/__init__.py": ""}
+        for j in range(num_files):
+            files[f"pkg{i}/m{j % 10}/f{j}.py"] = f"X = {j!r}\n" + "# padding\n" * 100
+        console_scripts = {f"pkg{i}": f"pkg{i}:main"}
+        wheels.append(
+            make_wheel(root, f"pkg{i}", files=files, console_scripts=console_scripts)
+        )
+    return wheels
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--wheels", type=int, default=100)
+    parser.add_argument("--files", type=int, default=200, help="files per wheel")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+    os.environ["PIP_DISABLE_PIP_VERSION_CHECK"] = "1"
+    os.environ["PIP_QUIET"] = "1"
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        root = Path(tmp_dir)
+        wheels = _make_wheels(root / "wheels", args.wheels, args.files)
+        size = sum(wheel.stat().st_size for wheel in wheels)
+        print(f"wheels: {len(wheels)}, {size / (1 << 20):.2f} MB")
+        results = []
+        for backend, kw in [("pip", {}), ("parallel", dict(workers=args.workers))]:
+            executable = make_venv(root / backend)
+            installer = IInstaller.make(backend, kw)
+            pip_cmd = [str(executable), "-m", "pip"]
+            t = time.perf_counter()
+            installer.install(wheels, pip_cmd=pip_cmd, executable=str(executable))
+            results.append((backend, time.perf_counter() - t))
+        for backend, elapsed in results:
+            print(f"{backend:<24} {elapsed:8.2f}s")
+
+
+if __name__ == "__main__":
+    main()
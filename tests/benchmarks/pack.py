@@ -0,0 +1,116 @@
+"""
+Compares importing pure-python packages from `site-packages` against importing them from
+the zip archive of `pack_pure_python`, on a synthetic venv with `--packages` packages of
+`--modules` modules each.
+
+Besides the import time, the `open` / `listdir` / `scandir` calls (and the distinct files
+which are opened) are counted by an audit hook, since the file system accesses dominate
+the import time on USB drives and network shares (while the page cache hides them on
+local disks). Notice that `zipimport` opens the archive for every module it reads. Linux / macOS only, since the packed archive is
+put on `sys.path` by the activation script of the venv.
+
+    python -m tests.benchmarks.pack --packages 50 --modules 40
+"""
+
+import json
+import argparse
+import statistics
+import subprocess
+
+from typing import Any
+from typing import Dict
+from typing import List
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from cfport.config import AutoConfig
+from cfport.installer import ParallelInstaller
+from cfport.executer.blocks.pack import PackPurePythonBlock
+from cfport.executer.blocks.prepare import PreparePythonBlock
+from ..utils import make_venv
+from ..utils import make_wheel
+
+
+_import_script = """
+import sys
+import json
+import time
+
+counts = dict(open=0, listdir=0, scandir=0)
+files = set()
+
+
+def _hook(event, args):
+    name = event.rpartition(".")[2]
+    if name in counts:
+        counts[name] += 1
+    if name == "open":
+        files.add(str(args[0]))
+
+
+sys.addaudithook(_hook)
+t = time.perf_counter()
+for i in range({packages}):
+    __import__(f"pkg{{i}}")
+elapsed = time.perf_counter() - t
+print(json.dumps(dict(elapsed=elapsed, files=len(files), **counts)))
+"""
+
+
+def _make_wheels(root: Path, num_packages: int, num_modules: int) -> List[Path]:
+    wheels = []
+    for i in range(num_packages):
+        imports = "".join(f"from . import m{j}\n" for j in range(num_modules))
+        files = {f"pkg{i}/__init__.py": imports}
+        for j in range(num_modules):
+            source = f"import os\nimport json\n\n\ndef f{j}(x):\n    return x + {j}\n"
+            files[f"pkg{i}/m{j}.py"] = source * 20
+        wheels.append(make_wheel(root, f"pkg{i}", files=files))
+    return wheels
+
+
+def _measure(root: Path, num_packages: int, runs: int) -> Dict[str, Any]:
+    script = _import_script.format(packages=num_packages)
+    activate = str(root / "bin" / "activate")
+    cmd = ["bash", "-c", 'source "$0" && exec python -c "$1"', activate, script]
+    results = []
+    # the first run writes the bytecode of the unpacked modules
+    for _ in range(runs + 1):
+        output = subprocess.run(cmd, capture_output=True, text=True, check=True)
+        results.append(json.loads(output.stdout))
+    return {k: statistics.median(r[k] for r in results[1:]) for k in results[0]}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--packages", type=int, default=50)
+    parser.add_argument("--modules", type=int, default=40, help="modules per package")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+    with TemporaryDirectory() as tmp_dir:
+        root = Path(tmp_dir)
+        wheels = _make_wheels(root / "wheels", args.packages, args.modules)
+        venv = root / "venv"
+        executable = make_venv(venv)
+        pip_cmd = [str(executable), "-m", "pip"]
+        ParallelInstaller().install(wheels, pip_cmd=pip_cmd, executable=str(executable))
+        unpacked = _measure(venv, args.packages, args.runs)
+        prepare_python = PreparePythonBlock()
+        prepare_python.root = venv
+        prepare_python.executable = executable
+        block = PackPurePythonBlock()
+        block.previous = {PreparePythonBlock.__identifier__: prepare_python}
+        block.build(
+            AutoConfig(workspace=str(root / "workspace"), pack_pure_python=True)
+        )
+        packed = _measure(venv, args.packages, args.runs)
+        for name, result in [("unpacked", unpacked), ("packed", packed)]:
+            print(
+                f"{name:<24} {result['elapsed']:8.3f}s    "
+                f"open: {result['open']:.0f} ({result['files']:.0f} files), "
+                f"listdir: {result['listdir']:.0f}, scandir: {result['scandir']:.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
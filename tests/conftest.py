@@ -0,0 +1,7 @@
+import os
+import tempfile
+
+
+# the caches (downloads, wheels, git mirrors, ...) of the tests should not touch the
+# user-level ones, and this should be done before `cfport` is imported
+os.environ["CFPORT_CACHE_DIR"] = tempfile.mkdtemp(prefix="cfport-tests-")
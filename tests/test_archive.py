@@ -0,0 +1,192 @@
+import os
+import io
+import gzip
+import tarfile
+import zipfile
+
+import pytest
+
+from typing import Any
+from typing import Dict
+from pathlib import Path
+from importlib.util import find_spec
+
+from cfport.toolkit import get_platform
+from cfport.toolkit import Platform
+from cfport.archive import get_archive_path
+from cfport.archive import export_archive
+from cfport.constants import ARCHIVE_MTIME
+from cfport.constants import WORKSPACE_META_DIR
+
+
+CHUNK_SIZE = 1 << 16
+formats = [
+    "zip",
+    "tar.gz",
+    pytest.param(
+        "tar.zst",
+        marks=pytest.mark.skipif(
+            find_spec("zstandard") is None,
+            reason="`zstandard` is required",
+        ),
+    ),
+]
+is_windows = get_platform() == Platform.WINDOWS
+
+
+def _make_workspace(root: Path) -> Path:
+    workspace = root / "workspace"
+    files = {
+        "app.py": b"print('hello')\n",
+        "empty.txt": b"",
+        # spans several chunks, compressible and incompressible parts are mixed
+        "data/large.txt": (b"0123456789" * 20000 + os.urandom(CHUNK_SIZE)) * 3,
+        "data/model.safetensors": os.urandom(3 * CHUNK_SIZE + 1),
+        "wheels/pkg-1.0-py3-none-any.whl": os.urandom(1000),
+        "lib/site-packages/pkg/__init__.py": b"X = 1\n" * 1000,
+        "bin/run": b"#!/bin/sh\necho run\n",
+        f"{WORKSPACE_META_DIR}/state.json": b"{}",
+    }
+    for name, data in files.items():
+        path = workspace / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+    (workspace / "empty_dir").mkdir()
+    if not is_windows:
+        (workspace / "bin" / "run").chmod(0o775)
+        (workspace / "app.py").chmod(0o600)
+        (workspace / "bin" / "link").symlink_to("run")
+        os.link(workspace / "app.py", workspace / "bin" / "app.py")
+    return workspace
+
+
+def _get_tree(root: Path) -> Dict[str, Any]:
+    # name -> contents of the files / targets of the links / `None` for directories
+    tree: Dict[str, Any] = {root.name: None}
+    for path in root.rglob("*"):
+        name = f"{root.name}/{path.relative_to(root).as_posix()}"
+        if path.is_symlink():
+            tree[name] = os.readlink(path)
+        elif path.is_dir():
+            tree[name] = None
+        else:
+            tree[name] = path.read_bytes()
+    return tree
+
+
+def _read_tar(tar_ref: tarfile.TarFile) -> Dict[str, Any]:
+    tree: Dict[str, Any] = {}
+    members = {member.name: member for member in tar_ref.getmembers()}
+    for name, member in members.items():
+        assert member.mtime == ARCHIVE_MTIME
+        assert member.uid == member.gid == 0
+        assert member.uname == member.gname == ""
+        if member.issym():
+            tree[name] = member.linkname
+        elif member.islnk():
+            tree[name] = tar_ref.extractfile(members[member.linkname]).read()  # type: ignore
+        elif member.isdir():
+            tree[name] = None
+        else:
+            tree[name] = tar_ref.extractfile(member).read()  # type: ignore
+    return tree
+
+
+def _read_archive(path: Path, archive_format: str) -> Dict[str, Any]:
+    if archive_format == "zip":
+        tree: Dict[str, Any] = {}
+        with zipfile.ZipFile(path, "r") as zip_ref:
+            assert zip_ref.testzip() is None
+            for info in zip_ref.infolist():
+                data = zip_ref.read(info)
+                mode = info.external_attr >> 16
+                if info.is_dir():
+                    tree[info.filename.rstrip("/")] = None
+                elif (mode & 0o170000) == 0o120000:
+                    tree[info.filename] = data.decode()
+                else:
+                    tree[info.filename] = data
+        return tree
+    if archive_format == "tar.gz":
+        with tarfile.open(path, "r:gz") as tar_ref:
+            return _read_tar(tar_ref)
+    import zstandard
+
+    with path.open("rb") as f:
+        data = zstandard.ZstdDecompressor().stream_reader(f).read()
+    with tarfile.open(fileobj=io.BytesIO(data), mode="r:") as tar_ref:
+        return _read_tar(tar_ref)
+
+
+@pytest.mark.parametrize("archive_format", formats)
+def test_export(tmp_path: Path, archive_format: str) -> None:
+    workspace = _make_workspace(tmp_path)
+    path = export_archive(workspace, archive_format, chunk_size=CHUNK_SIZE, workers=4)
+    assert path == get_archive_path(workspace, archive_format)
+    assert not path.with_name(f"{path.name}.tmp").exists()
+    expected = _get_tree(workspace)
+    # the meta directory is excluded by default
+    expected = {k: v for k, v in expected.items() if WORKSPACE_META_DIR not in k}
+    assert _read_archive(path, archive_format) == expected
+
+
+@pytest.mark.parametrize("archive_format", formats)
+def test_reproducible(tmp_path: Path, archive_format: str) -> None:
+    workspace = _make_workspace(tmp_path)
+    kw: Dict[str, Any] = dict(chunk_size=CHUNK_SIZE)
+    first = export_archive(workspace, archive_format, tmp_path / "0", workers=1, **kw)
+    # timestamps, the number of workers and the creation order do not matter
+    for path in workspace.rglob("*"):
+        if not path.is_symlink():
+            os.utime(path, (0, 0))
+    (workspace / "empty.txt").unlink()
+    (workspace / "empty.txt").write_bytes(b"")
+    second = export_archive(workspace, archive_format, tmp_path / "1", workers=4, **kw)
+    assert first.read_bytes() == second.read_bytes()
+    # but the contents do
+    (workspace / "empty.txt").write_bytes(b"x")
+    third = export_archive(workspace, archive_format, tmp_path / "2", workers=4, **kw)
+    assert first.read_bytes() != third.read_bytes()
+
+
+def test_zip_entries(tmp_path: Path) -> None:
+    workspace = _make_workspace(tmp_path)
+    path = export_archive(workspace, "zip", chunk_size=CHUNK_SIZE)
+    with zipfile.ZipFile(path, "r") as zip_ref:
+        infos = {info.filename: info for info in zip_ref.infolist()}
+    # compressed files are stored as-is, the others are deflated
+    for name in ["data/model.safetensors", "wheels/pkg-1.0-py3-none-any.whl"]:
+        assert infos[f"workspace/{name}"].compress_type == zipfile.ZIP_STORED
+    for name in ["data/large.txt", "lib/site-packages/pkg/__init__.py"]:
+        info = infos[f"workspace/{name}"]
+        assert info.compress_type == zipfile.ZIP_DEFLATED
+        assert info.compress_size < info.file_size
+    assert all(
+        info.date_time == infos["workspace/"].date_time for info in infos.values()
+    )
+    if not is_windows:
+        # permissions are normalized
+        assert infos["workspace/bin/run"].external_attr >> 16 & 0o777 == 0o755
+        assert infos["workspace/app.py"].external_attr >> 16 & 0o777 == 0o644
+
+
+def test_tar_entries(tmp_path: Path) -> None:
+    workspace = _make_workspace(tmp_path)
+    path = export_archive(workspace, "tar.gz", chunk_size=CHUNK_SIZE)
+    # the concatenated deflate streams form a single valid gzip member
+    data = gzip.decompress(path.read_bytes())
+    with tarfile.open(fileobj=io.BytesIO(data), mode="r:") as tar_ref:
+        members = {member.name: member for member in tar_ref.getmembers()}
+    assert list(members) == sorted(members)
+    if not is_windows:
+        assert members["workspace/bin/run"].mode == 0o755
+        assert members["workspace/app.py"].mode == 0o644
+        assert members["workspace/bin/link"].issym()
+        # hardlinks are kept, and point to the first name
+        assert members["workspace/bin/app.py"].islnk()
+        assert members["workspace/bin/app.py"].linkname == "workspace/app.py"
+
+
+def test_unknown_format(tmp_path: Path) -> None:
+    with pytest.raises(ValueError, match="unknown archive format"):
+        export_archive(tmp_path, "rar")
@@ -0,0 +1,98 @@
+import os
+import hashlib
+
+import pytest
+
+from pathlib import Path
+
+from cfport import toolkit
+from cfport.toolkit import download_file
+from .utils import RangeMode
+from .utils import FileServer
+
+
+PIECE_SIZE = 64 << 10
+DATA = os.urandom(PIECE_SIZE * 10 + 123)
+DATA_SHA256 = hashlib.sha256(DATA).hexdigest()
+
+
+@pytest.fixture(autouse=True)
+def small_pieces(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(toolkit, "DOWNLOAD_PIECE_SIZE", PIECE_SIZE)
+
+
+def _check_downloaded(path: Path) -> None:
+    assert path.read_bytes() == DATA
+    assert not path.with_name(f"{path.name}.partial").exists()
+    assert not path.with_name(f"{path.name}.partial.json").exists()
+
+
+def test_segmented(tmp_path: Path) -> None:
+    path = tmp_path / "data.bin"
+    with FileServer({"data.bin": DATA}) as server:
+        digest = download_file(server.url("data.bin"), path, segments=4)
+    assert digest == DATA_SHA256
+    _check_downloaded(path)
+    # the probe, and one request per piece
+    ranges = [r for _, r in server.requests]
+    assert ranges[0] == "bytes=0-0"
+    expected = {
+        f"bytes={start}-{min(start + PIECE_SIZE, len(DATA)) - 1}"
+        for start in range(0, len(DATA), PIECE_SIZE)
+    }
+    assert sorted(ranges[1:]) == sorted(expected)
+
+
+def test_resume(tmp_path: Path) -> None:
+    path = tmp_path / "data.bin"
+    partial_path = tmp_path / "data.bin.partial"
+    range_map_path = tmp_path / "data.bin.partial.json"
+    with FileServer({"data.bin": DATA}, max_requests=4) as server:
+        url = server.url("data.bin")
+        # the probe and the first 3 pieces succeed, then the 'connection' is broken
+        with pytest.raises(OSError):
+            download_file(url, path, segments=1)
+        assert not path.exists()
+        assert partial_path.is_file() and range_map_path.is_file()
+        server.max_requests = None
+        num_requests = len(server.requests)
+        digest = download_file(url, path, segments=4)
+    assert digest == DATA_SHA256
+    _check_downloaded(path)
+    # the pieces which are already downloaded are not requested again
+    resumed = [r for _, r in server.requests[num_requests + 1 :]]
+    starts = [int(r[len("bytes=") :].split("-")[0]) for r in resumed if r]
+    assert len(starts) == len(resumed) == 11 - 3
+    assert min(starts) == PIECE_SIZE * 3
+
+
+def test_range_ignored(tmp_path: Path) -> None:
+    path = tmp_path / "data.bin"
+    with FileServer({"data.bin": DATA}, range_mode=RangeMode.IGNORED) as server:
+        digest = download_file(server.url("data.bin"), path, segments=4)
+    assert digest == DATA_SHA256
+    _check_downloaded(path)
+    # the response of the probe is used as the single stream
+    assert len(server.requests) == 1
+
+
+def test_unknown_total_size(tmp_path: Path) -> None:
+    path = tmp_path / "data.bin"
+    with FileServer({"data.bin": DATA}, range_mode=RangeMode.UNKNOWN_TOTAL) as server:
+        digest = download_file(server.url("data.bin"), path, segments=4)
+    assert digest == DATA_SHA256
+    _check_downloaded(path)
+    # the whole file is requested again without `Range`
+    assert [r for _, r in server.requests] == ["bytes=0-0", None]
+
+
+def test_verify(tmp_path: Path) -> None:
+    path = tmp_path / "data.bin"
+    with FileServer({"data.bin": DATA}) as server:
+        url = server.url("data.bin")
+        download_file(url, path, sha256=DATA_SHA256, size=len(DATA))
+        with pytest.raises(RuntimeError, match="sha256"):
+            download_file(url, tmp_path / "bad.bin", sha256="0" * 64)
+        with pytest.raises(RuntimeError, match="size"):
+            download_file(url, tmp_path / "bad.bin", size=len(DATA) + 1)
+    _check_downloaded(path)
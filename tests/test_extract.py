@@ -0,0 +1,124 @@
+import io
+import os
+import zipfile
+
+import pytest
+
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Tuple
+from pathlib import Path
+
+from cfport import toolkit
+from cfport.toolkit import download
+from .utils import FileServer
+
+
+def _make_zip(members: Dict[str, bytes]) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zip_ref:
+        for name, data in members.items():
+            if name.endswith("/"):
+                zip_ref.writestr(zipfile.ZipInfo(name), b"")
+            else:
+                zip_ref.writestr(name, data)
+    return buffer.getvalue()
+
+
+def _get_members(prefix: str) -> Dict[str, bytes]:
+    # archivers write the entries of the folders as well
+    members = {prefix: b""} if prefix else {}
+    members[f"{prefix}empty/"] = b""
+    for i in range(200):
+        members[f"{prefix}d{i % 7}/f{i}.txt"] = os.urandom(i * 37) * 2
+    members[f"{prefix}large.bin"] = os.urandom(1 << 20)
+    return members
+
+
+def _get_tree(root: Path) -> Dict[str, Any]:
+    tree: Dict[str, Any] = {}
+    for path in sorted(root.rglob("*")):
+        rel = path.relative_to(root).as_posix()
+        tree[rel] = path.read_bytes() if path.is_file() else None
+    return tree
+
+
+@pytest.fixture(params=["serial", "parallel"])
+def extract_mode(
+    request: Any,
+    monkeypatch: pytest.MonkeyPatch,
+) -> Tuple[str, List[int]]:
+    # returns the mode, and the sizes of the buckets extracted by the worker threads
+    buckets: List[int] = []
+    if request.param == "parallel":
+        extract_members = toolkit._extract_zip_members
+
+        def _spy(path: str, staging: str, names: List[str]) -> None:
+            buckets.append(len(names))
+            extract_members(path, staging, names)
+
+        monkeypatch.setattr(toolkit, "EXTRACT_PARALLEL_MIN_MEMBERS", 1)
+        monkeypatch.setattr(toolkit, "EXTRACT_PARALLEL_MIN_SIZE", 1)
+        monkeypatch.setattr(toolkit, "_extract_zip_members", _spy)
+    return request.param, buckets
+
+
+@pytest.mark.parametrize(
+    "prefix, flattened",
+    [
+        # the single top-level folder has the same name as the destination
+        ("bundle/", True),
+        # the single top-level folder has another name
+        ("other/", False),
+        # there are several top-level names
+        ("", False),
+    ],
+)
+def test_extract(
+    tmp_path: Path,
+    extract_mode: Tuple[str, List[int]],
+    prefix: str,
+    flattened: bool,
+) -> None:
+    members = _get_members(prefix)
+    data = _make_zip(members)
+    expected_root = tmp_path / "expected"
+    with zipfile.ZipFile(io.BytesIO(data), "r") as zip_ref:
+        zip_ref.extractall(expected_root)
+    if flattened:
+        expected_root = expected_root / "bundle"
+    root = tmp_path / "root"
+    root.mkdir()
+    with FileServer({"bundle.zip": data}) as server:
+        dst = download(server.url("bundle.zip"), root, use_cache=False)
+    assert dst == root / "bundle"
+    assert _get_tree(dst) == _get_tree(expected_root)
+    # the archive and the staging folder are removed
+    assert [path.name for path in root.iterdir()] == ["bundle"]
+    mode, buckets = extract_mode
+    if mode == "parallel" and (os.cpu_count() or 1) > 1:
+        num_files = len([name for name in members if not name.endswith("/")])
+        assert len(buckets) > 1
+        assert sum(buckets) == num_files
+
+
+def test_extract_zip_workers(
+    tmp_path: Path,
+    extract_mode: Tuple[str, List[int]],
+) -> None:
+    # the number of workers is explicit, so members are split even on a single core
+    members = _get_members("bundle/")
+    path = tmp_path / "bundle.zip"
+    path.write_bytes(_make_zip(members))
+    with zipfile.ZipFile(path, "r") as zip_ref:
+        zip_ref.extractall(tmp_path / "expected")
+    names = toolkit._extract_zip(path, tmp_path / "staging", workers=4)
+    assert sorted(names) == sorted(members)
+    assert _get_tree(tmp_path / "staging") == _get_tree(tmp_path / "expected")
+    mode, buckets = extract_mode
+    if mode == "parallel":
+        # the members are balanced by their sizes
+        num_files = len([name for name in members if not name.endswith("/")])
+        assert len(buckets) == 4
+        assert sum(buckets) == num_files
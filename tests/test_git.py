@@ -0,0 +1,151 @@
+import shutil
+
+import pytest
+
+from typing import Dict
+from pathlib import Path
+
+from cfport import toolkit
+from cfport.toolkit import git_clone
+from cfport.toolkit import resolve_git_commit
+from .utils import run_git
+
+
+pytestmark = pytest.mark.skipif(shutil.which("git") is None, reason="git is required")
+
+
+class Repo:
+    """
+    A bare repository with three commits on `main` (tagged `v1` / `v2` / `v3`, `v2` is
+    annotated) and a `dev` branch on top of it, served through a `file://` url, so
+    `--depth` / `--filter` are honored as they are for remote repositories.
+    """
+
+    def __init__(self, root: Path):
+        self.bare = root / "repo.git"
+        self.url = self.bare.as_uri()
+        self.commits: Dict[str, str] = {}
+        work = root / "work"
+        work.mkdir()
+        run_git("init", "--quiet", "--initial-branch=main", cwd=work)
+        for i in range(1, 4):
+            (work / "version.txt").write_text(str(i))
+            (work / f"data{i}.txt").write_text(f"data{i}" * 100)
+            run_git("add", "-A", cwd=work)
+            run_git("commit", "--quiet", "-m", f"commit {i}", cwd=work)
+            tag_args = ["-a", "-m", f"v{i}"] if i == 2 else []
+            run_git("tag", *tag_args, f"v{i}", cwd=work)
+            self.commits[f"v{i}"] = run_git("rev-parse", "HEAD", cwd=work)
+        run_git("checkout", "--quiet", "-b", "dev", cwd=work)
+        (work / "version.txt").write_text("dev")
+        run_git("commit", "--quiet", "-am", "dev", cwd=work)
+        self.commits["dev"] = run_git("rev-parse", "HEAD", cwd=work)
+        run_git("checkout", "--quiet", "main", cwd=work)
+        run_git("clone", "--quiet", "--bare", str(work), str(self.bare), cwd=root)
+        for key in ["uploadpack.allowFilter", "uploadpack.allowAnySHA1InWant"]:
+            run_git("config", key, "true", cwd=self.bare)
+
+
+@pytest.fixture
+def repo(tmp_path: Path) -> Repo:
+    return Repo(tmp_path)
+
+
+@pytest.fixture
+def git_cache_dir(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    cache_dir = tmp_path / "git_cache"
+    monkeypatch.setattr(toolkit, "GIT_CACHE_DIR", cache_dir)
+    return cache_dir
+
+
+def _head(path: Path) -> str:
+    return run_git("rev-parse", "HEAD", cwd=path)
+
+
+def _count_commits(path: Path) -> int:
+    return int(run_git("rev-list", "--count", "HEAD", cwd=path))
+
+
+def test_clone(tmp_path: Path, repo: Repo) -> None:
+    dst = git_clone(repo.url, tmp_path / "clone")
+    assert _head(dst) == repo.commits["v3"]
+    assert _count_commits(dst) == 3
+    assert (dst / "version.txt").read_text() == "3"
+    # an existing destination is kept as-is
+    (dst / "version.txt").write_text("modified")
+    assert git_clone(repo.url, dst) == dst
+    assert (dst / "version.txt").read_text() == "modified"
+
+
+def test_shallow_clone(tmp_path: Path, repo: Repo) -> None:
+    dst = git_clone(repo.url, tmp_path / "clone", depth=1, filter_spec="blob:none")
+    assert _head(dst) == repo.commits["v3"]
+    assert _count_commits(dst) == 1
+    assert (dst / "shallow").is_file() or (dst / ".git" / "shallow").is_file()
+    assert run_git("config", "remote.origin.partialclonefilter", cwd=dst) == "blob:none"
+    assert (dst / "data1.txt").read_text() == "data1" * 100
+
+
+@pytest.mark.parametrize("ref", ["v1", "v2", "dev", "commit"])
+def test_pinned_clone(tmp_path: Path, repo: Repo, ref: str) -> None:
+    expected = repo.commits["v1" if ref == "commit" else ref]
+    if ref == "commit":
+        ref = expected
+    dst = git_clone(repo.url, tmp_path / "clone", ref=ref, depth=1)
+    assert _head(dst) == expected
+    assert _count_commits(dst) == 1
+    # the clone is detached
+    assert run_git("rev-parse", "--abbrev-ref", "HEAD", cwd=dst) == "HEAD"
+    assert run_git("remote", "get-url", "origin", cwd=dst) == repo.url
+
+
+def test_mirror(tmp_path: Path, repo: Repo, git_cache_dir: Path) -> None:
+    dst = git_clone(repo.url, tmp_path / "clone0", ref="v1", mirror=True)
+    assert _head(dst) == repo.commits["v1"]
+    # the origin of the clone still points to the original url
+    assert run_git("remote", "get-url", "origin", cwd=dst) == repo.url
+    mirrors = list(git_cache_dir.iterdir())
+    assert len(mirrors) == 1
+    mirror = mirrors[0]
+    assert run_git("rev-parse", "--is-bare-repository", cwd=mirror) == "true"
+    # new commits are fetched into the mirror before cloning from it
+    work = tmp_path / "work"
+    (work / "version.txt").write_text("4")
+    run_git("commit", "--quiet", "-am", "commit 4", cwd=work)
+    run_git("push", "--quiet", str(repo.bare), "main", cwd=work)
+    latest = _head(work)
+    dst = git_clone(repo.url, tmp_path / "clone1", ref="main", mirror=True)
+    assert _head(dst) == latest
+    assert list(git_cache_dir.iterdir()) == [mirror]
+    # offline clones are made from the existing mirror, even if the url is gone
+    shutil.rmtree(repo.bare)
+    dst = git_clone(repo.url, tmp_path / "clone2", mirror=True, offline=True)
+    assert _head(dst) == latest
+
+
+def test_offline(tmp_path: Path, repo: Repo, git_cache_dir: Path) -> None:
+    with pytest.raises(RuntimeError, match="without a git mirror"):
+        git_clone(repo.url, tmp_path / "clone", offline=True)
+    with pytest.raises(RuntimeError, match="is not found"):
+        git_clone(repo.url, tmp_path / "clone", mirror=True, offline=True)
+
+
+def test_clone_failed(tmp_path: Path, repo: Repo) -> None:
+    with pytest.raises(RuntimeError, match="failed to clone"):
+        git_clone(repo.url, tmp_path / "clone", ref="missing")
+    with pytest.raises(RuntimeError, match="failed to clone"):
+        git_clone((tmp_path / "missing.git").as_uri(), tmp_path / "clone1")
+
+
+def test_resolve_git_commit(repo: Repo) -> None:
+    assert resolve_git_commit(repo.url) == repo.commits["v3"]
+    assert resolve_git_commit(repo.url, "main") == repo.commits["v3"]
+    assert resolve_git_commit(repo.url, "dev") == repo.commits["dev"]
+    assert resolve_git_commit(repo.url, "v1") == repo.commits["v1"]
+    # annotated tags are resolved to the commits they point to
+    assert resolve_git_commit(repo.url, "v2") == repo.commits["v2"]
+    # commits are returned as-is, without a round trip
+    commit = repo.commits["v1"].upper()
+    assert resolve_git_commit("file:///missing", commit) == commit.lower()
+    with pytest.raises(RuntimeError, match="is not found"):
+        resolve_git_commit(repo.url, "missing")
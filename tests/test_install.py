@@ -0,0 +1,141 @@
+import sys
+
+import pytest
+
+from types import SimpleNamespace
+from typing import Any
+from typing import List
+from pathlib import Path
+
+from cfport import config as config_module
+from cfport.config import IConfig
+from cfport.config import PyRequirement
+from cfport.toolkit import check_requirements
+from cfport.executer.blocks import install as install_module
+from cfport.executer.blocks.install import InstallPythonRequirementsBlock
+from cfport.executer.blocks.prepare import PreparePythonBlock
+from .utils import make_venv
+from .utils import make_wheel
+
+
+def _make_block(executable: Path) -> InstallPythonRequirementsBlock:
+    block = InstallPythonRequirementsBlock()
+    prepare_python = SimpleNamespace(
+        executable=executable,
+        pip_cmd=[str(executable), "-m", "pip"],
+    )
+    block.previous = {PreparePythonBlock.__identifier__: prepare_python}
+    return block
+
+
+def _make_requirements(root: Path) -> List[Any]:
+    requirement_file = root / "requirements.txt"
+    requirement_file.write_text("pkg3\npkg4 # comment\n")
+    return [
+        "pkg0",
+        PyRequirement(package_name="pkg1"),
+        PyRequirement(install_command="$pip install pkg2"),
+        PyRequirement(requirement_file=str(requirement_file)),
+        "pkg5",
+    ]
+
+
+@pytest.mark.parametrize("batch", [False, True])
+def test_install_units(
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+    batch: bool,
+) -> None:
+    units: List[List[str]] = []
+
+    def _install_unit(requirements: List[PyRequirement], **kw: Any) -> None:
+        units.append([str(r) for r in requirements])
+
+    block = _make_block(Path(sys.executable))
+    monkeypatch.setattr(block, "install_unit", _install_unit)
+    config = IConfig(
+        python_requirements=_make_requirements(tmp_path),
+        batch_python_requirements=batch,
+        skip_satisfied_requirements=False,
+    )
+    block.build(config)
+    names = [str(r) for r in install_module._get_requirements(config)]
+    if not batch:
+        assert units == [[name] for name in names]
+    else:
+        # custom commands split the batches, and run in order
+        assert units == [names[:2], names[2:3], names[3:]]
+
+
+def test_install_batch_args(monkeypatch: pytest.MonkeyPatch) -> None:
+    cmds: List[List[str]] = []
+
+    def _run(cmd: List[str]) -> Any:
+        cmds.append(cmd)
+        return SimpleNamespace(returncode=0)
+
+    monkeypatch.setattr(install_module, "traced_run", _run)
+    requirements = [
+        PyRequirement(package_name="a>=1"),
+        PyRequirement(git_url="git+https://host/b.git@v1#egg=b"),
+        PyRequirement(requirement_file="requirements.txt"),
+    ]
+    kw: Any = dict(pip_cmd=["pip"], executable="python", wheelhouse=None, offline=False)
+    install_module._install_batch(requirements, **kw)
+    # the requirements are resolved by a single `pip install`
+    assert cmds == [
+        [
+            "pip",
+            "install",
+            "a>=1",
+            "git+https://host/b.git@v1#egg=b",
+            "-r",
+            "requirements.txt",
+        ]
+    ]
+    monkeypatch.setattr(
+        install_module, "traced_run", lambda cmd: SimpleNamespace(returncode=1)
+    )
+    with pytest.raises(RuntimeError, match="failed to install requirements"):
+        install_module._install_batch(requirements, **kw)
+
+
+def test_install_batch(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    # `pkg3` and `pkg5` are in the same batch, so `shared` is resolved once to the
+    # version which satisfies both of them
+    wheels = tmp_path / "wheels"
+    for i in range(6):
+        requires = {0: ["shared>=1.5"], 3: ["shared"], 5: ["shared<2"]}.get(i)
+        make_wheel(wheels, f"pkg{i}", requires=requires)
+    for version in ["1.0", "1.5", "2.0"]:
+        make_wheel(wheels, "shared", version)
+    monkeypatch.setenv("PIP_NO_INDEX", "1")
+    monkeypatch.setenv("PIP_FIND_LINKS", str(wheels))
+    cmds: List[List[str]] = []
+    for module in [install_module, config_module]:
+        run = module.traced_run
+
+        def _run(cmd: List[str], *, _run: Any = run, **kwargs: Any) -> Any:
+            cmds.append([str(c) for c in cmd])
+            return _run(cmd, **kwargs)
+
+        monkeypatch.setattr(module, "traced_run", _run)
+    executable = make_venv(tmp_path / "venv")
+    block = _make_block(executable)
+    config = IConfig(
+        python_requirements=_make_requirements(tmp_path),
+        batch_python_requirements=True,
+    )
+    block.build(config)
+    installs = [cmd[cmd.index("install") + 1 :] for cmd in cmds]
+    assert installs == [
+        ["pkg0", "pkg1"],
+        ["pkg2"],
+        ["-r", str(tmp_path / "requirements.txt"), "pkg5"],
+    ]
+    specs = [f"pkg{i}==1.0" for i in range(6)] + ["shared==1.5"]
+    assert check_requirements(str(executable), specs) == [True] * len(specs)
+    # satisfied requirements are skipped in the next run, custom commands always run
+    cmds.clear()
+    block.build(config)
+    assert [cmd[cmd.index("install") + 1 :] for cmd in cmds] == [["pkg2"]]
@@ -0,0 +1,141 @@
+import csv
+import subprocess
+
+import pytest
+
+from typing import Dict
+from typing import List
+from typing import Tuple
+from pathlib import Path
+
+from cfport.toolkit import get_platform
+from cfport.toolkit import Platform
+from cfport.installer import IInstaller
+from .utils import make_venv
+from .utils import make_wheel
+from .utils import get_site_packages
+
+
+# the launchers of `ParallelInstaller` target the embeddable layout (`python.exe` next to
+# `Scripts/`) on Windows, so they cannot be compared with the ones in a venv
+pytestmark = pytest.mark.skipif(
+    get_platform() == Platform.WINDOWS,
+    reason="console scripts of venvs differ from the portable layout on Windows",
+)
+
+
+def _make_wheels(root: Path, version: str) -> List[Path]:
+    wheels = [
+        make_wheel(
+            root,
+            "cli_pkg",
+            version,
+            files={
+                "cli_pkg/__init__.py": f"VERSION = {version!r}\n",
+                "cli_pkg/main.py": (
+                    "import sys\n"
+                    "from cli_pkg import VERSION\n\n\n"
+                    "def main():\n"
+                    "    print(sys.argv[0].rsplit('/', 1)[-1], VERSION, *sys.argv[1:])\n"
+                ),
+                f"cli_pkg/v{version.replace('.', '_')}.py": "",
+            },
+            console_scripts={"cli-pkg": "cli_pkg.main:main"},
+            data_scripts={
+                "cli-pkg-raw": "#!python\nimport cli_pkg\nprint('raw', cli_pkg.VERSION)\n",
+                "cli-pkg.sh": "#!/bin/sh\necho sh\n",
+            },
+        ),
+    ]
+    for i in range(5):
+        files = {f"lib{i}/__init__.py": "", f"lib{i}/sub/mod.py": f"X = {i}\n"}
+        wheels.append(make_wheel(root, f"lib{i}", version, files=files))
+    return wheels
+
+
+# `INSTALLER` differs, and `pip` records how the distributions are requested (PEP 610 /
+# PEP 376), which is optional
+_ignored_metadata = {"INSTALLER", "REQUESTED", "direct_url.json"}
+
+
+def _read_records(site_packages: Path) -> Dict[str, Dict[str, Tuple[str, str]]]:
+    # dist-info -> path -> (hash, size), without the bytecode and the ignored metadata
+    records = {}
+    for record in sorted(site_packages.glob("*.dist-info/RECORD")):
+        rows = {}
+        with record.open("r", newline="") as f:
+            for row in csv.reader(f):
+                if not row or "__pycache__" in row[0]:
+                    continue
+                if row[0].rsplit("/", 1)[-1] in _ignored_metadata:
+                    continue
+                rows[row[0]] = (row[1], row[2])
+        records[record.parent.name] = rows
+    return records
+
+
+def _get_tree(root: Path) -> Dict[str, bytes]:
+    return {
+        path.relative_to(root).as_posix(): path.read_bytes()
+        for path in root.rglob("*")
+        if path.is_file()
+        and "__pycache__" not in path.parts
+        and path.name not in _ignored_metadata
+    }
+
+
+def _install(root: Path, backend: str, wheel_sets: List[List[Path]]) -> Path:
+    executable = make_venv(root)
+    pip_cmd = [str(executable), "-m", "pip"]
+    installer = IInstaller.make(backend, {})
+    for wheels in wheel_sets:
+        installer.install(wheels, pip_cmd=pip_cmd, executable=str(executable))
+    return executable
+
+
+def test_equivalence(tmp_path: Path) -> None:
+    # installs `1.0` and then upgrades to `2.0`, so the uninstallation is compared too
+    wheel_sets = [_make_wheels(tmp_path / f"wheels{v}", v) for v in ["1.0", "2.0"]]
+    venvs = {}
+    for backend in ["pip", "parallel"]:
+        executable = _install(tmp_path / backend, backend, wheel_sets)
+        venvs[backend] = executable, get_site_packages(executable)
+    pip_executable, pip_site_packages = venvs["pip"]
+    executable, site_packages = venvs["parallel"]
+    # the same files are installed, and the bundled `pip` / `setuptools` are untouched
+    tree = _get_tree(site_packages)
+    assert tree.keys() == _get_tree(pip_site_packages).keys()
+    for name, data in tree.items():
+        if not name.endswith("/RECORD"):
+            assert data == (pip_site_packages / name).read_bytes(), name
+    assert not (site_packages / "cli_pkg" / "v1_0.py").exists()
+    assert (site_packages / "cli_pkg-2.0.dist-info" / "INSTALLER").read_text() == (
+        "cfport\n"
+    )
+    # `RECORD`s list the same files, and the hashes match for the unmodified ones
+    pip_records = _read_records(pip_site_packages)
+    records = _read_records(site_packages)
+    assert records.keys() == pip_records.keys()
+    for dist_info, rows in records.items():
+        pip_rows = pip_records[dist_info]
+        assert {p: (h, s) for p, (h, s) in rows.items() if "/bin/" not in p} == {
+            p: (h, s) for p, (h, s) in pip_rows.items() if "/bin/" not in p
+        }
+        assert rows.keys() == pip_rows.keys()
+    # console scripts and `#!python` scripts are generated, and behave the same
+    scripts_dir = executable.parent
+    pip_scripts_dir = pip_executable.parent
+    for name in ["cli-pkg", "cli-pkg-raw", "cli-pkg.sh"]:
+        assert (scripts_dir / name).is_file()
+        cmd_output = []
+        for directory in [scripts_dir, pip_scripts_dir]:
+            cmd = [str(directory / name), "a", "b"]
+            result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+            cmd_output.append(result.stdout)
+        assert cmd_output[0] == cmd_output[1]
+    assert (scripts_dir / "cli-pkg.sh").read_bytes() == (
+        pip_scripts_dir / "cli-pkg.sh"
+    ).read_bytes()
+    # the launchers run the `python` next to them, so the venv can be relocated
+    assert b"/python" in (scripts_dir / "cli-pkg").read_bytes().splitlines()[1]
+    assert str(executable).encode() not in (scripts_dir / "cli-pkg").read_bytes()
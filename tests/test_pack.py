@@ -0,0 +1,199 @@
+import json
+import zipfile
+import subprocess
+
+import pytest
+
+from typing import Any
+from typing import Dict
+from typing import List
+from pathlib import Path
+
+from cfport.config import AutoConfig
+from cfport.toolkit import get_platform
+from cfport.toolkit import Platform
+from cfport.installer import PipInstaller
+from cfport.constants import WORKSPACE_META_DIR
+from cfport.executer.blocks.pack import PACK_MARKER
+from cfport.executer.blocks.pack import PACKED_SITE_PACKAGES
+from cfport.executer.blocks.pack import PackPurePythonBlock
+from cfport.executer.blocks.prepare import PreparePythonBlock
+from .utils import make_venv
+from .utils import make_wheel
+from .utils import get_site_packages
+
+
+# the zip archive is put on `sys.path` by the `._pth` file of the embeddable on Windows,
+# which is not available here
+pytestmark = pytest.mark.skipif(
+    get_platform() == Platform.WINDOWS,
+    reason="packing is tested with venvs, which are not used on Windows",
+)
+
+_data_source = """
+import os
+
+with open(os.path.join(os.path.dirname(__file__), "data.json")) as f:
+    DATA = f.read()
+"""
+_plugins_source = """
+import os
+
+PLUGINS = sorted(os.listdir(os.path.dirname(__file__)))
+"""
+# name -> (files, the reason why it is not packed)
+distributions = {
+    "pure_pkg": (
+        {
+            "pure_pkg/__init__.py": "from .sub import X\nHERE = __file__\n",
+            "pure_pkg/sub/__init__.py": "X = 1\n",
+            "pure_pkg/py.typed": "",
+        },
+        None,
+    ),
+    "pure_module": ({"pure_module.py": "Y = 2\n"}, None),
+    "native_pkg": (
+        {"native_pkg/__init__.py": "", "native_pkg/_speedups.so": "\0"},
+        "contains native libraries ('native_pkg/_speedups.so')",
+    ),
+    "data_pkg": (
+        {"data_pkg/__init__.py": _data_source, "data_pkg/data.json": "{}"},
+        "accesses files by `__file__` ('data_pkg/__init__.py')",
+    ),
+    "plugin_pkg": (
+        {"plugin_pkg/__init__.py": _plugins_source},
+        "accesses files by `__file__` ('plugin_pkg/__init__.py')",
+    ),
+    "ns_a": (
+        {"ns/a/__init__.py": "A = 1\n"},
+        "shares 'ns' with other distributions",
+    ),
+    "ns_b": (
+        {"ns/b/__init__.py": "B = 1\n"},
+        "shares 'ns' with other distributions",
+    ),
+    "pth_pkg": (
+        {"pth_pkg/__init__.py": "", "pth_pkg.pth": "import os\n"},
+        "contains top-level data files ('pth_pkg.pth')",
+    ),
+    "excluded_pkg": ({"excluded_pkg/__init__.py": ""}, "excluded"),
+}
+
+
+class Packed:
+    def __init__(self, root: Path):
+        wheels = [
+            make_wheel(root / "wheels", name, files=files)
+            for name, (files, _) in distributions.items()
+        ]
+        self.root = root / "venv"
+        self.executable = make_venv(self.root)
+        self.site_packages = get_site_packages(self.executable)
+        pip_cmd = [str(self.executable), "-m", "pip"]
+        PipInstaller().install(wheels, pip_cmd=pip_cmd, executable=str(self.executable))
+        prepare_python = PreparePythonBlock()
+        prepare_python.root = self.root
+        prepare_python.executable = self.executable
+        self.block = PackPurePythonBlock()
+        self.block.previous = {PreparePythonBlock.__identifier__: prepare_python}
+        self.workspace = root / "workspace"
+
+    def build(self, pack: bool) -> None:
+        config = AutoConfig(
+            workspace=str(self.workspace),
+            pack_pure_python=pack,
+            pack_exclude=["excluded-pkg"],
+        )
+        self.block.build(config)
+
+    @property
+    def report_path(self) -> Path:
+        return self.workspace / WORKSPACE_META_DIR / "pack_report.json"
+
+    def run(self, source: str) -> Any:
+        # runs `source` like `run.sh` does (the activation script is sourced), and
+        # returns the json printed by it
+        script = 'source "$0" && exec python -c "$1"'
+        activate = str(self.root / "bin" / "activate")
+        cmd = ["bash", "-c", script, activate, source]
+        result = subprocess.run(cmd, capture_output=True, text=True)
+        assert result.returncode == 0, result.stderr
+        return json.loads(result.stdout)
+
+
+_import_source = """
+import json
+import importlib
+import importlib.metadata
+
+names = ["pure_pkg", "pure_pkg.sub", "pure_module", "native_pkg", "data_pkg",
+         "plugin_pkg", "ns.a", "ns.b", "pth_pkg", "excluded_pkg"]
+files = {name: importlib.import_module(name).__file__ for name in names}
+versions = {name: importlib.metadata.version(name) for name in ["pure_pkg", "ns_a"]}
+print(json.dumps(dict(files=files, versions=versions)))
+"""
+
+
+def _get_files(site_packages: Path) -> List[str]:
+    return sorted(
+        path.relative_to(site_packages).as_posix()
+        for path in site_packages.rglob("*")
+        if path.is_file() and "__pycache__" not in path.parts
+    )
+
+
+def test_pack(tmp_path: Path) -> None:
+    packed = Packed(tmp_path)
+    site_packages = packed.site_packages
+    files = _get_files(site_packages)
+    packed.build(True)
+    with packed.report_path.open("r") as f:
+        report = json.load(f)
+    reasons: Dict[str, Any] = {name: None for name in report["packed"]}
+    reasons.update(report["skipped"])
+    for name, (dist_files, reason) in distributions.items():
+        assert reasons[f"{name}-1.0.dist-info"] == reason, name
+        for rel in dist_files:
+            # only the packed files are removed from `site-packages`
+            assert (site_packages / rel).is_file() == (reason is not None)
+    # the packed modules are stored with their bytecode
+    zip_path = packed.root / PACKED_SITE_PACKAGES
+    with zipfile.ZipFile(zip_path) as zip_ref:
+        names = set(zip_ref.namelist())
+    for name in ["pure_pkg/__init__", "pure_pkg/sub/__init__", "pure_module"]:
+        assert {f"{name}.py", f"{name}.pyc"} <= names
+    assert "pure_pkg/py.typed" in names
+    activate = (packed.root / "bin" / "activate").read_text()
+    assert PACK_MARKER in activate
+    # the packed distributions are imported from the zip archive, and the metadata is
+    # still available
+    result = packed.run(_import_source)
+    for name, path in result["files"].items():
+        top = name.split(".")[0]
+        expected = reasons[f"{top}-1.0.dist-info"] is None if top != "ns" else False
+        assert (PACKED_SITE_PACKAGES in path) == expected, name
+    assert result["versions"] == dict(pure_pkg="1.0", ns_a="1.0")
+    # unpacking restores everything
+    packed.build(False)
+    assert not zip_path.exists()
+    assert not packed.report_path.exists()
+    assert PACK_MARKER not in (packed.root / "bin" / "activate").read_text()
+    assert _get_files(site_packages) == files
+    result = packed.run(_import_source)
+    assert not any(PACKED_SITE_PACKAGES in path for path in result["files"].values())
+
+
+def test_repack(tmp_path: Path) -> None:
+    packed = Packed(tmp_path)
+    packed.build(True)
+    zip_path = packed.root / PACKED_SITE_PACKAGES
+    data = zip_path.read_bytes()
+    # packing again restores the packed files first, and the archive is reproducible
+    packed.build(True)
+    assert zip_path.read_bytes() == data
+    assert (packed.root / "bin" / "activate").read_text().count(PACK_MARKER) == 1
+    # a missing archive cannot be unpacked
+    zip_path.unlink()
+    with pytest.raises(RuntimeError, match="is missing"):
+        packed.build(False)
+    assert packed.report_path.is_file()
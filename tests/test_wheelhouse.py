@@ -0,0 +1,161 @@
+import sys
+import shutil
+import zipfile
+import subprocess
+
+import pytest
+
+from typing import Dict
+from typing import List
+from pathlib import Path
+from importlib.util import find_spec
+
+from cfport.toolkit import resolve_git_commit
+from cfport.wheelhouse import Wheelhouse
+from .utils import run_git
+
+
+def _can_build_wheels() -> bool:
+    if find_spec("setuptools") is None:
+        return False
+    # `bdist_wheel` is vendored by `setuptools>=70.1`, and lives in `wheel` before that
+    if find_spec("wheel") is not None:
+        return True
+    return find_spec("setuptools.command.bdist_wheel") is not None
+
+
+pytestmark = [
+    pytest.mark.skipif(shutil.which("git") is None, reason="git is required"),
+    pytest.mark.skipif(
+        not any(shutil.which(cc) for cc in ["cc", "gcc", "clang", "cl"]),
+        reason="a C compiler is required",
+    ),
+    pytest.mark.skipif(
+        not _can_build_wheels(),
+        reason="`setuptools` (with `wheel` if it is older than 70.1) is required",
+    ),
+]
+
+_setup_template = """
+from setuptools import setup
+from setuptools import Extension
+
+setup(
+    name="{name}",
+    version="1.0",
+    ext_modules=[Extension("{name}", ["{name}.c"])],
+)
+"""
+
+_extension_template = """
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+
+static PyObject *answer(PyObject *self, PyObject *args) {{
+    return PyLong_FromLong({answer});
+}}
+
+static PyMethodDef methods[] = {{
+    {{"answer", answer, METH_NOARGS, NULL}},
+    {{NULL, NULL, 0, NULL}},
+}};
+
+static struct PyModuleDef module = {{PyModuleDef_HEAD_INIT, "{name}", NULL, -1, methods}};
+
+PyMODINIT_FUNC PyInit_{name}(void) {{
+    return PyModule_Create(&module);
+}}
+"""
+
+
+class ExtensionRepo:
+    """A git repository of a small C extension `name`, whose `answer()` is editable."""
+
+    def __init__(self, root: Path, name: str):
+        self.name = name
+        self.root = root / name
+        self.root.mkdir()
+        self.url = self.root.as_uri()
+        (self.root / "setup.py").write_text(_setup_template.format(name=name))
+        run_git("init", "--quiet", cwd=self.root)
+        self.commit(0)
+
+    def commit(self, answer: int) -> None:
+        code = _extension_template.format(name=self.name, answer=answer)
+        (self.root / f"{self.name}.c").write_text(code)
+        run_git("add", "-A", cwd=self.root)
+        run_git("commit", "--quiet", "-m", f"answer {answer}", cwd=self.root)
+
+    @property
+    def requirement(self) -> str:
+        # pinned to the commit, just like `InstallPythonRequirementsBlock.build_sources`,
+        # and `name @ git+file://...` is not accepted by older `pip`s (no host)
+        commit = resolve_git_commit(self.url, "HEAD")
+        return f"git+{self.url}@{commit}#egg={self.name}"
+
+
+def _get_answer(wheel: Path, name: str, root: Path) -> int:
+    target = root / wheel.stem
+    with zipfile.ZipFile(wheel, "r") as zip_ref:
+        zip_ref.extractall(target)
+    cmd = [sys.executable, "-c", f"import {name}; print({name}.answer())"]
+    result = subprocess.run(cmd, cwd=target, capture_output=True, text=True, check=True)
+    return int(result.stdout)
+
+
+def _build(wheelhouse: Wheelhouse, requirements: List[str]) -> Dict[str, Path]:
+    pip_cmd = [sys.executable, "-m", "pip"]
+    # the pinned requirements are their own source hashes
+    sources = {requirement: requirement for requirement in requirements}
+    return wheelhouse.build_sources(pip_cmd, sources, workers=2)
+
+
+def test_build_sources(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    # builds with the current `setuptools`, so no index is needed
+    monkeypatch.setenv("PIP_NO_BUILD_ISOLATION", "0")
+    monkeypatch.setenv("PIP_NO_INDEX", "1")
+    repos = [ExtensionRepo(tmp_path, name) for name in ["ext_a", "ext_b"]]
+    wheelhouse = Wheelhouse(tmp_path / "wheelhouse")
+    built: List[str] = []
+    build_source = wheelhouse._build_source
+
+    def _build_source(pip_cmd: List[str], requirement: str, cache_dir: Path) -> Path:
+        built.append(requirement)
+        return build_source(pip_cmd, requirement, cache_dir)
+
+    monkeypatch.setattr(wheelhouse, "_build_source", _build_source)
+    requirements = [repo.requirement for repo in repos]
+    wheels = _build(wheelhouse, requirements)
+    assert sorted(built) == sorted(requirements)
+    for repo, requirement in zip(repos, requirements):
+        wheel = wheels[requirement]
+        assert not wheel.name.endswith("-none-any.whl")
+        assert _get_answer(wheel, repo.name, tmp_path / "check0") == 0
+    # unchanged commits are never rebuilt
+    built.clear()
+    assert _build(wheelhouse, requirements) == wheels
+    assert built == []
+    # new commits are built again, while the others are still cached
+    repos[0].commit(42)
+    new_requirements = [repo.requirement for repo in repos]
+    assert new_requirements[0] != requirements[0]
+    new_wheels = _build(wheelhouse, new_requirements)
+    assert built == [new_requirements[0]]
+    assert new_wheels[new_requirements[1]] == wheels[requirements[1]]
+    answer = _get_answer(new_wheels[new_requirements[0]], "ext_a", tmp_path / "check1")
+    assert answer == 42
+    assert len(list((tmp_path / "wheelhouse" / "sources").iterdir())) == 3
+
+
+def test_build_sources_failed(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv("PIP_NO_BUILD_ISOLATION", "0")
+    monkeypatch.setenv("PIP_NO_INDEX", "1")
+    repo = ExtensionRepo(tmp_path, "ext_broken")
+    (repo.root / "ext_broken.c").write_text("this is not C")
+    run_git("commit", "--quiet", "-am", "broken", cwd=repo.root)
+    wheelhouse = Wheelhouse(tmp_path / "wheelhouse")
+    with pytest.raises(RuntimeError, match="failed to build"):
+        _build(wheelhouse, [repo.requirement])
+    # nothing is cached for the failed build
+    sources_dir = tmp_path / "wheelhouse" / "sources"
+    assert list(sources_dir.iterdir()) == []
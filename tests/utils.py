@@ -0,0 +1,206 @@
+import sys
+import stat
+import time
+import base64
+import hashlib
+import zipfile
+import threading
+import subprocess
+
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Tuple
+from typing import Optional
+from pathlib import Path
+from http.server import ThreadingHTTPServer
+from http.server import BaseHTTPRequestHandler
+
+from cfport.toolkit import get_platform
+from cfport.toolkit import Platform
+
+
+class RangeMode:
+    # `Range` is supported
+    SUPPORTED = "supported"
+    # `Range` is ignored, the whole file is always returned
+    IGNORED = "ignored"
+    # `Range` is supported, but the total size is not reported (`bytes a-b/*`)
+    UNKNOWN_TOTAL = "unknown_total"
+
+
+class _FileHandler(BaseHTTPRequestHandler):
+    server: "FileServer"
+
+    def _parse_range(self, size: int) -> Optional[Tuple[int, int]]:
+        header = self.headers.get("Range")
+        if header is None or self.server.range_mode == RangeMode.IGNORED:
+            return None
+        start_str, end_str = header[len("bytes=") :].split("-")
+        end = int(end_str) if end_str else size - 1
+        return int(start_str), min(end, size - 1)
+
+    def do_GET(self) -> None:
+        server = self.server
+        with server.lock:
+            server.requests.append((self.path, self.headers.get("Range")))
+            num_requests = len(server.requests)
+        if server.max_requests is not None and num_requests > server.max_requests:
+            self.send_error(503)
+            return
+        data = server.files.get(self.path.lstrip("/"))
+        if data is None:
+            self.send_error(404)
+            return
+        byte_range = self._parse_range(len(data))
+        if byte_range is None:
+            self.send_response(200)
+            body = data
+        else:
+            start, end = byte_range
+            total = "*" if server.range_mode == RangeMode.UNKNOWN_TOTAL else len(data)
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{total}")
+            body = data[start : end + 1]
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        chunk_size = 1 << 16
+        for i in range(0, len(body), chunk_size):
+            t = time.perf_counter()
+            self.wfile.write(body[i : i + chunk_size])
+            if server.rate is not None:
+                # throttles every connection, just like a remote server
+                elapsed = time.perf_counter() - t
+                time.sleep(max(0.0, chunk_size / server.rate - elapsed))
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+
+class FileServer(ThreadingHTTPServer):
+    """
+    Serves `files` (file name -> content) on localhost in a background thread, and records
+    the (path, `Range` header) of every request in `requests`.
+
+    `range_mode` controls how `Range` is handled (see `RangeMode`), requests after the
+    first `max_requests` ones fail with 503, and every connection is throttled to `rate`
+    bytes per second if it is provided.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        files: Dict[str, bytes],
+        *,
+        range_mode: str = RangeMode.SUPPORTED,
+        max_requests: Optional[int] = None,
+        rate: Optional[float] = None,
+    ):
+        super().__init__(("127.0.0.1", 0), _FileHandler)
+        self.files = files
+        self.range_mode = range_mode
+        self.max_requests = max_requests
+        self.rate = rate
+        self.requests: List[Tuple[str, Optional[str]]] = []
+        self.lock = threading.Lock()
+
+    def url(self, name: str) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/{name}"
+
+    def __enter__(self) -> "FileServer":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+def _record_hash(data: bytes) -> str:
+    digest = base64.urlsafe_b64encode(hashlib.sha256(data).digest())
+    return f"sha256={digest.rstrip(b'=').decode()}"
+
+
+def make_wheel(
+    root: Path,
+    name: str,
+    version: str = "1.0",
+    *,
+    files: Optional[Dict[str, str]] = None,
+    requires: Optional[List[str]] = None,
+    console_scripts: Optional[Dict[str, str]] = None,
+    data_scripts: Optional[Dict[str, str]] = None,
+) -> Path:
+    """
+    Writes a pure python wheel of `name` to `root` and returns its path.
+
+    `files` maps the paths in `site-packages` to their contents (defaults to a single
+    `{name}/__init__.py`), `requires` are written to `Requires-Dist`, `console_scripts`
+    maps the script names to their entry points (`module:func`), and `data_scripts` maps
+    the names of the scripts in `.data/scripts` to their contents.
+    """
+
+    if files is None:
+        files = {f"{name}/__init__.py": f"VERSION = {version!r}\n"}
+    dist_info = f"{name}-{version}.dist-info"
+    metadata = f"Metadata-Version: 2.1\nName: {name}\nVersion: {version}\n"
+    for requirement in requires or []:
+        metadata += f"Requires-Dist: {requirement}\n"
+    members = dict(files)
+    members[f"{dist_info}/METADATA"] = metadata
+    members[f"{dist_info}/WHEEL"] = (
+        "Wheel-Version: 1.0\nGenerator: cfport-tests\n"
+        "Root-Is-Purelib: true\nTag: py3-none-any\n"
+    )
+    if console_scripts:
+        lines = [f"{k} = {v}" for k, v in console_scripts.items()]
+        members[f"{dist_info}/entry_points.txt"] = "\n".join(
+            ["[console_scripts]", *lines, ""]
+        )
+    for script_name, script in (data_scripts or {}).items():
+        members[f"{name}-{version}.data/scripts/{script_name}"] = script
+    record_lines = []
+    root.mkdir(parents=True, exist_ok=True)
+    path = root / f"{name}-{version}-py3-none-any.whl"
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zip_ref:
+        for member, content in members.items():
+            data = content.encode()
+            info = zipfile.ZipInfo(member)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            # scripts are executable in the wheels built by the build backends
+            mode = 0o755 if ".data/scripts/" in member else 0o644
+            info.external_attr = (stat.S_IFREG | mode) << 16
+            zip_ref.writestr(info, data)
+            record_lines.append(f"{member},{_record_hash(data)},{len(data)}")
+        record_lines.append(f"{dist_info}/RECORD,,")
+        zip_ref.writestr(f"{dist_info}/RECORD", "\n".join(record_lines) + "\n")
+    return path
+
+
+def make_venv(root: Path) -> Path:
+    """Creates a virtual environment (with `pip`) at `root`, returns its interpreter."""
+
+    subprocess.run([sys.executable, "-m", "venv", str(root)], check=True)
+    if get_platform() == Platform.WINDOWS:
+        return root / "Scripts" / "python.exe"
+    return root / "bin" / "python"
+
+
+def get_site_packages(executable: Path) -> Path:
+    cmd = [
+        str(executable),
+        "-c",
+        "import sysconfig; print(sysconfig.get_path('purelib'))",
+    ]
+    result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+    return Path(result.stdout.strip())
+
+
+def run_git(*args: str, cwd: Path) -> str:
+    """Runs `git` (with a committer identity) in `cwd`, returns the stripped stdout."""
+
+    cmd = ["git", "-c", "user.name=cfport", "-c", "user.email=cfport@test", *args]
+    result = subprocess.run(cmd, cwd=cwd, capture_output=True, text=True, check=True)
+    return result.stdout.strip()